@@ -0,0 +1,63 @@
+"""Compares applying chains of transformations one at a time against resampling once with the combined matrix.
+Run from the root of the project after compiling bpimage.so:
+
+    python3 benchmarks/affine_chain.py
+"""
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bpimage'))
+import transform  # noqa: E402
+
+CHAINS = {
+    'scale rotate shear': [(transform.scale, [0.5]), (transform.rotate, [15, True]), (transform.shear, [0.1, 0, True])],
+    'rotate rotate': [(transform.rotate, [30, True]), (transform.rotate, [-30, True])],
+    'flipv rotate90 fliph': [(transform.flipv, []), (transform.rotate90, [1]), (transform.fliph, [])],
+    'scale up rotate': [(transform.scale, [1.5]), (transform.rotate, [45, False])],
+}
+
+
+def _time(func, repeat):
+    """Returns the fastest wall time in seconds of invoking the function.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _apply_each(img, ops):
+    """Applies each transformation in turn.
+    """
+    for command, args in ops:
+        img = command(img, *args)
+    return img
+
+
+def _main():
+    parser = ArgumentParser(description='Compares applying chains of transformations one at a time against resampling once.')
+    parser.add_argument('--megapixels', type=float, default=12, help='size of the synthetic image (default:%(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported (default:%(default)s)')
+    args = parser.parse_args()
+
+    # generate a random 3:2 image of the requested size.
+    width = int((args.megapixels * 1e6 * 1.5) ** .5)
+    height = int(width / 1.5)
+    img = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    print(f'image: {width}x{height}')
+    print(f'{"chain":<24}{"each s":>10}{"fused s":>10}{"speedup":>10}')
+    for name, ops in CHAINS.items():
+        each_seconds = _time(lambda: _apply_each(img, ops), args.repeat)
+        fused_seconds = _time(lambda: transform.apply_affines(img, ops), args.repeat)
+        print(f'{name:<24}{each_seconds:>10.3f}{fused_seconds:>10.3f}{each_seconds / fused_seconds:>10.2f}')
+
+
+if __name__ == '__main__':
+    _main()
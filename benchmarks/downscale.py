@@ -0,0 +1,93 @@
+"""Compares reducing an image with the averaging downscaler against point sampling it with the affine engine.
+Reports the time taken and the mean difference from an exact area average, lower is smoother.
+Run from the root of the project after compiling bpimage.so:
+
+    python3 benchmarks/downscale.py
+"""
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bpimage'))
+import clib  # noqa: E402
+import downscale  # noqa: E402
+import transform  # noqa: E402
+
+FACTORS = [0.5, 0.25, 0.1, 0.3, 0.13]
+
+
+def _time(func, repeat):
+    """Returns the fastest wall time in seconds of invoking the function, along with its result.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _point_sample(img, factor, interpolation):
+    """Scales the image with the affine engine alone, sampling the source at each destination pixel.
+    """
+    tform, (height, width) = transform._scale_transform(img.shape, factor)
+    tform = np.ascontiguousarray(tform, dtype=np.float32)
+    dest = np.empty((height, width, 3), dtype=np.uint8)
+    clib.lib.affine_transform(img, img.ctypes.shape, img.ctypes.strides, tform, dest, dest.ctypes.shape,
+                              dest.ctypes.strides, transform.INTERPOLATIONS[interpolation], 0, height)
+    return dest
+
+
+def _area_average(img, shape):
+    """Averages the source pixels covered by each destination pixel, weighting partially covered pixels, in float64.
+    """
+    def weights(size, dest_size):
+        edges = np.linspace(0, size, dest_size + 1)
+        starts, ends = edges[:-1, None], edges[1:, None]
+        pixels = np.arange(size)[None, :]
+        overlap = np.clip(np.minimum(ends, pixels + 1) - np.maximum(starts, pixels), 0, None)
+        return overlap / overlap.sum(axis=1, keepdims=True)
+
+    rows, cols = weights(img.shape[0], shape[0]), weights(img.shape[1], shape[1])
+    return np.einsum('yi,ijc,xj->yxc', rows, img.astype(np.float64), cols, optimize=True)
+
+
+def _main():
+    parser = ArgumentParser(description='Compares the averaging downscaler against point sampling.')
+    parser.add_argument('--megapixels', type=float, default=12, help='size of the synthetic image (default:%(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported (default:%(default)s)')
+    args = parser.parse_args()
+
+    # generate a 3:2 image with fine stripes, which alias when sampled, over smooth gradients.
+    width = int((args.megapixels * 1e6 * 1.5) ** .5)
+    height = int(width / 1.5)
+    rows, cols = np.mgrid[0:height, 0:width]
+    stripes = (np.sin(cols * 0.9) * 127.5 + 127.5).astype(np.uint8)
+    img = np.dstack([stripes, (cols * 255 // width).astype(np.uint8), (rows * 255 // height).astype(np.uint8)])
+
+    print(f'image: {width}x{height}')
+    print(f'{"factor":<8}{"method":<12}{"seconds":>10}{"mean diff":>12}')
+    for factor in FACTORS:
+        methods = {
+            'nearest': lambda: _point_sample(img, factor, 'nearest'),
+            'bicubic': lambda: _point_sample(img, factor, 'bicubic'),
+            'downscale': lambda: transform.scale(img, factor),
+            'pyramid': lambda: transform.scale(img, factor, pyramid=pyramid),
+        }
+        # a pyramid built ahead of time shows the cost when several sizes are made from the same image.
+        pyramid = downscale.Pyramid(img)
+        pyramid.level(downscale.level_for(transform._scale_transform(img.shape, factor)[0]))
+
+        expected = None
+        for name, func in methods.items():
+            seconds, result = _time(func, args.repeat)
+            if expected is None:
+                expected = _area_average(img, result.shape[:2])
+            print(f'{factor:<8}{name:<12}{seconds:>10.3f}{np.abs(result - expected).mean():>12.2f}')
+
+
+if __name__ == '__main__':
+    _main()
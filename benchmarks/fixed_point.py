@@ -0,0 +1,75 @@
+"""Compares the fixed-point convolution engine against the float engine for each filter.
+Reports the speedup and the largest difference between the two results.
+Run from the root of the project after compiling bpimage.so:
+
+    python3 benchmarks/fixed_point.py
+"""
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bpimage'))
+import filters  # noqa: E402
+
+KERNELS = {
+    'outline': filters._outline_kernel(),
+    'sharpen 2': filters._sharpen_kernel(2.0),
+    'emboss u 1': filters._emboss_kernel('u', 1),
+    'emboss l 3': filters._emboss_kernel('l', 3),
+    'motionblur': filters._motion_blur_kernel(),
+    'boxblur 1': filters._box_kernel(1),
+    'gaussian 2 1.0': filters._gaussian_kernel(2, 1.0),
+}
+
+
+def _time(func, repeat):
+    """Returns the fastest wall time in seconds of invoking the function, along with its result.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _main():
+    parser = ArgumentParser(description='Compares the fixed-point convolution engine against the float engine for each filter.')
+    parser.add_argument('--megapixels', type=float, default=24, help='size of the synthetic image (default:%(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported (default:%(default)s)')
+    args = parser.parse_args()
+
+    # generate a random 3:2 image of the requested size.
+    width = int((args.megapixels * 1e6 * 1.5) ** .5)
+    height = int(width / 1.5)
+    img = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    img = np.ascontiguousarray(img)
+
+    print(f'image: {width}x{height}')
+    print(f'{"filter":<16}{"float s":>10}{"fixed s":>10}{"speedup":>10}{"max diff":>10}{"% diff":>10}')
+    for name, (kern, bias) in KERNELS.items():
+        quantized = filters._quantize_kernel(kern, bias)
+        if quantized is None:
+            print(f'{name:<16}{"not quantizable":>30}')
+            continue
+
+        float_seconds, expected = _time(lambda: _convolve_float(img, kern, bias), args.repeat)
+        fixed_seconds, actual = _time(lambda: filters._convolve_fixed(img, kern, quantized, bias), args.repeat)
+        diff = np.abs(expected.astype(np.int16) - actual)
+        print(f'{name:<16}{float_seconds:>10.3f}{fixed_seconds:>10.3f}{float_seconds / fixed_seconds:>10.2f}'
+              f'{diff.max():>10}{np.count_nonzero(diff) / diff.size * 100:>10.3f}')
+
+
+def _convolve_float(img, kern, bias):
+    """Applies the kernel with the fastest of the float engines.
+    """
+    if (separated := filters._separate_kernel(kern)) is not None:
+        return filters._convolve_separable(img, *separated, bias=bias)
+    return filters._convolve_direct(img, kern, bias=bias)
+
+
+if __name__ == '__main__':
+    _main()
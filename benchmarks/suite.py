@@ -0,0 +1,289 @@
+"""Times every command of the CLI, along with chains of commands, on synthetic images of several sizes.
+Each case is applied the same way as the CLI, through the pipeline, and the wall time, throughput and peak memory
+are recorded. The startup of the CLI is timed too, by running it in a new interpreter for printing help and for
+a single edit of a small image. Results can be saved as JSON and compared against a baseline to catch regressions,
+for example after changing the compiler flags of bpimage.so or the imports of the CLI. Run after compiling bpimage.so:
+
+    python3 benchmarks/suite.py run -o results.json
+    python3 benchmarks/suite.py compare baseline.json results.json
+"""
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bpimage'))
+import cache  # noqa: E402
+import io_utils  # noqa: E402
+import main  # noqa: E402
+import pipeline  # noqa: E402
+
+SIZES = [0.25, 2, 12, 24, 100]
+
+# the command line arguments each command is timed with, every command in main.ACTIONS must be listed.
+COMMANDS = {
+    'rgb2gray': [],
+    'gray2rgb': [],
+    'sepia': [],
+    'brightness': ['1.2'],
+    'invert': [],
+    'contrast': ['1.2'],
+    'saturation': ['1.2'],
+    'flipv': [],
+    'fliph': [],
+    'rotate90': ['1'],
+    'rotate': ['30', 'true'],
+    'scale': ['0.5'],
+    'shear': ['0.2', '0', 'true'],
+    'boxblur': ['5'],
+    'outline': [],
+    'sharpen': ['2'],
+    'motionblur': [],
+    'emboss': ['u', '1'],
+    'gaussian': ['3', '1.5'],
+    'fastgaussian': ['5'],
+}
+
+# commands and chains which are timed on a source other than an RGB image, mapped to a function which prepares it.
+SOURCES = {
+    'gray2rgb': lambda img: np.ascontiguousarray(img[:, :, 0]),
+    'document scan': lambda img: np.ascontiguousarray(img[:, :, 0]),
+}
+
+# representative sequences of edits, as they would be passed to the CLI.
+CHAINS = {
+    'thumbnail': ['--scale', '0.25', '--sharpen', '1', '-i', 'bilinear'],
+    'straighten': ['--rotate', '3', 'false', '--scale', '0.5', '-i', 'bicubic'],
+    'color grade': ['--brightness', '1.1', '--contrast', '1.2', '--saturation', '0.8', '--sepia'],
+    'soften': ['--gaussian', '3', '1.5', '--boxblur', '2', '--sharpen', '1'],
+    'orient': ['--rotate90', '3', '--flipv'],
+    'document scan': ['--gaussian', '1', '0.8', '--rotate', '1.5', 'true', '--contrast', '1.3', '--sharpen', '1',
+                      '-i', 'bilinear'],
+}
+
+# command lines of the CLI timed from a new interpreter, {source} and {dest} are replaced with the paths of
+# a small image and its result.
+STARTUP = {
+    'startup help': ['--help'],
+    'startup invert': ['{source}', '-d', '{dest}', '--invert'],
+}
+
+# size of the image the startup cases edit, small so the time is dominated by starting the CLI.
+STARTUP_MEGAPIXELS = 0.25
+
+
+def _time(func, repeat):
+    """Returns the fastest wall time in seconds of invoking the function.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _time_process(command: list[str], repeat: int, cwd: str) -> float:
+    """Returns the fastest wall time in seconds of running the command in a new process.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        best = min(best, time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError(f'{" ".join(command)} failed: {process.stderr.decode().strip()}')
+    return best
+
+
+def _run_startup(cases: dict[str, list[str]], repeat: int) -> list[dict]:
+    """Times the startup cases, running the CLI from a temporary directory so it can't depend on the working directory.
+    The peak memory of the new process isn't recorded, on linux it includes the memory of this process it was forked from.
+    """
+    results = []
+    print(f'{"case":<16}{"megapixels":>12}{"seconds":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        width = int((STARTUP_MEGAPIXELS * 1e6 * 1.5) ** .5)
+        height = int(width / 1.5)
+        source, dest = os.path.join(directory, 'source.png'), os.path.join(directory, 'dest.png')
+        io_utils.save(np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8), source)
+
+        for name, tokens in cases.items():
+            args = [token.format(source=source, dest=dest) for token in tokens]
+            seconds = _time_process([sys.executable, str(Path(main.__file__).resolve()), *args], repeat, directory)
+            # help doesn't touch an image, so it has no size.
+            megapixels = STARTUP_MEGAPIXELS if '{source}' in tokens else 0
+            results.append({'case': name, 'args': tokens, 'megapixels': megapixels, 'seconds': seconds,
+                            'mp_per_s': height * width / 1e6 / seconds if megapixels else None, 'peak_rss_mb': None})
+            print(f'{name:<16}{megapixels:>12}{seconds:>10.4f}')
+    return results
+
+
+def _reset_peak_rss() -> bool:
+    """Resets the peak resident memory of the process so the next case is measured on its own.
+    Returns false where the peak can't be reset, in which case the peak of the whole run is reported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    """Returns the peak resident memory of the process in megabytes.
+    """
+    try:
+        with open('/proc/self/status') as file:
+            return int(re.search(r'VmHWM:\s+(\d+) kB', file.read()).group(1)) / 1024
+    except (OSError, AttributeError):
+        # linux reports kilobytes and macos bytes.
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+def _parse_ops(tokens: list[str]) -> tuple[list, bool]:
+    """Parses command line arguments into operations with the parser of the CLI.
+    Returns the operations and whether they should be applied unclamped.
+    """
+    parser = ArgumentParser()
+    main.add_operation_arguments(parser)
+    args = parser.parse_args(tokens)
+    return main._get_ops(args), args.fast
+
+
+def _cases(names: list[str] | None) -> dict[str, list[str]]:
+    """Returns the arguments of every case to run, the commands followed by the chains and the startup cases.
+    """
+    missing = set(command for group in main.ACTIONS.values() for command in group) - set(COMMANDS)
+    if missing:
+        raise ValueError(f'No benchmark arguments for {", ".join(sorted(missing))}, add them to COMMANDS.')
+    cases = {name: [f'--{name}', *args] for name, args in COMMANDS.items()}
+    cases.update(CHAINS)
+    cases.update(STARTUP)
+    if names:
+        unknown = set(names) - set(cases)
+        if unknown:
+            raise ValueError(f'Unknown cases: {", ".join(sorted(unknown))}')
+        cases = {name: tokens for name, tokens in cases.items() if name in names}
+    return cases
+
+
+def _run(args) -> dict:
+    cases = _cases(args.cases)
+    startup = {name: tokens for name, tokens in cases.items() if name in STARTUP}
+    cases = {name: tokens for name, tokens in cases.items() if name not in STARTUP}
+    results = []
+    if cases:
+        print(f'{"case":<16}{"megapixels":>12}{"seconds":>10}{"MP/s":>10}{"peak MB":>10}')
+    for megapixels in args.sizes if cases else []:
+        # generate a random 3:2 image of the requested size.
+        width = int((megapixels * 1e6 * 1.5) ** .5)
+        height = int(width / 1.5)
+        img = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+        for name, tokens in cases.items():
+            ops, unclamped = _parse_ops(tokens)
+            source = SOURCES.get(name, lambda img: img)(img)
+            _reset_peak_rss()
+            seconds = _time(lambda: pipeline.Pipeline(source, ops).compute(unclamped), args.repeat)
+            peak = _peak_rss_mb()
+            del source
+
+            result = {'case': name, 'args': tokens, 'megapixels': megapixels, 'seconds': seconds,
+                      'mp_per_s': height * width / 1e6 / seconds, 'peak_rss_mb': peak}
+            results.append(result)
+            print(f'{name:<16}{megapixels:>12}{seconds:>10.4f}{result["mp_per_s"]:>10.1f}{peak:>10.1f}')
+
+    if startup:
+        if results:
+            print()
+        results.extend(_run_startup(startup, args.repeat))
+
+    return {
+        'library': cache.library_version(),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version(),
+                    'numpy': np.__version__},
+        'repeat': args.repeat,
+        # whether peak_rss_mb is the peak of each case or of the whole run up to that case.
+        'peak_rss_per_case': _reset_peak_rss(),
+        'results': results,
+    }
+
+
+def _compare(baseline: dict, current: dict, threshold: float) -> int:
+    """Prints the change in time of every case found in both results, flagging those slower by more than the threshold.
+    Returns the number of regressions.
+    """
+    def key(result):
+        return result['case'], result['megapixels']
+    before = {key(result): result for result in baseline['results']}
+
+    regressions = 0
+    print(f'{"case":<16}{"megapixels":>12}{"baseline s":>12}{"seconds":>10}{"change":>10}')
+    for result in current['results']:
+        if key(result) not in before:
+            continue
+        base_seconds = before[key(result)]['seconds']
+        change = result['seconds'] / base_seconds - 1
+        regressed = change > threshold
+        regressions += regressed
+        print(f'{result["case"]:<16}{result["megapixels"]:>12}{base_seconds:>12.4f}{result["seconds"]:>10.4f}'
+              f'{change:>+10.1%}{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def _load(path: Path) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def _main():
+    parser = ArgumentParser(description='Times every command of the CLI and chains of commands on synthetic images.')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    run_parser = subparsers.add_parser('run', help='time the cases, optionally comparing against a baseline')
+    run_parser.add_argument('--sizes', type=float, nargs='+', default=SIZES, metavar='megapixels',
+                            help='sizes of the synthetic images (default:%(default)s)')
+    run_parser.add_argument('--cases', nargs='+', metavar='name', help='only run the named commands and chains')
+    run_parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported (default:%(default)s)')
+    run_parser.add_argument('-o', '--output', type=Path, help='save the results as JSON')
+    run_parser.add_argument('--baseline', type=Path, help='compare the results against a saved baseline')
+    compare_parser = subparsers.add_parser('compare', help='compare saved results against a saved baseline')
+    compare_parser.add_argument('baseline', type=Path)
+    compare_parser.add_argument('results', type=Path)
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--threshold', type=float, default=0.1,
+                               help='fraction a case may slow down by before it is flagged (default:%(default)s)')
+    args = parser.parse_args()
+
+    if args.mode == 'compare':
+        current, baseline = _load(args.results), _load(args.baseline)
+    else:
+        current = _run(args)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(current, file, indent=2)
+        if not args.baseline:
+            return
+        baseline = _load(args.baseline)
+        print()
+
+    if baseline['library'] != current['library'] or baseline['machine'] != current['machine']:
+        print('note: the library or machine differs from the baseline')
+    regressions = _compare(baseline, current, args.threshold)
+    if regressions:
+        return f'{regressions} cases regressed by more than {args.threshold:.0%}.'
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,63 @@
+"""Reports how convolution filters and transformations scale with the number of worker threads.
+Run from the root of the project after compiling bpimage.so:
+
+    python3 benchmarks/threads.py
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bpimage'))
+import filters  # noqa: E402
+import parallel  # noqa: E402
+import transform  # noqa: E402
+
+FILTERS = {
+    'gaussian 15 5.0': lambda img: filters.gaussian_blur(img, 15, 5.0),
+    'outline': filters.outline,
+    'motionblur': filters.motion_blur,
+    'rotate 30': lambda img: transform.rotate(img, 30),
+}
+
+
+def _time(func, img, repeat):
+    """Returns the fastest wall time in seconds of invoking the function on the image.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(img)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _main():
+    parser = ArgumentParser(description='Reports how convolution filters and transformations scale with the number of worker threads.')
+    parser.add_argument('--megapixels', type=float, default=24, help='size of the synthetic image (default:%(default)s)')
+    parser.add_argument('--max-threads', type=int, default=os.cpu_count(), help='largest thread count to test (default:%(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported (default:%(default)s)')
+    args = parser.parse_args()
+
+    # generate a random 3:2 image of the requested size.
+    width = int((args.megapixels * 1e6 * 1.5) ** .5)
+    height = int(width / 1.5)
+    img = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    thread_counts = sorted({1, *(2 ** i for i in range(1, args.max_threads.bit_length())), args.max_threads})
+    print(f'image: {width}x{height}')
+    print(f'{"filter":<20}{"threads":>8}{"seconds":>10}{"MP/s":>10}{"speedup":>10}')
+    for name, func in FILTERS.items():
+        baseline = None
+        for threads in thread_counts:
+            parallel.set_threads(threads)
+            seconds = _time(func, img, args.repeat)
+            baseline = baseline or seconds
+            print(f'{name:<20}{threads:>8}{seconds:>10.3f}{(width * height / 1e6) / seconds:>10.1f}{baseline / seconds:>10.2f}')
+
+
+if __name__ == '__main__':
+    _main()
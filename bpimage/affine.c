@@ -1,68 +1,1030 @@
-#include <stdio.h>
+#include <math.h>
+#include <stdint.h>
 #include <string.h>
 
-// The memory size of a single RGB pixel (composed of 3 unsigned chars for RGB)
-const size_t PIXEL_SIZE = 3 * sizeof(unsigned char);
+#if defined(__SSE2__)
+#include <emmintrin.h>
+#endif
+
+// The most channels a pixel may have, RGBA.
+#define MAX_CHANNELS 4
+
+// Supported strategies for sampling the source image between pixels
+#define INTERPOLATION_NEAREST 0
+#define INTERPOLATION_BILINEAR 1
+#define INTERPOLATION_BICUBIC 2
+
+// Source coordinates are stepped in 32.32 fixed point, so stepping along a row is exact integer math
+// and the range of columns which land inside the source can be solved exactly.
+#define FIXED_SHIFT 32
+#define FIXED_ONE ((int64_t)1 << FIXED_SHIFT)
+#define FIXED_HALF (FIXED_ONE >> 1)
+
+// The matrix is single precision, so coordinates which should land exactly on a pixel can fall just short of it.
+// Nudge every coordinate forward by a fraction of a pixel so they don't truncate to the previous pixel.
+#define FIXED_NUDGE (FIXED_ONE >> 12)
+
+// Interpolation weights are integers where WEIGHT_ONE represents 1.0. The position between two pixels is quantized
+// to one of WEIGHT_ONE phases, so the weights for every phase can be calculated before the image is touched.
+#define WEIGHT_BITS 10
+#define WEIGHT_ONE (1 << WEIGHT_BITS)
+
+// Samples are interpolated between source rows first, then between the columns of those results. The results of the
+// first pass are rounded to 16 bits (at most 255 * 1.125 * 1024 >> 4 = 18360 for bicubic), so both passes multiply
+// 16 bit values by 16 bit weights, which SSE2 does eight at a time with pmaddwd. Every path rounds at the same points,
+// so the vectorized and plain loops give identical results.
+#define ROW_SHIFT 4
+#define ROW_ROUND (1 << (ROW_SHIFT - 1))
+#define COLUMN_SHIFT (2 * WEIGHT_BITS - ROW_SHIFT)
+#define COLUMN_ROUND (1 << (COLUMN_SHIFT - 1))
+
+// Rows interpolated between source rows are padded with copies of the edge pixels, two for the taps of bicubic which
+// fall before the first column and three after the last, the extra one for the 8 byte loads of three channel pixels.
+#define PAD_BEFORE 2
+#define PAD_AFTER 3
+
+// The free parameter of the bicubic kernel, -0.5 gives the catmull-rom spline.
+#define BICUBIC_A -0.5
+
+/*
+Divides and rounds towards negative infinity.
+ */
+static inline int64_t floor_div(int64_t a, int64_t b)
+{
+    int64_t q = a / b;
+    return (a % b != 0 && ((a < 0) != (b < 0))) ? q - 1 : q;
+}
+
+/*
+Divides and rounds towards positive infinity.
+ */
+static inline int64_t ceil_div(int64_t a, int64_t b)
+{
+    int64_t q = a / b;
+    return (a % b != 0 && ((a < 0) == (b < 0))) ? q + 1 : q;
+}
+
+/*
+Narrows the range [first, last) of integers i to those where start + i * step falls within [lo, hi).
+
+@param start: The fixed point coordinate at i = 0.
+@param step: The fixed point amount the coordinate changes for each increment of i.
+@param lo: The lowest fixed point coordinate allowed.
+@param hi: The fixed point coordinate to stop at (exclusive).
+@param first: The lowest i in the range, updated in place.
+@param last: The end of the range (exclusive), updated in place. The range is empty if last <= first.
+ */
+static void clip_span(int64_t start, int64_t step, int64_t lo, int64_t hi, int64_t *first, int64_t *last)
+{
+    lo -= start;
+    hi -= start + 1;
+
+    if (step == 0)
+    {
+        // the coordinate is the same for the entire row, either all or none of it is inside.
+        if (lo > 0 || hi < 0)
+        {
+            *last = *first;
+        }
+        return;
+    }
+
+    // solve lo <= i * step <= hi, dividing by a negative step swaps the bounds.
+    int64_t low = step > 0 ? ceil_div(lo, step) : ceil_div(hi, step);
+    int64_t high = (step > 0 ? floor_div(hi, step) : floor_div(lo, step)) + 1;
+    if (low > *first)
+    {
+        *first = low;
+    }
+    if (high < *last)
+    {
+        *last = high;
+    }
+}
+
+/*
+Sets the pixels of a row in the range [start, end) to zero.
+ */
+static inline void clear_columns(unsigned char *row, long stride, int channels, int64_t start, int64_t end)
+{
+    int64_t x;
+
+    if (stride == channels)
+    {
+        // pixels are packed so the range can be cleared at once.
+        memset(row + start * channels, 0, (end - start) * channels);
+        return;
+    }
+    for (x = start; x < end; x++)
+    {
+        memset(row + stride * x, 0, channels);
+    }
+}
+
+/*
+Rounds a sum of source values weighted between rows to the 16 bit precision kept between the passes.
+ */
+static inline int to_row(int value)
+{
+    return (value + ROW_ROUND) >> ROW_SHIFT;
+}
+
+/*
+Converts a sum of row results weighted between columns back to a channel value, clamping the overshoot of bicubic.
+ */
+static inline unsigned char to_channel(int value)
+{
+    value = (value + COLUMN_ROUND) >> COLUMN_SHIFT;
+    return value < 0 ? 0 : (value > 255 ? 255 : value);
+}
+
+/*
+Evaluates the bicubic kernel at the given distance from the sample position.
+ */
+static double bicubic(double distance)
+{
+    double d = fabs(distance);
+    if (d <= 1)
+    {
+        return ((BICUBIC_A + 2) * d - (BICUBIC_A + 3)) * d * d + 1;
+    }
+    if (d < 2)
+    {
+        return ((BICUBIC_A * d - 5 * BICUBIC_A) * d + 8 * BICUBIC_A) * d - 4 * BICUBIC_A;
+    }
+    return 0;
+}
+
+/*
+Fills the table with the four bicubic weights of every phase, rounded so each set of weights sums to exactly WEIGHT_ONE.
+
+@param table: Array with WEIGHT_ONE * 4 elements.
+ */
+static void build_bicubic_table(int16_t *table)
+{
+    int phase, i, sum;
+    double t;
+
+    for (phase = 0; phase < WEIGHT_ONE; phase++)
+    {
+        t = (double)phase / WEIGHT_ONE;
+        sum = 0;
+        for (i = 0; i < 4; i++)
+        {
+            table[phase * 4 + i] = (int16_t)lround(bicubic(t + 1 - i) * WEIGHT_ONE);
+            sum += table[phase * 4 + i];
+        }
+        // give any rounding error to the pixel nearest the sample, so flat areas stay exactly flat.
+        table[phase * 4 + (t < 0.5 ? 1 : 2)] += WEIGHT_ONE - sum;
+    }
+}
+
+/*
+Returns the phase of a fixed point coordinate, its position between two pixels quantized to WEIGHT_BITS.
+ */
+static inline int phase_of(int64_t coord)
+{
+    return (int)((coord >> (FIXED_SHIFT - WEIGHT_BITS)) & (WEIGHT_ONE - 1));
+}
+
+/*
+Fills weights with the interpolation weights of a phase and returns the number of weights, the first weight
+applies to the pixel before the sample for bicubic and to the pixel the sample falls in for bilinear.
+ */
+static inline int phase_weights(int interpolation, const int16_t *table, int phase, int *weights)
+{
+    int i;
+
+    if (interpolation == INTERPOLATION_BICUBIC)
+    {
+        for (i = 0; i < 4; i++)
+        {
+            weights[i] = table[phase * 4 + i];
+        }
+        return 4;
+    }
+    weights[0] = WEIGHT_ONE - phase;
+    weights[1] = phase;
+    return 2;
+}
+
+/*
+Returns the index clamped within [0, length), used to repeat the edge pixels for samples which overlap the border.
+ */
+static inline long clamp_index(int64_t index, size_t length)
+{
+    return index < 0 ? 0 : (index >= (int64_t)length ? (long)length - 1 : (long)index);
+}
+
+/*
+Interpolates a single pixel whose neighbours may fall outside of the source image, the nearest edge pixel is repeated.
+Pixels near the border are rare so this favours simplicity over speed.
+
+@param x: The fixed point column of the sample, relative to the centers of the source pixels.
+@param y: The fixed point row of the sample, relative to the centers of the source pixels.
+ */
+static void sample_clamped(const unsigned char *img, size_t *img_shape, long s0, long s1, int channels, int interpolation,
+                           const int16_t *table, int64_t x, int64_t y, unsigned char *out)
+{
+    int wx[4], wy[4], i, j, c, column_sum;
+    long rows[4], cols[4];
+    int taps = phase_weights(interpolation, table, phase_of(x), wx);
+    int64_t ix = (x >> FIXED_SHIFT) - (taps == 4);
+    int64_t iy = (y >> FIXED_SHIFT) - (taps == 4);
+    int acc[MAX_CHANNELS] = {0};
+
+    phase_weights(interpolation, table, phase_of(y), wy);
+
+    for (i = 0; i < taps; i++)
+    {
+        rows[i] = s0 * clamp_index(iy + i, img_shape[0]);
+        cols[i] = s1 * clamp_index(ix + i, img_shape[1]);
+    }
+
+    for (i = 0; i < taps; i++)
+    {
+        for (c = 0; c < channels; c++)
+        {
+            column_sum = 0;
+            for (j = 0; j < taps; j++)
+            {
+                column_sum += img[rows[j] + cols[i] + c] * wy[j];
+            }
+            acc[c] += to_row(column_sum) * wx[i];
+        }
+    }
+
+    for (c = 0; c < channels; c++)
+    {
+        out[c] = to_channel(acc[c]);
+    }
+}
 
 /*
-Applies a convolution kernel to the image and writes the result to the destination image.
+Copies the nearest source pixel for each of count destination pixels, every sample must fall inside the source.
+ */
+static inline __attribute__((always_inline)) void nearest_span(const unsigned char *restrict img, long s0, long s1, int64_t x, int64_t y,
+                                                               int64_t step_x, int64_t step_y, unsigned char *restrict out, long ds1,
+                                                               int64_t count, const int channels)
+{
+    const unsigned char *pixel;
+    int c;
+
+    for (; count > 0; count--)
+    {
+        pixel = img + s0 * (y >> FIXED_SHIFT) + s1 * (x >> FIXED_SHIFT);
+        for (c = 0; c < channels; c++)
+        {
+            out[c] = pixel[c];
+        }
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
+
+/*
+Blends the 2x2 source pixels surrounding each of count samples, every neighbour must fall inside the source.
+ */
+static inline __attribute__((always_inline)) void bilinear_span(const unsigned char *restrict img, long s0, long s1, int64_t x, int64_t y,
+                                                                int64_t step_x, int64_t step_y, unsigned char *restrict out, long ds1,
+                                                                int64_t count, const int channels)
+{
+    const unsigned char *top, *bottom;
+    int px, py, c, left, right;
+
+    for (; count > 0; count--)
+    {
+        px = phase_of(x);
+        py = phase_of(y);
+        top = img + s0 * (y >> FIXED_SHIFT) + s1 * (x >> FIXED_SHIFT);
+        bottom = top + s0;
+        for (c = 0; c < channels; c++)
+        {
+            left = to_row(top[c] * (WEIGHT_ONE - py) + bottom[c] * py);
+            right = to_row(top[s1 + c] * (WEIGHT_ONE - py) + bottom[s1 + c] * py);
+            out[c] = to_channel(left * (WEIGHT_ONE - px) + right * px);
+        }
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
+
+/*
+Applies the bicubic weights of the 4x4 source pixels surrounding each of count samples, every neighbour must fall inside the source.
+ */
+static inline __attribute__((always_inline)) void bicubic_span(const unsigned char *restrict img, long s0, long s1, int64_t x, int64_t y,
+                                                               int64_t step_x, int64_t step_y, unsigned char *restrict out, long ds1,
+                                                               int64_t count, const int16_t *table, const int channels)
+{
+    const unsigned char *row, *column;
+    const int16_t *wx, *wy;
+    int i, c, acc;
+
+    for (; count > 0; count--)
+    {
+        wx = table + phase_of(x) * 4;
+        wy = table + phase_of(y) * 4;
+        row = img + s0 * ((y >> FIXED_SHIFT) - 1) + s1 * ((x >> FIXED_SHIFT) - 1);
+        for (c = 0; c < channels; c++)
+        {
+            acc = 0;
+            for (i = 0; i < 4; i++)
+            {
+                column = row + s1 * i + c;
+                acc += to_row(column[0] * wy[0] + column[s0] * wy[1] + column[2 * s0] * wy[2] + column[3 * s0] * wy[3]) * wx[i];
+            }
+            out[c] = to_channel(acc);
+        }
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
+
+#if defined(__SSE2__)
+/*
+Returns a vector with the pair of 16 bit weights [a, b] repeated, for pmaddwd to apply to interleaved pairs of values.
+ */
+static inline __m128i weight_pair(int a, int b)
+{
+    return _mm_set1_epi32((int)((uint32_t)(uint16_t)a | (uint32_t)(uint16_t)b << 16));
+}
+
+/*
+Returns a vector with a pair of adjacent 16 bit weights repeated.
+ */
+static inline __m128i load_weight_pair(const int16_t *weights)
+{
+    uint32_t pair;
+
+    memcpy(&pair, weights, 4);
+    return _mm_set1_epi32((int)pair);
+}
+
+/*
+Loads two adjacent pixels of 3 or 4 channels into the low 8 bytes, one pixel in each 4 bytes.
+Never reads past the second pixel, so it is safe at the very end of the image.
+ */
+static inline __attribute__((always_inline)) __m128i load_pixel_pair(const unsigned char *pixels, const int channels)
+{
+    uint32_t first, second;
+
+    if (channels == 4)
+    {
+        return _mm_loadl_epi64((const __m128i *)pixels);
+    }
+    // the second pixel is loaded from one byte early and shifted down, so the load ends with the pixel.
+    memcpy(&first, pixels, 4);
+    memcpy(&second, pixels + 2, 4);
+    return _mm_unpacklo_epi32(_mm_cvtsi32_si128((int)first), _mm_cvtsi32_si128((int)(second >> 8)));
+}
+
+/*
+Interpolates a pair of adjacent pixels between two rows, giving the weighted sums of the channels of each pixel as 32 bit lanes.
+
+@param weights: The weights of the rows from weight_pair.
+ */
+static inline __attribute__((always_inline)) void blend_pixel_pair(const unsigned char *a, const unsigned char *b, __m128i weights,
+                                                                   const int channels, __m128i *first, __m128i *second)
+{
+    __m128i zero = _mm_setzero_si128();
+    __m128i pairs = _mm_unpacklo_epi8(load_pixel_pair(a, channels), load_pixel_pair(b, channels));
+    *first = _mm_madd_epi16(_mm_unpacklo_epi8(pairs, zero), weights);
+    *second = _mm_madd_epi16(_mm_unpackhi_epi8(pairs, zero), weights);
+}
+
+/*
+Rounds the 32 bit lanes of sums weighted between rows to the precision kept between the passes.
+ */
+static inline __m128i to_rows(__m128i sums)
+{
+    return _mm_srai_epi32(_mm_add_epi32(sums, _mm_set1_epi32(ROW_ROUND)), ROW_SHIFT);
+}
+
+/*
+Interpolates between two columns whose 16 bit channels are packed in the low and high 8 bytes of the vector,
+giving the weighted sum of each channel as 32 bit lanes.
+ */
+static inline __m128i blend_column_pair(__m128i columns, __m128i weights)
+{
+    return _mm_madd_epi16(_mm_unpacklo_epi16(columns, _mm_srli_si128(columns, 8)), weights);
+}
+
+/*
+Writes the channels of a pixel from the 32 bit lanes of sums weighted between columns, clamping the overshoot of bicubic.
+ */
+static inline __attribute__((always_inline)) void store_pixel(unsigned char *out, __m128i sums, const int channels)
+{
+    __m128i values = _mm_srai_epi32(_mm_add_epi32(sums, _mm_set1_epi32(COLUMN_ROUND)), COLUMN_SHIFT);
+    // saturating to 16 bits and then to unsigned 8 bits clamps each channel to [0, 255].
+    values = _mm_packs_epi32(values, values);
+    uint32_t pixel = (uint32_t)_mm_cvtsi128_si32(_mm_packus_epi16(values, values));
+    memcpy(out, &pixel, channels);
+}
+
+/*
+Vectorized bilinear_span for packed pixels of 3 or 4 channels, each pixel is interpolated in the lanes of one vector.
+ */
+static inline __attribute__((always_inline)) void bilinear_span_sse2(const unsigned char *restrict img, long s0, int64_t x, int64_t y,
+                                                                     int64_t step_x, int64_t step_y, unsigned char *restrict out, long ds1,
+                                                                     int64_t count, const int channels)
+{
+    const unsigned char *top;
+    __m128i left, right;
+    int px, py;
+
+    for (; count > 0; count--)
+    {
+        px = phase_of(x);
+        py = phase_of(y);
+        top = img + s0 * (y >> FIXED_SHIFT) + channels * (x >> FIXED_SHIFT);
+        blend_pixel_pair(top, top + s0, weight_pair(WEIGHT_ONE - py, py), channels, &left, &right);
+        store_pixel(out, blend_column_pair(_mm_packs_epi32(to_rows(left), to_rows(right)), weight_pair(WEIGHT_ONE - px, px)), channels);
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
 
-@param img_padded: A version of the source image padded on all sides by the kernel.
-    Expected to have shape of (img height + kern height -1, img width + kern width - 1, 3).
-    Expected to be in contigious row major layout.
-@param kern: The convolution kernel to apply to the image.
-    Expected to be a contigious 2 dimensional array in row major order with shape (N,N) where N is an odd number > 1
-@param dest: The destination image to write the results to.
-    Expected to have the same shape as the original unpadded image. (img height, img width, 3)
-    Expected to be in contigious row major layout.
-@param bias: A constant value that is added to the result for each pixel after convolution is calculated.
-@param dest_shape: The shape of the image in format (height, width)
-@param kern_shape: The shape of the kernel in format (height, width)
+/*
+Vectorized bicubic_span for packed pixels of 3 or 4 channels, each pixel is interpolated in the lanes of one vector.
+ */
+static inline __attribute__((always_inline)) void bicubic_span_sse2(const unsigned char *restrict img, long s0, int64_t x, int64_t y,
+                                                                    int64_t step_x, int64_t step_y, unsigned char *restrict out, long ds1,
+                                                                    int64_t count, const int16_t *table, const int channels)
+{
+    const unsigned char *row;
+    const int16_t *wx, *wy;
+    __m128i top, bottom, c0, c1, c2, c3, w01, w23;
+
+    for (; count > 0; count--)
+    {
+        wx = table + phase_of(x) * 4;
+        wy = table + phase_of(y) * 4;
+        w01 = load_weight_pair(wy);
+        w23 = load_weight_pair(wy + 2);
+        row = img + s0 * ((y >> FIXED_SHIFT) - 1) + channels * ((x >> FIXED_SHIFT) - 1);
+
+        // interpolate the four columns between the four rows, a pair of columns at a time.
+        blend_pixel_pair(row, row + s0, w01, channels, &c0, &c1);
+        blend_pixel_pair(row + 2 * s0, row + 3 * s0, w23, channels, &top, &bottom);
+        c0 = _mm_add_epi32(c0, top);
+        c1 = _mm_add_epi32(c1, bottom);
+        blend_pixel_pair(row + 2 * channels, row + s0 + 2 * channels, w01, channels, &c2, &c3);
+        blend_pixel_pair(row + 2 * s0 + 2 * channels, row + 3 * s0 + 2 * channels, w23, channels, &top, &bottom);
+        c2 = _mm_add_epi32(c2, top);
+        c3 = _mm_add_epi32(c3, bottom);
+
+        store_pixel(out, _mm_add_epi32(blend_column_pair(_mm_packs_epi32(to_rows(c0), to_rows(c1)), load_weight_pair(wx)),
+                                       blend_column_pair(_mm_packs_epi32(to_rows(c2), to_rows(c3)), load_weight_pair(wx + 2))),
+                    channels);
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
+/*
+Vectorized bilinear_span for grayscale, the pair of columns is interpolated between the rows in the lanes of one vector.
+ */
+static inline void bilinear_span_gray_sse2(const unsigned char *restrict img, long s0, int64_t x, int64_t y, int64_t step_x,
+                                           int64_t step_y, unsigned char *restrict out, long ds1, int64_t count)
+{
+    const unsigned char *top;
+    __m128i zero = _mm_setzero_si128(), columns;
+    uint16_t upper, lower;
+    int px, py;
+
+    for (; count > 0; count--)
+    {
+        px = phase_of(x);
+        py = phase_of(y);
+        top = img + s0 * (y >> FIXED_SHIFT) + (x >> FIXED_SHIFT);
+        memcpy(&upper, top, 2);
+        memcpy(&lower, top + s0, 2);
+        columns = _mm_unpacklo_epi8(_mm_unpacklo_epi8(_mm_cvtsi32_si128(upper), _mm_cvtsi32_si128(lower)), zero);
+        columns = to_rows(_mm_madd_epi16(columns, weight_pair(WEIGHT_ONE - py, py)));
+        store_pixel(out, _mm_madd_epi16(_mm_packs_epi32(columns, columns), weight_pair(WEIGHT_ONE - px, px)), 1);
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
+
+/*
+Vectorized bicubic_span for grayscale, the four columns are interpolated between the rows in the lanes of one vector.
+ */
+static inline void bicubic_span_gray_sse2(const unsigned char *restrict img, long s0, int64_t x, int64_t y, int64_t step_x,
+                                          int64_t step_y, unsigned char *restrict out, long ds1, int64_t count, const int16_t *table)
+{
+    const unsigned char *row;
+    const int16_t *wx, *wy;
+    __m128i zero = _mm_setzero_si128(), top, bottom, sums;
+    uint32_t r0, r1, r2, r3;
+
+    for (; count > 0; count--)
+    {
+        wx = table + phase_of(x) * 4;
+        wy = table + phase_of(y) * 4;
+        row = img + s0 * ((y >> FIXED_SHIFT) - 1) + ((x >> FIXED_SHIFT) - 1);
+        memcpy(&r0, row, 4);
+        memcpy(&r1, row + s0, 4);
+        memcpy(&r2, row + 2 * s0, 4);
+        memcpy(&r3, row + 3 * s0, 4);
+        top = _mm_unpacklo_epi8(_mm_unpacklo_epi8(_mm_cvtsi32_si128((int)r0), _mm_cvtsi32_si128((int)r1)), zero);
+        bottom = _mm_unpacklo_epi8(_mm_unpacklo_epi8(_mm_cvtsi32_si128((int)r2), _mm_cvtsi32_si128((int)r3)), zero);
+        sums = to_rows(_mm_add_epi32(_mm_madd_epi16(top, load_weight_pair(wy)), _mm_madd_epi16(bottom, load_weight_pair(wy + 2))));
+        // weight the four columns, then add the two pairs of columns together.
+        sums = _mm_madd_epi16(_mm_packs_epi32(sums, sums), _mm_loadl_epi64((const __m128i *)wx));
+        store_pixel(out, _mm_add_epi32(sums, _mm_shuffle_epi32(sums, _MM_SHUFFLE(1, 1, 1, 1))), 1);
+        out += ds1;
+        x += step_x;
+        y += step_y;
+    }
+}
+#endif
+
+/*
+Samples count destination pixels with the interpolation, every neighbour must fall inside the source.
+Always inlined with a constant number of channels, so the loops over the channels of each pixel are unrolled.
+ */
+static inline __attribute__((always_inline)) void sample_span(const unsigned char *restrict img, long s0, long s1, int interpolation,
+                                                              const int16_t *table, int64_t x, int64_t y, int64_t step_x, int64_t step_y,
+                                                              unsigned char *restrict out, long ds1, int64_t count, const int channels)
+{
+#if defined(__SSE2__)
+    // the channels of a packed pixel fit the lanes of a vector, so interpolate a pixel at a time with SSE2.
+    if (channels == 1 && s1 == 1)
+    {
+        switch (interpolation)
+        {
+        case INTERPOLATION_BICUBIC:
+            bicubic_span_gray_sse2(img, s0, x, y, step_x, step_y, out, ds1, count, table);
+            return;
+        case INTERPOLATION_BILINEAR:
+            bilinear_span_gray_sse2(img, s0, x, y, step_x, step_y, out, ds1, count);
+            return;
+        }
+    }
+    else if (s1 == channels)
+    {
+        switch (interpolation)
+        {
+        case INTERPOLATION_BICUBIC:
+            bicubic_span_sse2(img, s0, x, y, step_x, step_y, out, ds1, count, table, channels);
+            return;
+        case INTERPOLATION_BILINEAR:
+            bilinear_span_sse2(img, s0, x, y, step_x, step_y, out, ds1, count, channels);
+            return;
+        }
+    }
+#endif
+    switch (interpolation)
+    {
+    case INTERPOLATION_BICUBIC:
+        bicubic_span(img, s0, s1, x, y, step_x, step_y, out, ds1, count, table, channels);
+        break;
+    case INTERPOLATION_BILINEAR:
+        bilinear_span(img, s0, s1, x, y, step_x, step_y, out, ds1, count, channels);
+        break;
+    default:
+        nearest_span(img, s0, s1, x, y, step_x, step_y, out, ds1, count, channels);
+    }
+}
+
+/*
+Maps each pixel of the destination image back to the source image using the inverse transformation matrix
+and samples the source at that location. Destination pixels which map outside of the source image are set to zero.
+
+@param img: The source image with shape (height, width, channels), may have any strides.
+@param img_shape: The shape of the source image in format (height, width)
+@param img_strides: The strides in bytes of the source image in format (row, column)
+@param inv_transform: A contigious 3x3 matrix in row major order which maps destination (x,y) coordinates to source coordinates.
+@param dest: The destination image to write the results to with shape (dest height, dest width, channels)
+@param dest_shape: The shape of the destination image in format (height, width)
+@param dest_strides: The strides in bytes of the destination image in format (row, column)
+@param channels: The number of channels of each pixel, 1 for grayscale, 3 for RGB or 4 for RGBA.
+@param interpolation: One of the INTERPOLATION_ constants.
+    INTERPOLATION_NEAREST copies the source pixel the coordinate falls in.
+    INTERPOLATION_BILINEAR blends the 2x2 source pixels nearest the center of the destination pixel.
+    INTERPOLATION_BICUBIC fits a cubic through the 4x4 source pixels nearest the center of the destination pixel.
+@param row_start: The first row of the destination image to write.
+@param row_end: The row of the destination image to stop at (exclusive).
 */
-void affine_transform(unsigned char *img, size_t *img_shape, size_t *img_strides, float *inv_transform, unsigned char *dest, size_t *dest_shape, size_t *dest_strides)
+void affine_transform(const unsigned char *restrict img, size_t *img_shape, long *img_strides, float *inv_transform,
+                      unsigned char *restrict dest, size_t *dest_shape, long *dest_strides, int channels, int interpolation,
+                      size_t row_start, size_t row_end)
 {
     // cache the source image dimensions and strides
     size_t img_height = img_shape[0];
     size_t img_width = img_shape[1];
-    size_t s0 = img_strides[0];
-    size_t s1 = img_strides[1];
+    long s0 = img_strides[0];
+    long s1 = img_strides[1];
 
     // cache the destination image dimensions and strides
-    size_t dest_height = dest_shape[0];
     size_t dest_width = dest_shape[1];
-    size_t ds0 = dest_strides[0];
-    size_t ds1 = dest_strides[1];
+    long ds0 = dest_strides[0];
+    long ds1 = dest_strides[1];
+
+    // moving one column to the right in the destination moves by a constant step in the source.
+    int64_t step_x = (int64_t)((double)inv_transform[0] * FIXED_ONE);
+    int64_t step_y = (int64_t)((double)inv_transform[3] * FIXED_ONE);
 
-    // x and y scale
-    float sx = inv_transform[0];
-    float sy = inv_transform[4];
-    // x and y shear
-    float shx = inv_transform[1];
-    float shy = inv_transform[3];
-    // x and y offset
-    float tx = inv_transform[2];
-    float ty = inv_transform[5];
+    // nearest maps the corner of each destination pixel and reads the pixel it lands in. interpolation maps the center
+    // of each destination pixel and measures the position relative to the centers of the source pixels.
+    double center = interpolation == INTERPOLATION_NEAREST ? 0 : 0.5;
+    int64_t shift = interpolation == INTERPOLATION_NEAREST ? 0 : FIXED_HALF;
 
-    size_t x1, y1, x, y;
+    // samples must land inside the source to be written, and must be this far inside for every neighbour to be inside.
+    int64_t margin_lo = interpolation == INTERPOLATION_BICUBIC ? FIXED_ONE : 0;
+    int64_t margin_hi = interpolation == INTERPOLATION_NEAREST ? 0 : (interpolation == INTERPOLATION_BICUBIC ? 2 * FIXED_ONE : FIXED_ONE);
 
-    // iterate each pixel in the destination image.
-    for (y1 = 0; y1 < dest_height; y1++)
+    int16_t table[WEIGHT_ONE * 4];
+    if (interpolation == INTERPOLATION_BICUBIC)
     {
-        for (x1 = 0; x1 < dest_width; x1++)
+        build_bicubic_table(table);
+    }
+
+    size_t y1;
+    int64_t x1, first, last, inner_first, inner_last, x, y;
+    unsigned char *out;
+
+    for (y1 = row_start; y1 < row_end; y1++)
+    {
+        // the source coordinate of the first pixel of the row.
+        x = (int64_t)(((double)inv_transform[1] * (y1 + center) + inv_transform[0] * center + inv_transform[2]) * FIXED_ONE) + FIXED_NUDGE - shift;
+        y = (int64_t)(((double)inv_transform[4] * (y1 + center) + inv_transform[3] * center + inv_transform[5]) * FIXED_ONE) + FIXED_NUDGE - shift;
+
+        // find the columns of this row which land inside of the source image, every other column is cleared.
+        first = 0;
+        last = (int64_t)dest_width;
+        clip_span(x, step_x, -shift, (int64_t)img_width * FIXED_ONE - shift, &first, &last);
+        clip_span(y, step_y, -shift, (int64_t)img_height * FIXED_ONE - shift, &first, &last);
+        if (last <= first)
+        {
+            first = last = (int64_t)dest_width;
+        }
+
+        // then the columns far enough inside that every neighbour can be read without checking the bounds.
+        inner_first = first;
+        inner_last = last;
+        clip_span(x, step_x, margin_lo, (int64_t)img_width * FIXED_ONE - margin_hi, &inner_first, &inner_last);
+        clip_span(y, step_y, margin_lo, (int64_t)img_height * FIXED_ONE - margin_hi, &inner_first, &inner_last);
+        if (inner_last <= inner_first)
+        {
+            inner_first = inner_last = last;
+        }
+
+        out = dest + ds0 * y1;
+        clear_columns(out, ds1, channels, 0, first);
+        clear_columns(out, ds1, channels, last, (int64_t)dest_width);
+
+        for (x1 = first; x1 < inner_first; x1++)
+        {
+            sample_clamped(img, img_shape, s0, s1, channels, interpolation, table, x + x1 * step_x, y + x1 * step_y, out + ds1 * x1);
+        }
+        for (x1 = inner_last; x1 < last; x1++)
+        {
+            sample_clamped(img, img_shape, s0, s1, channels, interpolation, table, x + x1 * step_x, y + x1 * step_y, out + ds1 * x1);
+        }
+
+        // step from the start of the row to the first inner column, then sample the rest without any bounds checks.
+        x += inner_first * step_x;
+        y += inner_first * step_y;
+        out += ds1 * inner_first;
+        switch (channels)
+        {
+        case 1:
+            sample_span(img, s0, s1, interpolation, table, x, y, step_x, step_y, out, ds1, inner_last - inner_first, 1);
+            break;
+        case 4:
+            sample_span(img, s0, s1, interpolation, table, x, y, step_x, step_y, out, ds1, inner_last - inner_first, 4);
+            break;
+        default:
+            sample_span(img, s0, s1, interpolation, table, x, y, step_x, step_y, out, ds1, inner_last - inner_first, 3);
+        }
+    }
+}
+
+/*
+Interpolates count values of the packed rows into the row buffer, every value uses the same weights.
+Always inlined with a constant number of taps, so the loop is vectorized for each.
+ */
+static inline __attribute__((always_inline)) void blend_rows(const unsigned char *const *rows, const int *wy, const int taps,
+                                                             int16_t *restrict row_buffer, size_t count)
+{
+    const unsigned char *restrict r0 = rows[0], *restrict r1 = rows[1], *restrict r2 = rows[2], *restrict r3 = rows[3];
+    size_t k = 0;
+    int acc;
+
+#if defined(__SSE2__)
+    // interleave the bytes of a pair of rows so each pmaddwd weights both rows of four values at once.
+    __m128i zero = _mm_setzero_si128(), w01 = weight_pair(wy[0], wy[1]), w23 = weight_pair(wy[2], wy[3]);
+    __m128i a, b, lo, hi, s0, s1, s2, s3;
+    for (; k + 16 <= count; k += 16)
+    {
+        a = _mm_loadu_si128((const __m128i *)(r0 + k));
+        b = _mm_loadu_si128((const __m128i *)(r1 + k));
+        lo = _mm_unpacklo_epi8(a, b);
+        hi = _mm_unpackhi_epi8(a, b);
+        s0 = _mm_madd_epi16(_mm_unpacklo_epi8(lo, zero), w01);
+        s1 = _mm_madd_epi16(_mm_unpackhi_epi8(lo, zero), w01);
+        s2 = _mm_madd_epi16(_mm_unpacklo_epi8(hi, zero), w01);
+        s3 = _mm_madd_epi16(_mm_unpackhi_epi8(hi, zero), w01);
+        if (taps == 4)
+        {
+            a = _mm_loadu_si128((const __m128i *)(r2 + k));
+            b = _mm_loadu_si128((const __m128i *)(r3 + k));
+            lo = _mm_unpacklo_epi8(a, b);
+            hi = _mm_unpackhi_epi8(a, b);
+            s0 = _mm_add_epi32(s0, _mm_madd_epi16(_mm_unpacklo_epi8(lo, zero), w23));
+            s1 = _mm_add_epi32(s1, _mm_madd_epi16(_mm_unpackhi_epi8(lo, zero), w23));
+            s2 = _mm_add_epi32(s2, _mm_madd_epi16(_mm_unpacklo_epi8(hi, zero), w23));
+            s3 = _mm_add_epi32(s3, _mm_madd_epi16(_mm_unpackhi_epi8(hi, zero), w23));
+        }
+        _mm_storeu_si128((__m128i *)(row_buffer + k), _mm_packs_epi32(to_rows(s0), to_rows(s1)));
+        _mm_storeu_si128((__m128i *)(row_buffer + k + 8), _mm_packs_epi32(to_rows(s2), to_rows(s3)));
+    }
+#endif
+    for (; k < count; k++)
+    {
+        acc = r0[k] * wy[0] + r1[k] * wy[1];
+        if (taps == 4)
         {
-            // calculate the location of the source pixel by applying the inverse transformation matrix.
-            // since x and y are integer types this will have the effect of simple rounding to the nearest neighbor.
-            x = x1 * sx + y1 * shx + tx;
-            y = x1 * shy + y1 * sy + ty;
+            acc += r2[k] * wy[2] + r3[k] * wy[3];
+        }
+        row_buffer[k] = to_row(acc);
+    }
+}
 
-            // skip any locations which fall outside of the source image.
-            if ((x < 0 || x >= img_width) || (y < 0 || y >= img_height))
+/*
+Writes the destination columns [first, last) of a row by applying the weights of each column to the row buffer.
+Always inlined with a constant number of taps and channels, so the loops over the taps and channels are unrolled.
+
+@param col_taps: The first column of the row buffer each destination column reads, the rest of its taps follow it.
+@param col_weights: The weights of each destination column, taps values per column.
+ */
+static inline __attribute__((always_inline)) void interpolate_columns(const int16_t *restrict row_buffer, const int *restrict col_taps,
+                                                                      const int16_t *restrict col_weights, const int taps, const int channels,
+                                                                      unsigned char *restrict out, long ds1, int64_t first, int64_t last)
+{
+    const int16_t *tap, *w;
+    int64_t x1 = first;
+    int i, c, acc;
+
+    out += ds1 * first;
+#if defined(__SSE2__)
+    if (channels > 1)
+    {
+        // each pixel is interpolated in the lanes of one vector, a pair of taps per pmaddwd.
+        __m128i sums;
+        for (; x1 < last; x1++)
+        {
+            tap = row_buffer + channels * col_taps[x1];
+            w = col_weights + taps * x1;
+            sums = _mm_madd_epi16(_mm_unpacklo_epi16(_mm_loadl_epi64((const __m128i *)tap),
+                                                     _mm_loadl_epi64((const __m128i *)(tap + channels))),
+                                  load_weight_pair(w));
+            if (taps == 4)
             {
-                continue;
+                sums = _mm_add_epi32(sums, _mm_madd_epi16(_mm_unpacklo_epi16(_mm_loadl_epi64((const __m128i *)(tap + 2 * channels)),
+                                                                             _mm_loadl_epi64((const __m128i *)(tap + 3 * channels))),
+                                                          load_weight_pair(w + 2)));
             }
+            store_pixel(out, sums, channels);
+            out += ds1;
+        }
+    }
+    else
+    {
+        // grayscale pixels are interpolated four at a time, the taps of each column are adjacent in the row buffer.
+        __m128i sums, values, odd;
+        uint32_t t0, t1, t2, t3;
+        for (; x1 + 4 <= last; x1 += 4)
+        {
+            w = col_weights + taps * x1;
+            if (taps == 4)
+            {
+                sums = _mm_madd_epi16(_mm_unpacklo_epi64(_mm_loadl_epi64((const __m128i *)(row_buffer + col_taps[x1])),
+                                                         _mm_loadl_epi64((const __m128i *)(row_buffer + col_taps[x1 + 1]))),
+                                      _mm_loadu_si128((const __m128i *)w));
+                odd = _mm_madd_epi16(_mm_unpacklo_epi64(_mm_loadl_epi64((const __m128i *)(row_buffer + col_taps[x1 + 2])),
+                                                        _mm_loadl_epi64((const __m128i *)(row_buffer + col_taps[x1 + 3]))),
+                                     _mm_loadu_si128((const __m128i *)(w + 8)));
+                // add the pairs of sums belonging to the same column.
+                sums = _mm_add_epi32(_mm_castps_si128(_mm_shuffle_ps(_mm_castsi128_ps(sums), _mm_castsi128_ps(odd), _MM_SHUFFLE(2, 0, 2, 0))),
+                                     _mm_castps_si128(_mm_shuffle_ps(_mm_castsi128_ps(sums), _mm_castsi128_ps(odd), _MM_SHUFFLE(3, 1, 3, 1))));
+            }
+            else
+            {
+                memcpy(&t0, row_buffer + col_taps[x1], 4);
+                memcpy(&t1, row_buffer + col_taps[x1 + 1], 4);
+                memcpy(&t2, row_buffer + col_taps[x1 + 2], 4);
+                memcpy(&t3, row_buffer + col_taps[x1 + 3], 4);
+                sums = _mm_madd_epi16(_mm_setr_epi32((int)t0, (int)t1, (int)t2, (int)t3), _mm_loadu_si128((const __m128i *)w));
+            }
+            values = _mm_srai_epi32(_mm_add_epi32(sums, _mm_set1_epi32(COLUMN_ROUND)), COLUMN_SHIFT);
+            values = _mm_packs_epi32(values, values);
+            t0 = (uint32_t)_mm_cvtsi128_si32(_mm_packus_epi16(values, values));
+            for (i = 0; i < 4; i++)
+            {
+                out[ds1 * i] = (unsigned char)(t0 >> (8 * i));
+            }
+            out += 4 * ds1;
+        }
+    }
+#endif
+    for (; x1 < last; x1++)
+    {
+        tap = row_buffer + channels * col_taps[x1];
+        w = col_weights + taps * x1;
+        for (c = 0; c < channels; c++)
+        {
+            acc = 0;
+            for (i = 0; i < taps; i++)
+            {
+                acc += tap[channels * i + c] * w[i];
+            }
+            out[c] = to_channel(acc);
+        }
+        out += ds1;
+    }
+}
+
+/*
+Calls interpolate_columns with the number of channels as a constant, so it is specialized for each supported count.
+ */
+static inline __attribute__((always_inline)) void interpolate_channels(const int16_t *restrict row_buffer, const int *restrict col_taps,
+                                                                       const int16_t *restrict col_weights, const int taps, int channels,
+                                                                       unsigned char *restrict out, long ds1, int64_t first, int64_t last)
+{
+    switch (channels)
+    {
+    case 1:
+        interpolate_columns(row_buffer, col_taps, col_weights, taps, 1, out, ds1, first, last);
+        break;
+    case 4:
+        interpolate_columns(row_buffer, col_taps, col_weights, taps, 4, out, ds1, first, last);
+        break;
+    default:
+        interpolate_columns(row_buffer, col_taps, col_weights, taps, 3, out, ds1, first, last);
+    }
+}
+
+/*
+Interpolates the destination image from the source image with a transformation which only scales, flips and translates.
+Each destination column samples the same source columns with the same weights on every row, so those are calculated once
+and each row is interpolated in two cheap passes, first between source rows then between source columns.
+Destination pixels which map outside of the source image are set to zero.
+
+@param img: The source image with shape (height, width, channels), may have any strides.
+@param img_shape: The shape of the source image in format (height, width)
+@param img_strides: The strides in bytes of the source image in format (row, column)
+@param inv_transform: A contigious 3x3 matrix in row major order which maps destination (x,y) coordinates to source coordinates,
+    the shear elements must be zero.
+@param dest: The destination image to write the results to with shape (dest height, dest width, channels)
+@param dest_shape: The shape of the destination image in format (height, width)
+@param dest_strides: The strides in bytes of the destination image in format (row, column)
+@param channels: The number of channels of each pixel, 1 for grayscale, 3 for RGB or 4 for RGBA.
+@param interpolation: INTERPOLATION_BILINEAR or INTERPOLATION_BICUBIC.
+@param col_taps: Buffer with dest width elements which receives the first source column each destination column reads.
+@param col_weights: Buffer with shape (dest width, 4) which receives the weights of the source columns each destination column reads.
+@param row_buffer: Buffer with shape (width + PAD_BEFORE + PAD_AFTER, channels) which receives a row interpolated between
+    source rows, with room for the edge pixels repeated either side.
+@param row_start: The first row of the destination image to write.
+@param row_end: The row of the destination image to stop at (exclusive).
+*/
+void affine_resample_axis(const unsigned char *restrict img, size_t *img_shape, long *img_strides, float *inv_transform,
+                          unsigned char *restrict dest, size_t *dest_shape, long *dest_strides, int channels, int interpolation,
+                          int *restrict col_taps, int16_t *restrict col_weights, int16_t *restrict row_buffer,
+                          size_t row_start, size_t row_end)
+{
+    size_t img_height = img_shape[0];
+    size_t img_width = img_shape[1];
+    long s0 = img_strides[0];
+    long s1 = img_strides[1];
+    size_t dest_width = dest_shape[1];
+    long ds0 = dest_strides[0];
+    long ds1 = dest_strides[1];
+
+    int16_t table[WEIGHT_ONE * 4];
+    int weights[4], wy[4] = {0}, taps = 0, i, j, c, acc;
+    long tap_first = 0, tap_last = 0, lo, hi, col;
+    int64_t x1, first, last, x, y;
+    size_t y1, k;
+    const unsigned char *rows[4] = {NULL};
+    unsigned char *out;
+
+    if (interpolation == INTERPOLATION_BICUBIC)
+    {
+        build_bicubic_table(table);
+    }
+
+    // map the center of each destination pixel, relative to the centers of the source pixels.
+    int64_t step_x = (int64_t)((double)inv_transform[0] * FIXED_ONE);
+    int64_t start_x = (int64_t)(((double)inv_transform[0] * 0.5 + inv_transform[2]) * FIXED_ONE) + FIXED_NUDGE - FIXED_HALF;
+
+    // the same columns land inside the source on every row.
+    first = 0;
+    last = (int64_t)dest_width;
+    clip_span(start_x, step_x, -FIXED_HALF, (int64_t)img_width * FIXED_ONE - FIXED_HALF, &first, &last);
+    if (last <= first)
+    {
+        first = last = (int64_t)dest_width;
+    }
+
+    // calculate the first source column each destination column reads and the weights of its taps. taps before the
+    // first column or after the last read the edge pixels repeated in the padding of the row buffer.
+    row_buffer += PAD_BEFORE * channels;
+    for (x1 = first; x1 < last; x1++)
+    {
+        x = start_x + x1 * step_x;
+        taps = phase_weights(interpolation, table, phase_of(x), weights);
+        col = (long)(x >> FIXED_SHIFT) - (taps == 4);
+        col_taps[x1] = (int)col;
+        for (i = 0; i < taps; i++)
+        {
+            col_weights[x1 * taps + i] = (int16_t)weights[i];
+        }
+        // track the range of source columns read, only those need interpolating between rows.
+        if (x1 == first || col < tap_first)
+        {
+            tap_first = col;
+        }
+        if (x1 == first || col + taps - 1 > tap_last)
+        {
+            tap_last = col + taps - 1;
+        }
+    }
+    lo = tap_first < 0 ? 0 : tap_first;
+    hi = tap_last >= (long)img_width ? (long)img_width - 1 : tap_last;
+
+    for (y1 = row_start; y1 < row_end; y1++)
+    {
+        out = dest + ds0 * y1;
+        y = (int64_t)(((double)inv_transform[4] * (y1 + 0.5) + inv_transform[5]) * FIXED_ONE) + FIXED_NUDGE - FIXED_HALF;
+
+        // rows which land outside of the source are cleared entirely.
+        if (first == last || y < -FIXED_HALF || y >= (int64_t)img_height * FIXED_ONE - FIXED_HALF)
+        {
+            clear_columns(out, ds1, channels, 0, (int64_t)dest_width);
+            continue;
+        }
+        clear_columns(out, ds1, channels, 0, first);
+        clear_columns(out, ds1, channels, last, (int64_t)dest_width);
+
+        // interpolate between the source rows, every channel of every column uses the same weights.
+        taps = phase_weights(interpolation, table, phase_of(y), wy);
+        for (j = 0; j < taps; j++)
+        {
+            rows[j] = img + s0 * clamp_index((y >> FIXED_SHIFT) - (taps == 4) + j, img_height) + s1 * lo;
+        }
+        if (s1 == channels)
+        {
+            // the pixels are packed, so treat the row as one long run of values.
+            if (taps == 4)
+            {
+                blend_rows(rows, wy, 4, row_buffer + lo * channels, (hi - lo + 1) * channels);
+            }
+            else
+            {
+                blend_rows(rows, wy, 2, row_buffer + lo * channels, (hi - lo + 1) * channels);
+            }
+        }
+        else
+        {
+            for (k = 0; k <= (size_t)(hi - lo); k++)
+            {
+                for (c = 0; c < channels; c++)
+                {
+                    acc = 0;
+                    for (j = 0; j < taps; j++)
+                    {
+                        acc += rows[j][s1 * k + c] * wy[j];
+                    }
+                    row_buffer[(lo + k) * channels + c] = to_row(acc);
+                }
+            }
+        }
+        // repeat the edge pixels for the taps which fall outside of the source.
+        for (col = tap_first; col < lo; col++)
+        {
+            memcpy(row_buffer + col * channels, row_buffer + lo * channels, channels * sizeof(int16_t));
+        }
+        for (col = hi + 1; col <= tap_last; col++)
+        {
+            memcpy(row_buffer + col * channels, row_buffer + hi * channels, channels * sizeof(int16_t));
+        }
 
-            // copy the source pixel to the destination pixel.
-            memcpy(dest + ds0 * y1 + ds1 * x1, img + s0 * y + s1 * x, PIXEL_SIZE);
+        // then interpolate between the source columns.
+        if (taps == 4)
+        {
+            interpolate_channels(row_buffer, col_taps, col_weights, 4, channels, out, ds1, first, last);
+        }
+        else
+        {
+            interpolate_channels(row_buffer, col_taps, col_weights, 2, channels, out, ds1, first, last);
         }
     }
-}
\ No newline at end of file
+}
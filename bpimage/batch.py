@@ -0,0 +1,201 @@
+"""Batch CLI for bpimage library.
+Applies the same operations to many images, spreading the files across a pool of worker processes.
+The operations are parsed and optimized once, each worker then opens, processes and saves one file at a time
+so decoding, processing and encoding of different files overlap.
+"""
+import glob
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Callable
+from PIL import Image
+import buffers
+import io_utils
+import main
+import parallel
+import pipeline
+
+# the number of files queued for each worker, keeps every worker busy without queueing the whole batch at once.
+FILES_PER_WORKER = 4
+
+# the result cache of each worker process, opened by _init_worker.
+_result_cache = None
+
+# the buffer pool of each worker process, so images of the same size reuse the memory of the previous file.
+_pool = None
+
+
+def _get_cli_args():
+    parser = ArgumentParser(description='Batch CLI for bpimage library. Applies the same edits to many images.')
+    parser.add_argument('sources', nargs='+',
+                        help='source image files, directories of images or glob patterns such as "photos/**/*.jpg"')
+    parser.add_argument('-o', '--out-dir', type=Path,
+                        help='directory the processed images are saved in, created if it does not exist (default: current directory)')
+    parser.add_argument('-n', '--name', default='{stem}{suffix}', metavar='template',
+                        help='template for the name of each processed image. {stem}, {suffix}, {name} and {index} are replaced with '
+                             'the file name without extension, the extension, the full file name and the position of the source (default:%(default)s)')
+    parser.add_argument('-w', '--workers', type=main.positive_int, default=os.cpu_count() or 1, metavar='count',
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('-t', '--threads', type=main.positive_int, default=1, metavar='count',
+                        help='number of threads each worker uses to process an image (default:%(default)s)')
+    main.add_cache_arguments(parser)
+    main.add_operation_arguments(parser)
+
+    # if no args provided, output the help message
+    if len(sys.argv) < 2:
+        parser.print_help(sys.stderr)
+        exit(1)
+
+    args = parser.parse_args()
+    if args.out_dir is None and args.name == parser.get_default('name'):
+        parser.error('one of the arguments -o/--out-dir -n/--name is required, otherwise the sources would be overwritten')
+    return args
+
+
+def _expand_sources(patterns: list[str]) -> list[Path]:
+    """Returns every file matched by the patterns in order, expanding globs and directories and skipping duplicates.
+    Directories contribute the files inside them which have the extension of a supported image format.
+    """
+    extensions = set(Image.registered_extensions()) | {io_utils.RAW_EXTENSION}
+    sources = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for match in map(Path, matches):
+            if match.is_dir():
+                sources.update(dict.fromkeys(sorted(path for path in match.iterdir()
+                                                    if path.is_file() and path.suffix.lower() in extensions)))
+            else:
+                sources[match] = None
+    return list(sources)
+
+
+def _dest_paths(sources: list[Path], out_dir: Path, template: str) -> list[Path]:
+    """Returns the path each source is saved to.
+
+    Raises:
+        ValueError: the template was invalid, named the same destination twice or would overwrite a source.
+    """
+    out_dir = out_dir or Path('.')
+    try:
+        dests = [out_dir / template.format(stem=source.stem, suffix=source.suffix, name=source.name, index=index)
+                 for index, source in enumerate(sources)]
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f'Invalid name template \'{template}\': {e}') from e
+
+    resolved = [dest.resolve() for dest in dests]
+    if len(set(resolved)) != len(resolved):
+        raise ValueError(f'Name template \'{template}\' gives more than one source the same destination.')
+    if set(resolved) & {source.resolve() for source in sources}:
+        raise ValueError(f'Name template \'{template}\' would overwrite a source image.')
+    return dests
+
+
+def _init_worker(args):
+    """Configures each worker process before it receives any files.
+    """
+    global _result_cache, _pool
+    parallel.set_threads(args.threads)
+    _result_cache = main._get_cache(args)
+    _pool = buffers.BufferPool()
+
+
+def _process_file(source: Path, dest: Path, ops: list[tuple[Callable, list]]) -> tuple[int, bool, str | None]:
+    """Applies the optimized operations to one file.
+    Returns the size of the source in bytes, whether the result came from the cache
+    and the error message if the file could not be processed.
+    """
+    try:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if _result_cache is not None:
+            data = io_utils.read(source)
+            result, cached = _result_cache.get_or_compute(
+                _result_cache.key(data, ops, dest.suffix),
+                lambda: _finish(pipeline.apply(_decode(data, source), ops, _pool), io_utils.encode, dest.suffix))
+            io_utils.write(result, dest)
+            return len(data), cached, None
+        _finish(pipeline.apply(io_utils.open(source), ops, _pool), io_utils.save, dest)
+        return source.stat().st_size, False, None
+    except (io_utils.ImageOpenError, io_utils.ImageSaveError) as e:
+        return 0, False, str(e)
+    except Exception as e:
+        return 0, False, f'Unexpected error processing \'{source}\': {str(e)}'
+
+
+def _finish(img, output: Callable, *args):
+    """Saves or encodes the result then gives its memory back to the pool.
+    """
+    try:
+        return output(img, *args)
+    finally:
+        _pool.release(img)
+
+
+def _decode(data: bytes, source: Path):
+    """Decodes the contents of a source file, naming the file in the error.
+    """
+    try:
+        return io_utils.decode(data)
+    except io_utils.ImageOpenError as e:
+        raise io_utils.ImageOpenError(f'Cannot open \'{source}\': {str(e)}') from e
+
+
+def _process_batch(args):
+    sources = _expand_sources(args.sources)
+    if not sources:
+        return 'No source images found.'
+    try:
+        dests = _dest_paths(sources, args.out_dir, args.name)
+    except ValueError as e:
+        return str(e)
+
+    # the operations are the same for every file, so optimize them once rather than in each worker.
+    ops = pipeline.optimize(main._get_ops(args), unclamped=args.fast)
+
+    processed = failed = cached = total_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(args,)) as executor:
+        pending = set()
+        queued = iter(zip(sources, dests))
+        while True:
+            # keep a bounded number of files queued so the batch can be any size.
+            for source, dest in queued:
+                pending.add(executor.submit(_process_file, source, dest, ops))
+                if len(pending) >= args.workers * FILES_PER_WORKER:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                size, hit, error = future.result()
+                if error is not None:
+                    failed += 1
+                    print(error, file=sys.stderr)
+                else:
+                    processed += 1
+                    cached += hit
+                    total_bytes += size
+
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print(f'processed {processed} of {len(sources)} images in {seconds:.2f}s: '
+          f'{processed / seconds:.2f} images/s, {total_bytes / 1e6 / seconds:.2f} MB/s'
+          + (f', {cached} from the cache' if args.cache else ''))
+    if failed:
+        return f'{failed} of {len(sources)} images failed.'
+
+
+def _main():
+    args = _get_cli_args()
+    return _process_batch(args)
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(_main())
+    except KeyboardInterrupt:
+        sys.exit()
+    except Exception as e:
+        sys.exit(f'Unexpected exception: {str(e)}')
@@ -0,0 +1,54 @@
+#ifndef BORDER_H
+#define BORDER_H
+
+#include <stddef.h>
+
+// Supported strategies for reading pixels which fall outside of the image, match the modes of numpy.pad
+#define BORDER_EDGE 0
+#define BORDER_REFLECT 1
+#define BORDER_WRAP 2
+#define BORDER_CONSTANT 3
+
+/*
+Maps an index which may fall outside of the image to the index of the pixel which should be read instead.
+
+@param index: The index to map, may be negative or past the end.
+@param length: The number of elements which can be indexed.
+@param mode: One of the BORDER_ constants.
+    BORDER_EDGE repeats the nearest edge pixel (aaa|abcd|ddd)
+    BORDER_REFLECT mirrors the image without repeating the edge pixel (dcb|abcd|cba)
+    BORDER_WRAP tiles the image (bcd|abcd|abc)
+    BORDER_CONSTANT treats every outside pixel as zero.
+@returns The index to read, or -1 if the pixel should be treated as zero.
+ */
+static inline long border_index(long index, size_t length, int mode)
+{
+    long len = (long)length;
+    long period;
+
+    if (index >= 0 && index < len)
+    {
+        return index;
+    }
+
+    switch (mode)
+    {
+    case BORDER_REFLECT:
+        if (len == 1)
+        {
+            return 0;
+        }
+        // reflecting repeatedly is periodic, fold into one period then mirror the second half.
+        period = 2 * (len - 1);
+        index = ((index % period) + period) % period;
+        return index < len ? index : period - index;
+    case BORDER_WRAP:
+        return ((index % len) + len) % len;
+    case BORDER_CONSTANT:
+        return -1;
+    default:
+        return index < 0 ? 0 : len - 1;
+    }
+}
+
+#endif
@@ -0,0 +1,112 @@
+#include <stdio.h>
+#include "border.h"
+
+/*
+Returns the value at the index of the array after mapping the index through the border mode.
+@returns The value, or zero if the index falls outside of the image in constant mode.
+ */
+static inline unsigned int border_value(unsigned int *values, long index, size_t length, int mode, size_t channels, size_t c)
+{
+    long i = border_index(index, length, mode);
+    return i < 0 ? 0 : values[i * channels + c];
+}
+
+/*
+Blurs each pixel by averaging all surrounding pixels extending radius pixels in each direction and writes the result to the destination image.
+Uses running sums so the cost per pixel does not depend on the radius.
+A vertical running sum is kept for each column, each output row is then produced by sliding a window across those column sums.
+Pixels outside of the image are read according to the border mode.
+
+@param img: The source image.
+Expected to have shape of (img height, img width, channels).
+Expected to be in contigious row major layout.
+
+@param dest: The destination image to write the results to. Must not overlap with img.
+Expected to have the same shape as the source image.
+Expected to be in contigious row major layout.
+
+@param col_sums: Scratch memory holding the vertical running sum of each channel of each column.
+Expected to have shape of (img width * channels).
+
+@param shape: The shape of the image in format (height, width)
+@param channels: The number of channels of each pixel, 1 for grayscale, 3 for RGB or 4 for RGBA.
+@param radius: The number of pixels to take in each direction.
+@param mode: One of the BORDER_ constants defined in border.h
+*/
+void box_blur(unsigned char *img, unsigned char *dest, unsigned int *col_sums, size_t *shape, size_t channels, size_t radius, int mode)
+{
+    // cache shapes
+    size_t height = shape[0];
+    size_t width = shape[1];
+    size_t row_len = width * channels;
+
+    // every pixel is the average of a (2r+1)x(2r+1) window, round to nearest instead of truncating.
+    size_t size = radius * 2 + 1;
+    size_t area = size * size;
+    size_t half_area = area / 2;
+
+    long r = (long)radius;
+    long y, x, k, add_index, sub_index;
+    size_t i, c, sum;
+    unsigned char *add_row, *sub_row, *dest_row;
+
+    // initialize the column sums with the window centered on the first row.
+    for (i = 0; i < row_len; i++)
+    {
+        col_sums[i] = 0;
+    }
+    for (k = -r; k <= r; k++)
+    {
+        // rows outside of the image in constant mode are zero and contribute nothing.
+        if ((add_index = border_index(k, height, mode)) < 0)
+        {
+            continue;
+        }
+        add_row = img + add_index * row_len;
+        for (i = 0; i < row_len; i++)
+        {
+            col_sums[i] += add_row[i];
+        }
+    }
+
+    for (y = 0; y < (long)height; y++)
+    {
+        dest_row = dest + y * row_len;
+
+        // slide a window across the column sums, one running sum per channel.
+        for (c = 0; c < channels; c++)
+        {
+            sum = 0;
+            for (k = -r; k <= r; k++)
+            {
+                sum += border_value(col_sums, k, width, mode, channels, c);
+            }
+
+            for (x = 0; x < (long)width; x++)
+            {
+                dest_row[x * channels + c] = (sum + half_area) / area;
+
+                sum += border_value(col_sums, x + r + 1, width, mode, channels, c);
+                sum -= border_value(col_sums, x - r, width, mode, channels, c);
+            }
+        }
+
+        // move the vertical window down a row by adding the next row and removing the oldest.
+        if ((add_index = border_index(y + r + 1, height, mode)) >= 0)
+        {
+            add_row = img + add_index * row_len;
+            for (i = 0; i < row_len; i++)
+            {
+                col_sums[i] += add_row[i];
+            }
+        }
+        if ((sub_index = border_index(y - r, height, mode)) >= 0)
+        {
+            sub_row = img + sub_index * row_len;
+            for (i = 0; i < row_len; i++)
+            {
+                col_sums[i] -= sub_row[i];
+            }
+        }
+    }
+}
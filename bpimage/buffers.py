@@ -0,0 +1,148 @@
+"""Reusable memory for images and scratch space.
+Operations allocate their results and scratch space with empty, which takes memory from the active BufferPool
+if there is one and otherwise allocates it as usual. Memory given back with release is kept by the pool and handed
+out again for a later request of a similar size, so processing many images of the same size in a long running
+process stops allocating once the pool holds a buffer of each size the operations need.
+The active pool is held in a context variable, so each thread, and each band run by parallel.run_bands on behalf
+of a thread, sees the pool that thread activated.
+"""
+import contextvars
+import threading
+import weakref
+import numpy as np
+
+# default limit on the memory a pool keeps for reuse, buffers released past it are freed instead.
+DEFAULT_MAX_BYTES = 1024 * 2**20
+
+# requests are rounded up to a power of two no smaller than this, so similar sizes share buffers.
+MIN_BUCKET_BYTES = 4096
+
+# the active pool of the current context, None while no pool is active.
+_pool = contextvars.ContextVar('bpimage_buffer_pool', default=None)
+
+
+class BufferPool:
+    """Keeps released buffers for reuse, grouped into buckets by size rounded up to a power of two.
+    Use as a context manager to make it the pool empty takes memory from on the current thread.
+    The pool may be shared between threads, each thread activating it with its own with block.
+
+    Rounding up wastes little memory in practice, the pages of a buffer beyond the size requested are never touched
+    so the operating system never backs them with physical memory.
+
+    Example:
+        pool = BufferPool()
+        for path in paths:
+            result = pipeline.Pipeline(io_utils.open(path)).gaussian(3, 1.5).scale(0.5).compute(pool=pool)
+            io_utils.save(result, dest)
+            pool.release(result)
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            max_bytes: The most memory the pool keeps for reuse.
+        """
+        self.max_bytes = max_bytes
+        self.allocations = 0
+        self.reuses = 0
+        self._free = {}
+        self._free_bytes = 0
+        # buffers handed out and not yet released, held weakly so a buffer which is never released is freed as usual.
+        self._outstanding = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        # tokens restoring the previously active pool, kept per thread since each thread enters the pool separately.
+        self._tokens = threading.local()
+
+    def __enter__(self) -> 'BufferPool':
+        if not hasattr(self._tokens, 'stack'):
+            self._tokens.stack = []
+        self._tokens.stack.append(_pool.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        _pool.reset(self._tokens.stack.pop())
+
+    def empty(self, shape: tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """Returns an uninitialized C contiguous array, reusing a released buffer of the same bucket if there is one.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        bucket = _bucket(nbytes)
+        with self._lock:
+            free = self._free.get(bucket)
+            if free:
+                buffer = free.pop()
+                self._free_bytes -= buffer.nbytes
+                self.reuses += 1
+            else:
+                buffer = None
+                self.allocations += 1
+        if buffer is None:
+            buffer = np.empty(bucket, dtype=np.uint8)
+        with self._lock:
+            self._outstanding[id(buffer)] = buffer
+        return buffer[:nbytes].view(dtype).reshape(shape)
+
+    def release(self, *arrays: np.ndarray):
+        """Gives buffers back to the pool. Arrays which were not taken from the pool are ignored.
+        The arrays, and any views of them, must not be used afterwards.
+        """
+        for array in arrays:
+            buffer = _root(array)
+            with self._lock:
+                if self._outstanding.pop(id(buffer), None) is None:
+                    continue
+                if self._free_bytes + buffer.nbytes > self.max_bytes:
+                    continue
+                self._free.setdefault(buffer.nbytes, []).append(buffer)
+                self._free_bytes += buffer.nbytes
+
+    def owns(self, array: np.ndarray) -> bool:
+        """Returns true if the array is a buffer, or a view of a buffer, taken from the pool and not yet released.
+        """
+        with self._lock:
+            return id(_root(array)) in self._outstanding
+
+    def clear(self):
+        """Frees every buffer kept for reuse.
+        """
+        with self._lock:
+            self._free.clear()
+            self._free_bytes = 0
+
+
+def empty(shape: tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+    """Returns an uninitialized C contiguous array, taken from the active pool if there is one.
+    """
+    pool = _pool.get()
+    if pool is None:
+        return np.empty(shape, dtype=dtype)
+    return pool.empty(shape, dtype)
+
+
+def release(*arrays: np.ndarray):
+    """Gives arrays taken with empty back to the active pool, does nothing if there is no active pool.
+    """
+    pool = _pool.get()
+    if pool is not None:
+        pool.release(*arrays)
+
+
+def active() -> BufferPool | None:
+    """Returns the active pool of the current thread, or None if there is no active pool.
+    """
+    return _pool.get()
+
+
+def _bucket(nbytes: int) -> int:
+    """Returns the size of the buffers which hold a request of the given size.
+    """
+    return max(MIN_BUCKET_BYTES, 1 << (max(nbytes, 1) - 1).bit_length())
+
+
+def _root(array: np.ndarray) -> np.ndarray:
+    """Returns the array which owns the memory of a view.
+    """
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
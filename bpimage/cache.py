@@ -0,0 +1,216 @@
+"""On-disk cache of encoded results.
+Identical requests, the same source with the same edits saved in the same format, are answered with the stored file
+instead of decoding, processing and encoding the image again.
+
+Entries are named by a hash of the source bytes, the optimized operations and a fingerprint of the library,
+so a rebuilt library never returns results computed by an older one. Entries are written to a temporary file and
+renamed into place, so workers sharing a cache directory never read a partial entry. Once the entries exceed the
+size cap the least recently used are removed.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from functools import cache
+from pathlib import Path
+from typing import Callable
+import clib
+
+# default size cap of a cache directory.
+DEFAULT_MAX_BYTES = 1024 * 2**20
+
+# temporary files older than this are left over from a writer which stopped, and are removed by eviction.
+STALE_TEMP_SECONDS = 3600
+
+# suffix of entries which are still being written.
+_TEMP_SUFFIX = '.tmp'
+
+# eviction removes entries until the cache is within this fraction of its cap,
+# so the directory is only listed again once another tenth of the cap has been written.
+_LOW_WATER = 0.9
+
+
+class ResultCache:
+    """Cache of encoded results stored as files in a directory, which may be shared by many processes.
+    The hits and misses are counted for this instance only.
+
+    Each instance keeps a running total of the size of the directory, taken when it last listed the directory plus
+    the entries it has written since, and only lists the directory again once the total passes the cap.
+    Processes sharing a directory don't see each other's writes, so together they may pass the cap by a little
+    until one of them lists it.
+
+    Example:
+        data, hit = ResultCache('cache').get_or_compute(key, lambda: io_utils.encode(process(img), '.jpg'))
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            directory: The directory the entries are stored in, created if it does not exist.
+            max_bytes: The total size the entries are kept within, the least recently used are removed past it.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # size of the directory as far as this instance knows, None until it has been listed.
+        self._bytes = None
+
+    @staticmethod
+    def key(source: bytes, ops: list[tuple[Callable, list]], extension: str) -> str:
+        """Returns the key of a result.
+
+        Args:
+            source: The bytes of the source image file.
+            ops: The optimized operations applied to the source, as returned by pipeline.optimize.
+            extension: The extension of the format the result is encoded in.
+
+        Returns:
+            A hex digest which changes whenever the source, the operations, the format or the library changes.
+        """
+        digest = hashlib.sha256()
+        digest.update(library_version().encode())
+        digest.update(extension.lower().encode())
+        digest.update(_normalize(ops).encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        """Returns the stored result for the key, or None if there is no entry.
+        """
+        path = self.directory / key
+        try:
+            data = path.read_bytes()
+            # the modification time orders entries for eviction, so reading an entry marks it as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Stores the result for the key, then removes the least recently used entries if the cap is exceeded.
+        Results larger than the cap are not stored.
+        """
+        if len(data) > self.max_bytes:
+            return
+        try:
+            replaced = (self.directory / key).stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=_TEMP_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, self.directory / key)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        if self._bytes is not None:
+            self._bytes += len(data) - replaced
+        if self._bytes is None or self._bytes > self.max_bytes:
+            self._evict()
+
+    def get_or_compute(self, key: str, compute: Callable[[], bytes]) -> tuple[bytes, bool]:
+        """Returns the stored result for the key, computing and storing it if there is no entry.
+
+        Args:
+            key: The key of the result, as returned by key.
+            compute: Returns the encoded result, only invoked on a miss.
+
+        Returns:
+            The encoded result and whether it was found in the cache.
+        """
+        data = self.get(key)
+        if data is not None:
+            return data, True
+        data = compute()
+        self.put(key, data)
+        return data, False
+
+    def stats(self) -> dict:
+        """Returns the hits, misses and evictions of this instance along with the current size of the cache.
+        """
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries)}
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        """Returns the modification time, size and path of every entry, removing stale temporary files.
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(_TEMP_SUFFIX):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        os.unlink(entry.path)
+                    continue
+            except FileNotFoundError:
+                # removed by another process.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        return entries
+
+    def _evict(self):
+        """Lists the directory, then if the cache is over its cap removes the least recently used entries
+        until it is within _LOW_WATER of it.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                try:
+                    path.unlink()
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes * _LOW_WATER:
+                    break
+        self._bytes = total
+
+
+@cache
+def library_version() -> str:
+    """Returns a fingerprint of the library, which changes whenever its python modules, the compiled library
+    or the image codecs change.
+    """
+    # imported here rather than with the module, so the CLI can build its parser without loading them.
+    import numpy as np
+    from PIL import Image
+
+    digest = hashlib.sha256(f'pillow {Image.__version__} numpy {np.__version__}'.encode())
+    paths = sorted(Path(__file__).parent.glob('*.py'))
+    # the compiled library holds most of the code a result depends on.
+    try:
+        paths.append(clib.path())
+    except OSError:
+        pass
+    for path in paths:
+        try:
+            digest.update(path.read_bytes())
+        except FileNotFoundError:
+            pass
+    return digest.hexdigest()
+
+
+def _normalize(value) -> str:
+    """Formats operations and their arguments so equal operations always give the same text.
+    Numbers are formatted as floats so 2 and 2.0 match, and arrays by their shape and contents.
+    """
+    if callable(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    if isinstance(value, (list, tuple)):
+        return f'[{",".join(_normalize(item) for item in value)}]'
+    # numpy is already loaded by the operations being normalized, importing it again only looks it up.
+    import numpy as np
+    if isinstance(value, np.ndarray):
+        return f'array({value.dtype},{value.shape},{hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()})'
+    if isinstance(value, (bool, str)) or value is None:
+        return repr(value)
+    return repr(float(value))
@@ -0,0 +1,73 @@
+"""Loads the functions written in c from the compiled library.
+The library is found next to the package rather than relative to the working directory, so the CLI and the library
+work from any directory. Modules declare the signature of each function they use when they are imported, which
+costs nothing. The library is only loaded when the first function is invoked, and each function is configured with
+its signature on first use.
+
+Example:
+    clib.declare('lut_apply', None, [...])
+    clib.lib.lut_apply(img, table, dest, start, end)
+"""
+import ctypes
+import threading
+from pathlib import Path
+
+# file name of the compiled library.
+LIBRARY_NAME = 'bpimage.so'
+
+# directories searched for the library in order, the root of the project where the build instructions
+# compile it, then the package itself.
+SEARCH_PATHS = [Path(__file__).resolve().parent.parent, Path(__file__).resolve().parent]
+
+# the return type and argument types of each declared function.
+_signatures = {}
+
+
+def declare(name: str, restype, argtypes: list):
+    """Records the signature of a c function, which is applied when the function is first used through lib.
+
+    Args:
+        name: The name of the c function.
+        restype: The ctypes return type, None for void.
+        argtypes: The ctypes type of each argument.
+    """
+    _signatures[name] = (restype, argtypes)
+
+
+def path() -> Path:
+    """Returns the path of the compiled library.
+
+    Raises:
+        OSError: The library could not be found, it has not been compiled.
+    """
+    for directory in SEARCH_PATHS:
+        if (candidate := directory / LIBRARY_NAME).is_file():
+            return candidate
+    raise OSError(f'Could not find {LIBRARY_NAME} in {" or ".join(map(str, SEARCH_PATHS))}, '
+                  'compile the c files as described in the README.')
+
+
+class _Library:
+    """The compiled library, loaded when the first function is looked up.
+    Each function is configured with its declared signature then stored as an attribute,
+    so after the first use looking it up is an ordinary attribute access.
+    """
+
+    def __init__(self):
+        self._cdll = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if name not in _signatures:
+            raise AttributeError(f'No c function named \'{name}\' has been declared.')
+        with self._lock:
+            if self._cdll is None:
+                self._cdll = ctypes.CDLL(str(path()))
+            func = getattr(self._cdll, name)
+            func.restype, func.argtypes = _signatures[name]
+            setattr(self, name, func)
+        return func
+
+
+# the functions of the compiled library, each is bound on first use.
+lib = _Library()
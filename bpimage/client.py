@@ -0,0 +1,94 @@
+"""Client for the bpimage server.
+Takes the same arguments as main.py but sends the edits to a running server.py rather than loading the library,
+so each invocation only starts a small python process. Only the standard library is imported.
+"""
+import http.client
+import json
+import socket
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# number of times a job refused by a busy server is retried before giving up.
+DEFAULT_RETRIES = 10
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket.
+    """
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def _get_cli_args():
+    parser = ArgumentParser(description='Client for the bpimage server. Accepts every edit argument of main.py.')
+    parser.add_argument('source', help='source image file path', type=Path)
+    parser.add_argument('-d', '--dest', help='destination image file path', type=Path, required=True)
+    address_group = parser.add_mutually_exclusive_group()
+    address_group.add_argument('--url', default='http://127.0.0.1:8765', help='address of the server (default:%(default)s)')
+    address_group.add_argument('--socket', metavar='path', help='unix domain socket the server listens on')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, metavar='count',
+                        help='times to retry while the server is busy (default:%(default)s)')
+    parser.add_argument('--timeout', type=float, metavar='seconds', help='give up waiting for the server after this long')
+
+    # if no args provided, output the help message
+    if len(sys.argv) < 2:
+        parser.print_help(sys.stderr)
+        exit(1)
+
+    # every other argument is an edit, which the server validates.
+    return parser.parse_known_args()
+
+
+def _connect(args) -> http.client.HTTPConnection:
+    if args.socket:
+        return _UnixHTTPConnection(args.socket, timeout=args.timeout)
+    url = urlsplit(args.url)
+    return http.client.HTTPConnection(url.hostname, url.port, timeout=args.timeout)
+
+
+def _send_job(args, job: dict) -> str | None:
+    """Posts the job, retrying while the server is busy.
+    Returns the error message if the job failed.
+    """
+    body = json.dumps(job).encode()
+    for attempt in range(args.retries + 1):
+        connection = _connect(args)
+        try:
+            connection.request('POST', '/jobs', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        except (OSError, http.client.HTTPException) as e:
+            return f'Could not reach the server: {str(e)}'
+        finally:
+            connection.close()
+
+        if response.status == http.client.SERVICE_UNAVAILABLE and attempt < args.retries:
+            time.sleep(float(response.getheader('Retry-After', 1)))
+            continue
+        if response.status != http.client.OK:
+            return result.get('error', f'Server responded with {response.status}.')
+        return None
+
+
+def _main():
+    args, edits = _get_cli_args()
+    # the server may run in another directory, so send absolute paths.
+    job = {'source': str(args.source.resolve()), 'dest': str(args.dest.resolve()), 'args': edits}
+    return _send_job(args, job)
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(_main())
+    except KeyboardInterrupt:
+        sys.exit()
+    except Exception as e:
+        sys.exit(f'Unexpected exception: {str(e)}')
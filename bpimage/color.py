@@ -1,164 +1,440 @@
 
 """Functions for modifying the colors of images.
 """
+from typing import Callable
 import numpy as np
-from validation import ensure_8bit_rgb
+import colormatrix
+import lut
+import validation
 
 
-def rgb2grayscale(img: np.ndarray) -> np.ndarray:
+def rgb2grayscale(img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """Converts an RGB image to a grayscale image.
     Each RGB pixel becomes a single 8bit value representing the weighted sum of the channels.
+    The alpha of an RGBA image is dropped, an image which is already grayscale is copied.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,1).
+        A new ndarray, or out if provided, with dtype=uint8 and shape=(h,w).
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: out was not a valid destination for the result.
     """
-    ensure_8bit_rgb(img)
-
-    # using weighted averages defined in https://en.wikipedia.org/wiki/Grayscale#Converting_colour_to_grayscale
-    return (img @ np.array([.2126, .7152, .0722])).clip(0, 255).astype(np.uint8)
+    return colormatrix.apply(img, _for_channels(_grayscale_matrix(), validation.pixels(img).shape[2]), out=out)
 
 
-def grayscale2rgb(img: np.ndarray) -> np.ndarray:
+def grayscale2rgb(img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """Converts an image in grayscale format to RGB format.
     Each single 8bit pixel of the image is expanded into RGB channels.
 
     Args:
         img: The source grayscale image with shape=(h,w,1).
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and shape=(h,w,3).
 
     Raises:
         ValueError: img was not grayscale.
+        ValueError: out was not a valid destination for the result.
     """
     if img.ndim != 2:
         raise ValueError("img must be grayscale.")
 
     # expand 2d array to 3d and fill the RGB values with the grayscale pixel value.
-    return img[:, :, np.newaxis].repeat(3, axis=-1)
+    dest = validation.output(out, img.shape + (3,), img)
+    np.copyto(dest, img[:, :, np.newaxis])
+    return dest
 
 
-def sepia(img: np.ndarray) -> np.ndarray:
+def sepia(img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """Applies a sepia tone to an RGB image
+    A grayscale image is toned as if each channel held the gray value, giving an RGB image. The alpha of an RGBA image is kept.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and shape=(h,w,4) for RGBA, otherwise shape=(h,w,3).
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: out was not a valid destination for the result.
     """
-    ensure_8bit_rgb(img)
-
-    # using common weights defined at https://stackoverflow.com/questions/36434905
-    transform = np.array([[.393, .769, .189],
-                          [.349, .686, .168],
-                          [.272, .534, .131]])
+    return colormatrix.apply(img, _for_channels(_sepia_matrix(), validation.pixels(img).shape[2]), out=out)
 
-    # clamp the values to ensure there isn't any overflow when casting from float back to uint8
-    return np.clip(img @ transform.T, 0, 255).astype(np.uint8)
 
-
-def brightness(img: np.ndarray, strength: float) -> np.ndarray:
+def brightness(img: np.ndarray, strength: float, out: np.ndarray = None) -> np.ndarray:
     """Modifies the brightness of the image.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
         strength: The amount to brighten or darken the image.
             A value of 0.0 will result in a black image, 1.0 gives the original image.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,1).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
         ValueError: strength was negative.
+        ValueError: out was not a valid destination for the result.
     """
-    ensure_8bit_rgb(img)
+    return apply_table(img, _brightness_table(strength), out=out)
 
-    if(strength < 0):
-        raise ValueError("strength must be positive.")
 
-    # Since we're multiplying by a scale it's going to be likely that the uint8 values will overflow.
-    # To get around this upcast the image to a larger data type, then clip back to uint8 range.
-    return np.clip(img.astype(np.float32) * strength, 0, 255).astype(np.uint8)
-
-
-def invert(img: np.ndarray) -> np.ndarray:
+def invert(img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """Create a negative of the image. 
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,1).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: out was not a valid destination for the result.
     """
-    ensure_8bit_rgb(img)
+    return apply_table(img, _invert_table(), out=out)
 
-    return 255 - img
 
-
-def contrast(img: np.ndarray, strength: float) -> np.ndarray:
+def contrast(img: np.ndarray, strength: float, out: np.ndarray = None) -> np.ndarray:
     """Modify the contrast of the image. 
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
         strength: The amount to modify the contrast.
             A value of 0.0 will result in a gray image, 1.0 gives the original image.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,1).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: out was not a valid destination for the result.
     """
-    ensure_8bit_rgb(img)
-
-    # We are expecting a 8bit rgb image.
-    # When multiplying these pixel values the results will likely be greater than 255.
-    # These values would wraparound, which would give weird results even with a clip at the end.
-    # This is because values greater than 255 will have already wrapped around before the clip.
-    #
-    # To get around this and at the cost of memory and runtime performance,
-    # Upcast the image to be stored as a float. This ensures we can hold values without wrap around.
-    img = img.astype(np.float32)
+    validation.pixels(img)
 
-    # use formula described in http://www.graficaobscura.com/interp/index.html
-    # lerp the image from its average pixel color (gray).
-    return np.clip(((1.0 - strength) * img.mean()) + (strength * img), 0, 255).astype(np.uint8)
+    # the table depends on the average pixel value, which needs one pass over the image before applying the table.
+    return apply_table(img, _contrast_table(strength, float(_color_channels(img).mean())), out=out)
 
 
-def saturation(img: np.ndarray, strength: float) -> np.ndarray:
+def saturation(img: np.ndarray, strength: float, out: np.ndarray = None) -> np.ndarray:
     """Modify the color saturation of the image. 
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+            Grayscale has no saturation to modify, so it is returned as a copy.
         strength: The amount to modify the saturation.
             A value of 0.0 will result in a black and white image, 1.0 gives the original image.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: out was not a valid destination for the result.
+    """
+    return colormatrix.apply(img, _channel_matrix(saturation, [strength], validation.pixels(img).shape[2]), out=out)
+
+
+def apply_pointwise(img: np.ndarray, ops: list[tuple[Callable, list]], out: np.ndarray = None) -> np.ndarray:
+    """Applies a sequence of pointwise color modifications (brightness, invert and contrast)
+    by composing them into a single lookup table, so the image is only processed once.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        ops: The modifications to apply in order, each is a function and the arguments to invoke it with after the image.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: ops contained a function which is not a pointwise color modification.
+        ValueError: out was not a valid destination for the result.
+    """
+    validation.pixels(img)
+    return apply_table(img, pointwise_table(ops, lambda: histogram(img)), out=out)
+
+
+def apply_matrices(img: np.ndarray, ops: list[tuple[Callable, list]], out: np.ndarray = None) -> np.ndarray:
+    """Applies a sequence of linear color modifications (rgb2grayscale, grayscale2rgb, sepia and saturation)
+    by composing their color matrices into one, so the image is only processed once.
+    Unlike applying each modification in turn, the result is only clamped to 0-255 at the end.
+    Grayscale and RGBA images, and the grayscale produced by a modification, are handled as the modifications do individually.
+
+    Args:
+        img: The source image.
+        ops: The modifications to apply in order, each is a function and the arguments to invoke it with after the image.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,1).
+        A new ndarray, or out if provided, with dtype=uint8, shape=(h,w,3), shape=(h,w,4) if the alpha of RGBA is kept
+        or shape=(h,w) if the final modification produces grayscale.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: ops contained a function which is not a linear color modification.
+        ValueError: the channels of the image did not match the first modification.
+        ValueError: out was not a valid destination for the result.
     """
-    ensure_8bit_rgb(img)
+    matrix = None
+    channels = validation.pixels(img).shape[2]
+    for command, args in ops:
+        if command not in _LINEAR:
+            raise ValueError(f'Not a linear color operation: \'{command.__name__}\'')
+        # each modification takes the channels produced by the one before it.
+        step = _channel_matrix(command, args, channels)
+        channels = step.shape[0]
+        matrix = step if matrix is None else colormatrix.compose(matrix, step)
+    return colormatrix.apply(img, matrix, out=out)
+
 
-    # cast the image to float to handle overflow which could happen before the clip.
-    img = img.astype(np.float32)
+def fuse(ops: list[tuple[Callable, list]]) -> list[tuple[Callable, list]]:
+    """Combines runs of adjacent pointwise color modifications into a single invocation of apply_pointwise,
+    and runs of adjacent linear color modifications into a single invocation of apply_matrices.
+
+    Pointwise modifications give an identical result. Linear modifications are only combined with the next one
+    if their matrix can never leave the 0-255 range, so the result only differs from applying each in turn by the rounding of the intermediate images.
+
+    Args:
+        ops: The operations to perform in order, each is a function and the arguments to invoke it with after the image.
+
+    Returns:
+        A new list of operations with runs of modifications replaced.
+    """
+    return _fuse_matrices(_fuse_pointwise(ops))
 
+
+def is_modification(command: Callable) -> bool:
+    """Returns true if the operation is a color modification, or a combination of them, which only reads the pixel it produces.
+    """
+    return command in _POINTWISE or command in _LINEAR or command in (apply_pointwise, apply_matrices, apply_table)
+
+
+def needs_mean(command: Callable, args: list) -> bool:
+    """Returns true if the operation depends on the mean channel value of the whole image, such as contrast.
+    """
+    if command is apply_pointwise:
+        return any(_POINTWISE[modification][1] for modification, _ in args[0])
+    return command in _POINTWISE and _POINTWISE[command][1]
+
+
+def histogram(img: np.ndarray) -> np.ndarray:
+    """Counts how many times each of the 256 values appears in the color channels of the image, without the alpha of RGBA.
+    The histograms of bands of an image add up to the histogram of the whole image.
+    """
+    return lut.histogram(_color_channels(img))
+
+
+def pointwise_table(ops: list[tuple[Callable, list]], source_histogram: Callable[[], np.ndarray]) -> np.ndarray:
+    """Composes the lookup tables of a sequence of pointwise modifications into one, see apply_table.
+
+    Args:
+        ops: The pointwise modifications to apply in order, each is a function and the arguments to invoke it with after the image.
+        source_histogram: Returns the histogram of the image the modifications are applied to, see histogram.
+            It is only called if a modification depends on the mean of the image.
+
+    Returns:
+        A lookup table with 256 uint8 entries.
+
+    Raises:
+        ValueError: ops contained a function which is not a pointwise color modification.
+    """
+    table = lut.IDENTITY
+    hist = None
+    for command, args in ops:
+        if command not in _POINTWISE:
+            raise ValueError(f'Not a pointwise operation: \'{command.__name__}\'')
+        builder, uses_mean = _POINTWISE[command]
+        if uses_mean:
+            # the mean of the image at this step can be calculated from the histogram of the source.
+            hist = source_histogram() if hist is None else hist
+            step = builder(*args, lut.mean(hist, table))
+        else:
+            step = builder(*args)
+        table = lut.compose(table, step)
+    return table
+
+
+def apply_table(img: np.ndarray, table: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Maps the color channels of the image through a lookup table, see lut.apply. The alpha of an RGBA image is kept.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        table: A lookup table with 256 uint8 entries, such as one returned by pointwise_table.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: out was not a valid destination for the result.
+    """
+    if validation.pixels(img).shape[2] != 4:
+        return lut.apply(img, table, out=out)
+    # the table maps every channel, so put the alpha back afterwards. Working in place overwrites it, so keep a copy.
+    alpha = img[:, :, 3].copy() if out is not None and np.may_share_memory(out, img) else img[:, :, 3]
+    dest = lut.apply(img, table, out=out)
+    dest[:, :, 3] = alpha
+    return dest
+
+
+def _fuse_pointwise(ops: list[tuple[Callable, list]]) -> list[tuple[Callable, list]]:
+    """Replaces runs of adjacent pointwise modifications with an invocation of apply_pointwise.
+    """
+    fused = []
+    run = []
+    for command, args in ops + [(None, [])]:
+        if command in _POINTWISE:
+            run.append((command, args))
+            continue
+        if len(run) > 1:
+            fused.append((apply_pointwise, [run]))
+        else:
+            fused.extend(run)
+        run = []
+        if command is not None:
+            fused.append((command, args))
+    return fused
+
+
+def _brightness_table(strength: float) -> np.ndarray:
+    """Builds the lookup table used by brightness.
+    """
+    if(strength < 0):
+        raise ValueError("strength must be positive.")
+
+    # Since we're multiplying by a scale it's going to be likely that the uint8 values will overflow.
+    # To get around this upcast the values to a larger data type, then clip back to uint8 range.
+    return np.clip(lut.IDENTITY.astype(np.float32) * strength, 0, 255).astype(np.uint8)
+
+
+def _invert_table() -> np.ndarray:
+    """Builds the lookup table used by invert.
+    """
+    return 255 - lut.IDENTITY
+
+
+def _contrast_table(strength: float, mean: float) -> np.ndarray:
+    """Builds the lookup table used by contrast for an image with the given mean channel value.
+    """
+    # upcast so that values greater than 255 don't wrap around before the clip.
+    # use formula described in http://www.graficaobscura.com/interp/index.html
+    # lerp the values from the average pixel color (gray).
+    values = lut.IDENTITY.astype(np.float32)
+    return np.clip(((1.0 - strength) * mean) + (strength * values), 0, 255).astype(np.uint8)
+
+
+def _color_channels(img: np.ndarray) -> np.ndarray:
+    """Returns the channels of the image which hold color, a view without the alpha of an RGBA image.
+    """
+    return img[:, :, :3] if img.ndim == 3 and img.shape[2] == 4 else img
+
+
+def _channel_matrix(command: Callable, args: list, channels: int) -> np.ndarray:
+    """Returns the color matrix of a linear modification for pixels with the given number of channels.
+    """
+    # every row of the saturation matrix sums to one, so it leaves gray pixels as they are, keep them grayscale.
+    if command is saturation and channels == 1:
+        return np.array([[1, 0]], dtype=np.float32)
+    return _for_channels(_LINEAR[command](*args), channels)
+
+
+def _for_channels(matrix: np.ndarray, channels: int) -> np.ndarray:
+    """Adapts a color matrix which takes RGB to pixels with the given number of channels, other matrices are returned as they are.
+    Grayscale is treated as RGB with the gray value in every channel, so the weights of the channels are summed.
+    The alpha of RGBA is passed through unchanged when the matrix produces RGB, and dropped when it produces grayscale.
+    """
+    if matrix.shape[1] != 4 or channels == 3:
+        return matrix
+    weights, offsets = matrix[:, :3].astype(np.float64), matrix[:, 3:]
+    if channels == 1:
+        return np.hstack([weights.sum(axis=1, keepdims=True), offsets]).astype(np.float32)
+    adapted = np.hstack([weights, np.zeros((matrix.shape[0], 1)), offsets])
+    if matrix.shape[0] == 3:
+        adapted = np.vstack([adapted, np.eye(1, 5, 3)])
+    return adapted.astype(np.float32)
+
+
+def _fuse_matrices(ops: list[tuple[Callable, list]]) -> list[tuple[Callable, list]]:
+    """Replaces runs of adjacent linear modifications whose intermediate results can't be clamped with an invocation of apply_matrices.
+    """
+    fused = []
+    run = []
+    for command, args in ops + [(None, [])]:
+        matrix = _LINEAR[command](*args) if command in _LINEAR else None
+        # the run can only continue if skipping the clamp of the previous modification changes nothing.
+        if matrix is not None and (not run or colormatrix.clamp_safe(run[-1][2])):
+            run.append((command, args, matrix))
+            continue
+        if len(run) > 1:
+            fused.append((apply_matrices, [[(c, a) for c, a, _ in run]]))
+        else:
+            fused.extend((c, a) for c, a, _ in run)
+        run = [(command, args, matrix)] if matrix is not None else []
+        if matrix is None and command is not None:
+            fused.append((command, args))
+    return fused
+
+
+def _grayscale_matrix() -> np.ndarray:
+    """Builds the color matrix used by rgb2grayscale.
+    """
+    # using weighted averages defined in https://en.wikipedia.org/wiki/Grayscale#Converting_colour_to_grayscale
+    return np.array([[.2126, .7152, .0722, 0]], dtype=np.float32)
+
+
+def _rgb_matrix() -> np.ndarray:
+    """Builds a color matrix equivalent to grayscale2rgb.
+    """
+    return np.array([[1, 0], [1, 0], [1, 0]], dtype=np.float32)
+
+
+def _sepia_matrix() -> np.ndarray:
+    """Builds the color matrix used by sepia.
+    """
+    # using common weights defined at https://stackoverflow.com/questions/36434905
+    return np.array([[.393, .769, .189, 0],
+                     [.349, .686, .168, 0],
+                     [.272, .534, .131, 0]], dtype=np.float32)
+
+
+def _saturation_matrix(strength: float) -> np.ndarray:
+    """Builds the color matrix used by saturation.
+    """
     # use formula described in http://www.graficaobscura.com/interp/index.html
-    # lerp the image from its grayscale version
-    blackandwhite = grayscale2rgb(rgb2grayscale(img))
-    return np.clip(((1.0 - strength) * blackandwhite) + (strength * img),0,255).astype(np.uint8)
+    # lerp each pixel from its grayscale version, every channel of the grayscale version is the same weighted sum.
+    gray = np.repeat(_grayscale_matrix()[:, :3], 3, axis=0)
+    weights = ((1.0 - strength) * gray) + (strength * np.eye(3))
+    return np.hstack([weights, np.zeros((3, 1))]).astype(np.float32)
+
+
+# operations which are a color matrix, mapped to the function that builds their matrix.
+_LINEAR = {
+    rgb2grayscale: _grayscale_matrix,
+    grayscale2rgb: _rgb_matrix,
+    sepia: _sepia_matrix,
+    saturation: _saturation_matrix,
+}
+
+
+# operations which map each channel value independently, mapped to the function that builds their lookup table
+# and whether that function also needs the mean channel value of the image.
+_POINTWISE = {
+    brightness: (_brightness_table, False),
+    invert: (_invert_table, False),
+    contrast: (_contrast_table, True),
+}
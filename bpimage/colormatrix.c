@@ -0,0 +1,68 @@
+#include <stdio.h>
+
+/*
+Clamps a float value to be between the min and max of an unsigned char and truncates it.
+ */
+static inline unsigned char to_channel(float value)
+{
+    return value < 0 ? 0 : (value > 255.0f ? 255 : (unsigned char)value);
+}
+
+/*
+Multiplies the channels of every pixel by a color matrix and writes the result to the destination image.
+Each output channel is a weighted sum of the input channels plus an offset, computed with float math and clamped to 0-255.
+
+@param img: The source image. Expected to be in contigious row major layout with in_channels values per pixel.
+@param matrix: The color matrix, expected to be contigious with shape (out_channels, in_channels + 1).
+    The final column holds the offset added to each output channel.
+@param dest: The destination image. Expected to be in contigious row major layout with out_channels values per pixel.
+@param in_channels: The number of channels of each source pixel.
+@param out_channels: The number of channels of each destination pixel.
+@param start: The index of the first pixel to transform.
+@param end: One past the index of the last pixel to transform.
+*/
+void color_matrix(unsigned char *img, float *matrix, unsigned char *dest, size_t in_channels, size_t out_channels, size_t start, size_t end)
+{
+    size_t cols = in_channels + 1;
+    size_t p, o, i;
+    float value;
+    unsigned char *src, *dst;
+    float *row;
+
+    // the common rgb to rgb case, unrolled so each channel is only read once.
+    if (in_channels == 3 && out_channels == 3)
+    {
+        float m00 = matrix[0], m01 = matrix[1], m02 = matrix[2], b0 = matrix[3];
+        float m10 = matrix[4], m11 = matrix[5], m12 = matrix[6], b1 = matrix[7];
+        float m20 = matrix[8], m21 = matrix[9], m22 = matrix[10], b2 = matrix[11];
+        float r, g, b;
+        for (p = start; p < end; p++)
+        {
+            src = img + p * 3;
+            dst = dest + p * 3;
+            r = src[0];
+            g = src[1];
+            b = src[2];
+            dst[0] = to_channel(m00 * r + m01 * g + m02 * b + b0);
+            dst[1] = to_channel(m10 * r + m11 * g + m12 * b + b1);
+            dst[2] = to_channel(m20 * r + m21 * g + m22 * b + b2);
+        }
+        return;
+    }
+
+    for (p = start; p < end; p++)
+    {
+        src = img + p * in_channels;
+        dst = dest + p * out_channels;
+        for (o = 0; o < out_channels; o++)
+        {
+            row = matrix + o * cols;
+            value = row[in_channels];
+            for (i = 0; i < in_channels; i++)
+            {
+                value += row[i] * src[i];
+            }
+            dst[o] = to_channel(value);
+        }
+    }
+}
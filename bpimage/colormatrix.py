@@ -0,0 +1,74 @@
+"""Functions for applying color matrices to 8bit images.
+A color matrix has shape (out channels, in channels + 1), each output channel of a pixel is a weighted sum
+of its input channels plus the offset in the final column. Linear color modifications such as sepia, saturation
+and grayscale conversion can be expressed as a matrix, and consecutive matrices can be composed into one
+so the image is only processed once.
+"""
+import ctypes
+import numpy as np
+import clib
+import parallel
+import profiling
+import validation
+
+# declare the color matrix function written in c so we can invoke it, the library is loaded on first use.
+clib.declare('color_matrix', None, [np.ctypeslib.ndpointer(np.uint8, flags='C_CONTIGUOUS'),
+                                    np.ctypeslib.ndpointer(np.float32, ndim=2, flags='C_CONTIGUOUS'),
+                                    np.ctypeslib.ndpointer(np.uint8, flags='C_CONTIGUOUS'),
+                                    ctypes.c_size_t,
+                                    ctypes.c_size_t,
+                                    ctypes.c_size_t,
+                                    ctypes.c_size_t])
+
+
+def apply(img: np.ndarray, matrix: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Multiplies the channels of every pixel by the matrix, clamping the result to 0-255.
+
+    Args:
+        img: The source image with dtype=uint8 and shape=(h,w,c), or shape=(h,w) if the matrix has one input channel.
+        matrix: A matrix with shape (out channels, c + 1).
+        out: The array to write the result to, defaults to a new array. May be the image itself when the matrix
+            has three input and output channels.
+
+    Returns:
+        The destination ndarray with dtype=uint8 and shape=(h,w,out channels), or shape=(h,w) if the matrix has
+        one output channel.
+
+    Raises:
+        ValueError: The number of channels of the image did not match the matrix.
+        ValueError: out was not a valid destination, see validation.output.
+    """
+    out_channels, in_channels = matrix.shape[0], matrix.shape[1] - 1
+    channels = img.shape[2] if img.ndim == 3 else 1
+    if channels != in_channels:
+        raise ValueError(f'Expected image with {in_channels} channels but image has {channels}.')
+
+    # each pixel is read in full before it is written, so only a matrix which keeps the layout can work in place.
+    shape = img.shape[:2] + ((out_channels,) if out_channels > 1 else ())
+    dest = validation.output(out, shape, img, in_place=in_channels == out_channels == 3)
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    width = img.shape[1]
+    profiling.engine('color_matrix')
+
+    def apply_band(start: int, end: int):
+        clib.lib.color_matrix(img, matrix, dest, in_channels, out_channels, start * width, end * width)
+
+    parallel.run_bands(apply_band, img.shape[0])
+    return dest
+
+
+def compose(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Returns a matrix which is equivalent to applying the first matrix then the second, ignoring the clamp between them.
+    """
+    # treat the first matrix as an affine transform by adding the row which carries the offset through.
+    first = np.vstack([first, np.eye(1, first.shape[1], first.shape[1] - 1)])
+    return (second.astype(np.float64) @ first).astype(np.float32)
+
+
+def clamp_safe(matrix: np.ndarray) -> bool:
+    """Returns true if the matrix can never produce a value outside of 0-255, so skipping its clamp changes nothing.
+    """
+    weights, offsets = matrix[:, :-1], matrix[:, -1]
+    return bool(np.all(offsets == 0) and np.all(weights >= 0) and np.all(np.sum(weights, axis=1) <= 1 + 1e-6))
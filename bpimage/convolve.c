@@ -1,6 +1,8 @@
 #include <stdio.h>
+#include "border.h"
 
-#define COLOR_DEPTH 3
+// The most channels a pixel may have, RGBA.
+#define MAX_CHANNELS 4
 
 /*
 Clamps a float value to be between the min and max of an unsigned char
@@ -9,69 +11,180 @@ Clamps a float value to be between the min and max of an unsigned char
  */
 float clamp(float value);
 
+/*
+Calculates a single destination pixel whose kernel window extends past the edge of the image.
+Every source pixel is mapped through border_index, so this is slower than the interior loop.
+ */
+static void convolve_border_pixel(unsigned char *img, float *kern, unsigned char *dest, float bias, size_t *img_shape, size_t channels, size_t *kern_shape, int mode, long y, long x)
+{
+    size_t height = img_shape[0];
+    size_t width = img_shape[1];
+    long kheight = kern_shape[0];
+    long kwidth = kern_shape[1];
+    long rh = kheight / 2;
+    long rw = kwidth / 2;
+
+    size_t s1 = channels * sizeof(unsigned char);
+    size_t s0 = s1 * width;
+
+    long ky, kx, sy, sx;
+    size_t offset, c;
+    float kval, acc[MAX_CHANNELS] = {0};
+
+    for (ky = 0; ky < kheight; ky++)
+    {
+        // pixels which map outside of the image in constant mode are zero and contribute nothing.
+        if ((sy = border_index(y + ky - rh, height, mode)) < 0)
+        {
+            continue;
+        }
+        for (kx = 0; kx < kwidth; kx++)
+        {
+            if ((sx = border_index(x + kx - rw, width, mode)) < 0)
+            {
+                continue;
+            }
+            kval = kern[kwidth * ky + kx];
+            offset = sy * s0 + sx * s1;
+            for (c = 0; c < channels; c++)
+            {
+                acc[c] += img[offset + c] * kval;
+            }
+        }
+    }
+
+    offset = y * s0 + x * s1;
+    for (c = 0; c < channels; c++)
+    {
+        dest[offset + c] = clamp(acc[c] + bias);
+    }
+}
+
+/*
+Calculates the destination pixels [x_start, x_end) of a row whose kernel windows lie completely within the image.
+Always inlined with a constant number of channels, so the loops over the channels are unrolled and the sums stay in registers.
+ */
+static inline __attribute__((always_inline)) void convolve_interior(unsigned char *img, float *kern, unsigned char *dest, float bias,
+                                                                    long width, const size_t channels, size_t kheight, size_t kwidth,
+                                                                    long y, long x_start, long x_end)
+{
+    long rh = kheight / 2;
+    long rw = kwidth / 2;
+    size_t s1 = channels * sizeof(unsigned char);
+    size_t s0 = s1 * width;
+
+    long x;
+    size_t ky, kx, c, wy, pixel_offset, window_offset;
+    float kval, acc[MAX_CHANNELS];
+
+    for (x = x_start; x < x_end; x++)
+    {
+        for (c = 0; c < channels; c++)
+        {
+            acc[c] = 0;
+        }
+
+        // iterate every element of the kernel
+        for (ky = 0; ky < kheight; ky++)
+        {
+            wy = (y - rh + ky) * s0;
+            for (kx = 0; kx < kwidth; kx++)
+            {
+                // get the kernel element.
+                kval = kern[kwidth * ky + kx];
+
+                // multiple the kernel element by the pixel and add to accumulated values
+                window_offset = wy + (x - rw + kx) * s1;
+                for (c = 0; c < channels; c++)
+                {
+                    acc[c] += img[window_offset + c] * kval;
+                }
+            }
+        }
+
+        // set the pixel on the destination image.
+        pixel_offset = y * s0 + x * s1;
+        for (c = 0; c < channels; c++)
+        {
+            dest[pixel_offset + c] = clamp(acc[c] + bias);
+        }
+    }
+}
+
 /*
 Applies a convolution kernel to the image and writes the result to the destination image.
+Only the destination rows in the range [row_start, row_end) are written, which allows bands of rows to be processed in parallel.
+Pixels whose kernel window lies completely within the image take a fast path without any bounds checks,
+pixels near the edge of the image read outside pixels according to the border mode.
 
-@param img_padded: A version of the source image padded on all sides by the kernel.
-Expected to have shape of (img height + kern height -1, img width + kern width - 1, 3).
+@param img: The source image.
+Expected to have shape of (img height, img width, channels).
 Expected to be in contigious row major layout.
 
 @param kern: The convolution kernel to apply to the image.
 Expected to be a contigious 2 dimensional array in row major order with shape (N,N) where N is an odd number > 1
 
 @param dest: The destination image to write the results to.
-Expected to have the same shape as the original unpadded image. (img height, img width, 3)
+Expected to have the same shape as the source image.
 Expected to be in contigious row major layout.
 
 @param bias: A constant value that is added to the result for each pixel after convolution is calculated.
-@param dest_shape: The shape of the image in format (height, width)
+@param img_shape: The shape of the image in format (height, width)
+@param channels: The number of channels of each pixel, 1 for grayscale, 3 for RGB or 4 for RGBA.
 @param kern_shape: The shape of the kernel in format (height, width)
+@param mode: One of the BORDER_ constants defined in border.h
+@param row_start: The first destination row to write.
+@param row_end: One past the last destination row to write.
 */
-void convolve(unsigned char *img_padded, float *kern, unsigned char *dest, float bias, size_t *dest_shape, size_t *kern_shape)
-{   
-    // cache shapes 
-    size_t height = dest_shape[0];
-    size_t width = dest_shape[1];
+void convolve(unsigned char *img, float *kern, unsigned char *dest, float bias, size_t *img_shape, size_t channels, size_t *kern_shape, int mode, size_t row_start, size_t row_end)
+{
+    // cache shapes
+    long height = img_shape[0];
+    long width = img_shape[1];
     size_t kheight = kern_shape[0];
     size_t kwidth = kern_shape[1];
+    long rh = kheight / 2;
+    long rw = kwidth / 2;
 
-    // calculate strides based on shapes
-    size_t s1 = COLOR_DEPTH * sizeof(unsigned char);
-    size_t s0 = s1 * width;
-    size_t ps0 = (width + kwidth - 1) * s1;
+    // the columns whose kernel window lies within the image.
+    long interior_start = rw;
+    long interior_end = width - rw > rw ? width - rw : rw;
 
-    size_t y, x, ky, kx, wy, pixel_offset, window_offset;
-    float kval, r, g, b;
+    long y, x;
 
-    // iterate every pixel of the padded image
-    for (y = 0; y < height; y++)
+    for (y = row_start; y < (long)row_end; y++)
     {
-        for (x = 0; x < width; x++)
+        // rows near the top or bottom need every pixel to handle the border.
+        if (y < rh || y >= height - rh)
         {
-            r = g = b = 0;
-     
-            // iterate every element of the kernel
-            for (ky = 0; ky < kheight; ky++)
+            for (x = 0; x < width; x++)
             {
-                wy = (y + ky) * ps0;
-                for (kx = 0; kx < kwidth; kx++)
-                {
-                    // get the kernel element. 
-                    kval = kern[kwidth * ky + kx];
-
-                    // multiple the kernel element by the pixel and add to accumulated values
-                    window_offset = wy + (x+kx) * s1;
-                    r += img_padded[window_offset] * kval;
-                    g += img_padded[++window_offset] * kval;
-                    b += img_padded[++window_offset] * kval;
-                }
+                convolve_border_pixel(img, kern, dest, bias, img_shape, channels, kern_shape, mode, y, x);
             }
+            continue;
+        }
+
+        // the left and right edges of the row need to handle the border.
+        for (x = 0; x < interior_start; x++)
+        {
+            convolve_border_pixel(img, kern, dest, bias, img_shape, channels, kern_shape, mode, y, x);
+        }
+        for (x = interior_end; x < width; x++)
+        {
+            convolve_border_pixel(img, kern, dest, bias, img_shape, channels, kern_shape, mode, y, x);
+        }
 
-            // set the pixel on the destination image. 
-            pixel_offset = y * s0 + x * s1;
-            dest[pixel_offset] = clamp(r + bias);
-            dest[++pixel_offset] = clamp(g + bias);
-            dest[++pixel_offset] = clamp(b + bias);
+        // the window of every other pixel lies within the image.
+        switch (channels)
+        {
+        case 1:
+            convolve_interior(img, kern, dest, bias, width, 1, kheight, kwidth, y, interior_start, interior_end);
+            break;
+        case 4:
+            convolve_interior(img, kern, dest, bias, width, 4, kheight, kwidth, y, interior_start, interior_end);
+            break;
+        default:
+            convolve_interior(img, kern, dest, bias, width, 3, kheight, kwidth, y, interior_start, interior_end);
         }
     }
 }
@@ -80,4 +193,241 @@ float clamp(float value)
 {
     const float ret = value < 0 ? 0 : value;
     return ret > 255.0f ? 255.0f : ret;
-}
\ No newline at end of file
+}
+
+/*
+Calculates the horizontal pass of a single pixel whose kernel window extends past the left or right edge of the row.
+ */
+static void convolve_row_border_pixel(unsigned char *src_row, float *kern, float *buf_row, size_t width, size_t channels, long kern_size, int mode, long x)
+{
+    long radius = kern_size / 2;
+    long k, sx;
+    size_t c;
+    float acc;
+
+    for (c = 0; c < channels; c++)
+    {
+        acc = 0;
+        for (k = 0; k < kern_size; k++)
+        {
+            if ((sx = border_index(x + k - radius, width, mode)) >= 0)
+            {
+                acc += src_row[sx * channels + c] * kern[k];
+            }
+        }
+        buf_row[x * channels + c] = acc;
+    }
+}
+
+/*
+Applies a separable convolution kernel to the image and writes the result to the destination image.
+The kernel is applied as two 1D passes, first horizontally into an intermediate float buffer, then vertically into the destination.
+This costs O(2N) per pixel instead of the O(N^2) of the full 2D kernel.
+Only the destination rows in the range [row_start, row_end) are written, which allows bands of rows to be processed in parallel.
+
+@param img: The source image.
+Expected to have shape of (img height, img width, channels).
+Expected to be in contigious row major layout.
+
+@param kern_x: The horizontal 1D kernel. Expected to be a contigious array of length kern_size.
+@param kern_y: The vertical 1D kernel. Expected to be a contigious array of length kern_size.
+
+@param buffer: Scratch memory used to hold the result of the horizontal pass.
+Expected to have shape of (row_end - row_start + kern size - 1, img width, channels).
+Expected to be in contigious row major layout.
+
+@param dest: The destination image to write the results to.
+Expected to have the same shape as the source image.
+Expected to be in contigious row major layout.
+
+@param bias: A constant value that is added to the result for each pixel after convolution is calculated.
+@param img_shape: The shape of the image in format (height, width)
+@param channels: The number of channels of each pixel, 1 for grayscale, 3 for RGB or 4 for RGBA.
+@param kern_size: The length of both 1D kernels, an odd number > 1.
+@param mode: One of the BORDER_ constants defined in border.h
+@param row_start: The first destination row to write.
+@param row_end: One past the last destination row to write.
+*/
+void convolve_separable(unsigned char *img, float *kern_x, float *kern_y, float *buffer, unsigned char *dest, float bias, size_t *img_shape, size_t channels, size_t kern_size, int mode, size_t row_start, size_t row_end)
+{
+    // cache shapes
+    size_t height = img_shape[0];
+    long width = img_shape[1];
+    long ksize = kern_size;
+    long radius = ksize / 2;
+    size_t buffer_height = row_end - row_start + kern_size - 1;
+
+    // calculate the row length (in elements) of each array.
+    long row_len = width * channels;
+    long stride = channels;
+
+    // the columns whose kernel window lies within the row.
+    long interior_start = radius;
+    long interior_end = width - radius > radius ? width - radius : radius;
+
+    long x, sy, i, k;
+    size_t y;
+    float acc;
+    unsigned char *src_row;
+    float *buf_row;
+
+    // horizontal pass, the rows above and below the band are needed so the vertical pass has its neighbors.
+    for (y = 0; y < buffer_height; y++)
+    {
+        buf_row = buffer + y * row_len;
+
+        // rows which fall outside of the image in constant mode are zero.
+        if ((sy = border_index((long)(row_start + y) - radius, height, mode)) < 0)
+        {
+            for (i = 0; i < row_len; i++)
+            {
+                buf_row[i] = 0;
+            }
+            continue;
+        }
+        src_row = img + sy * row_len;
+
+        // pixels near the left and right edges map their neighbors through the border mode.
+        for (x = 0; x < interior_start; x++)
+        {
+            convolve_row_border_pixel(src_row, kern_x, buf_row, width, channels, ksize, mode, x);
+        }
+        for (x = interior_end; x < width; x++)
+        {
+            convolve_row_border_pixel(src_row, kern_x, buf_row, width, channels, ksize, mode, x);
+        }
+
+        // every other pixel lies within the row, so walk it as a flat array of channel values.
+        for (i = interior_start * stride; i < interior_end * stride; i++)
+        {
+            acc = 0;
+            for (k = 0; k < ksize; k++)
+            {
+                acc += src_row[i + (k - radius) * stride] * kern_x[k];
+            }
+            buf_row[i] = acc;
+        }
+    }
+
+    // vertical pass, reads the horizontally blurred rows and writes the final pixels.
+    for (y = 0; y < row_end - row_start; y++)
+    {
+        buf_row = buffer + y * row_len;
+        for (i = 0; i < row_len; i++)
+        {
+            acc = 0;
+            for (k = 0; k < ksize; k++)
+            {
+                acc += buf_row[i + k * row_len] * kern_y[k];
+            }
+            dest[(row_start + y) * row_len + i] = clamp(acc + bias);
+        }
+    }
+}
+
+/*
+Applies a convolution kernel to the image using fixed-point integer math and writes the result to the destination image.
+The kernel is quantized to integers scaled by 2^shift, so each row can be accumulated with integer multiply-adds which the compiler vectorizes.
+Pixels whose kernel window extends past the edge of the image fall back to the float kernel.
+Only the destination rows in the range [row_start, row_end) are written, which allows bands of rows to be processed in parallel.
+
+@param img: The source image.
+Expected to have shape of (img height, img width, channels).
+Expected to be in contigious row major layout.
+
+@param kern: The float convolution kernel, used for pixels near the border.
+Expected to be a contigious 2 dimensional array in row major order with shape (N,N) where N is an odd number > 1
+
+@param kern_fixed: The kernel multiplied by 2^shift and rounded to integers, same shape as kern.
+@param acc: Scratch memory used to accumulate one row. Expected to have shape of (img width * channels).
+
+@param dest: The destination image to write the results to.
+Expected to have the same shape as the source image.
+Expected to be in contigious row major layout.
+
+@param bias: A constant value that is added to the result for each pixel after convolution is calculated.
+@param bias_fixed: The bias multiplied by 2^shift and rounded to an integer.
+@param shift: The number of fractional bits of kern_fixed and bias_fixed.
+@param img_shape: The shape of the image in format (height, width)
+@param channels: The number of channels of each pixel, 1 for grayscale, 3 for RGB or 4 for RGBA.
+@param kern_shape: The shape of the kernel in format (height, width)
+@param mode: One of the BORDER_ constants defined in border.h
+@param row_start: The first destination row to write.
+@param row_end: One past the last destination row to write.
+*/
+void convolve_fixed(unsigned char *img, float *kern, short *kern_fixed, int *acc, unsigned char *dest, float bias, int bias_fixed, int shift, size_t *img_shape, size_t channels, size_t *kern_shape, int mode, size_t row_start, size_t row_end)
+{
+    // cache shapes
+    long height = img_shape[0];
+    long width = img_shape[1];
+    long kheight = kern_shape[0];
+    long kwidth = kern_shape[1];
+    long rh = kheight / 2;
+    long rw = kwidth / 2;
+    long stride = channels;
+    long row_len = width * stride;
+
+    // the columns whose kernel window lies within the image, as flat channel offsets into a row.
+    long interior_start = rw;
+    long interior_end = width - rw > rw ? width - rw : rw;
+    long span_start = interior_start * stride;
+    long span_end = interior_end * stride;
+
+    long y, x, ky, kx, i, value;
+    int kval;
+    unsigned char *src;
+    unsigned char *dest_row;
+
+    for (y = row_start; y < (long)row_end; y++)
+    {
+        // rows near the top or bottom need every pixel to handle the border.
+        if (y < rh || y >= height - rh)
+        {
+            for (x = 0; x < width; x++)
+            {
+                convolve_border_pixel(img, kern, dest, bias, img_shape, channels, kern_shape, mode, y, x);
+            }
+            continue;
+        }
+
+        // the left and right edges of the row need to handle the border.
+        for (x = 0; x < interior_start; x++)
+        {
+            convolve_border_pixel(img, kern, dest, bias, img_shape, channels, kern_shape, mode, y, x);
+        }
+        for (x = interior_end; x < width; x++)
+        {
+            convolve_border_pixel(img, kern, dest, bias, img_shape, channels, kern_shape, mode, y, x);
+        }
+
+        // accumulate the interior of the row one kernel element at a time,
+        // each pass is a straight run of multiply-adds over contiguous memory.
+        for (i = span_start; i < span_end; i++)
+        {
+            acc[i] = bias_fixed;
+        }
+        for (ky = 0; ky < kheight; ky++)
+        {
+            for (kx = 0; kx < kwidth; kx++)
+            {
+                if ((kval = kern_fixed[kwidth * ky + kx]) == 0)
+                {
+                    continue;
+                }
+                src = img + (y - rh + ky) * row_len + (kx - rw) * stride;
+                for (i = span_start; i < span_end; i++)
+                {
+                    acc[i] += src[i] * kval;
+                }
+            }
+        }
+
+        // scale back down and clamp, the shift floors the result which matches the truncation of the float path.
+        dest_row = dest + y * row_len;
+        for (i = span_start; i < span_end; i++)
+        {
+            value = acc[i] >> shift;
+            dest_row[i] = value < 0 ? 0 : (value > 255 ? 255 : value);
+        }
+    }
+}
@@ -0,0 +1,112 @@
+#include <stdint.h>
+#include <string.h>
+
+// Dividing a rounded block sum by the pixel count is replaced by multiplying with a reciprocal scaled by 2^40.
+// The sum is below 256 * count, so the result is exact while count * count stays below 2^32.
+#define RECIPROCAL_SHIFT 40
+#define RECIPROCAL_LIMIT 65536
+
+/*
+Reduces the image by averaging every block of factor_y by factor_x source pixels into one destination pixel.
+Source rows are streamed in order and summed into a buffer before the columns of each block are added up,
+so every source pixel is read exactly once. Blocks along the right and bottom edges which extend past the source
+only average the pixels which exist.
+
+@param img: The source image, rows and pixels may have any stride but channels are expected to be adjacent.
+@param img_shape: The height, width and channels of the source image.
+@param img_strides: The number of bytes between rows and between pixels of the source image.
+@param dest: The destination image, at most ceil(height / factor_y) by ceil(width / factor_x) pixels.
+@param dest_shape: The height, width and channels of the destination image.
+@param dest_strides: The number of bytes between rows and between pixels of the destination image.
+@param factor_y: The number of source rows averaged into each destination row.
+@param factor_x: The number of source columns averaged into each destination column.
+@param row_sums: Scratch space holding the sum of each source column for the rows of a block,
+    expected to be contiguous with at least width * channels values.
+@param row_start: The first row of the destination image to fill.
+@param row_end: One past the last row of the destination image to fill.
+*/
+void box_downscale(const unsigned char *restrict img, size_t *img_shape, long *img_strides,
+                   unsigned char *restrict dest, size_t *dest_shape, long *dest_strides,
+                   size_t factor_y, size_t factor_x, uint32_t *restrict row_sums, size_t row_start, size_t row_end)
+{
+    const size_t channels = img_shape[2];
+    const size_t src_width = img_shape[1];
+    const size_t values = src_width * channels;
+    const long s0 = img_strides[0], s1 = img_strides[1];
+    const long ds0 = dest_strides[0], ds1 = dest_strides[1];
+    size_t y1, y0, x1, x0, c, i;
+
+    for (y1 = row_start; y1 < row_end; y1++)
+    {
+        size_t top = y1 * factor_y;
+        size_t bottom = top + factor_y < img_shape[0] ? top + factor_y : img_shape[0];
+
+        // sum the rows of the block column by column, the common packed layout is a single run of values.
+        memset(row_sums, 0, values * sizeof(uint32_t));
+        for (y0 = top; y0 < bottom; y0++)
+        {
+            const unsigned char *row = img + y0 * s0;
+            if (s1 == (long)channels)
+            {
+                for (i = 0; i < values; i++)
+                {
+                    row_sums[i] += row[i];
+                }
+            }
+            else
+            {
+                for (x0 = 0; x0 < src_width; x0++)
+                {
+                    for (c = 0; c < channels; c++)
+                    {
+                        row_sums[x0 * channels + c] += row[x0 * s1 + c];
+                    }
+                }
+            }
+        }
+
+        // add up the columns of each block and divide by the number of pixels it covers, rounding to nearest.
+        // every block except the last in the row covers the same number of pixels, so divide those by multiplying.
+        unsigned char *out = dest + y1 * ds0;
+        uint32_t full_count = (uint32_t)((bottom - top) * factor_x);
+        uint64_t reciprocal = ((UINT64_C(1) << RECIPROCAL_SHIFT) + full_count - 1) / full_count;
+        size_t full_blocks = src_width / factor_x < dest_shape[1] ? src_width / factor_x : dest_shape[1];
+        if (channels == 3 && full_count < RECIPROCAL_LIMIT)
+        {
+            for (x1 = 0; x1 < full_blocks; x1++)
+            {
+                const uint32_t *sums = row_sums + x1 * factor_x * 3;
+                uint32_t r = full_count / 2, g = full_count / 2, b = full_count / 2;
+                for (x0 = 0; x0 < factor_x; x0++)
+                {
+                    r += sums[x0 * 3];
+                    g += sums[x0 * 3 + 1];
+                    b += sums[x0 * 3 + 2];
+                }
+                out[x1 * ds1] = (unsigned char)((r * reciprocal) >> RECIPROCAL_SHIFT);
+                out[x1 * ds1 + 1] = (unsigned char)((g * reciprocal) >> RECIPROCAL_SHIFT);
+                out[x1 * ds1 + 2] = (unsigned char)((b * reciprocal) >> RECIPROCAL_SHIFT);
+            }
+        }
+        else
+        {
+            full_blocks = 0;
+        }
+
+        for (x1 = full_blocks; x1 < dest_shape[1]; x1++)
+        {
+            size_t left = x1 * factor_x;
+            size_t right = left + factor_x < src_width ? left + factor_x : src_width;
+            uint32_t count = (uint32_t)((bottom - top) * (right - left));
+            for (c = 0; c < channels; c++)
+            {
+                uint32_t sum = count / 2;
+                for (x0 = left; x0 < right; x0++)
+                {
+                    sum += row_sums[x0 * channels + c];
+                }
+                out[x1 * ds1 + c] = (unsigned char)(sum / count);
+            }
+        }
+    }
+}
@@ -0,0 +1,148 @@
+"""Functions for reducing the size of images by averaging, rather than point sampling, the source pixels.
+Reducing by a whole factor averages each block of source pixels with a single streaming read of the image.
+Reducing by any other amount starts from a mipmap pyramid of successive halvings and resamples the nearest level,
+so no more than a 2x reduction is ever point sampled.
+"""
+import ctypes
+import math
+import numpy as np
+import buffers
+import clib
+import parallel
+import profiling
+
+# declare the box filter written in c so we can invoke it, the library is loaded on first use.
+clib.declare('box_downscale', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                     ctypes.POINTER(np.ctypeslib.c_intp),
+                                     ctypes.POINTER(np.ctypeslib.c_intp),
+                                     np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                     ctypes.POINTER(np.ctypeslib.c_intp),
+                                     ctypes.POINTER(np.ctypeslib.c_intp),
+                                     ctypes.c_size_t,
+                                     ctypes.c_size_t,
+                                     np.ctypeslib.ndpointer(np.uint32, ndim=1, flags='C_CONTIGUOUS'),
+                                     ctypes.c_size_t,
+                                     ctypes.c_size_t])
+
+
+def box(img: np.ndarray, factor_y: int, factor_x: int = None, dest: np.ndarray = None) -> np.ndarray:
+    """Reduces the image by averaging every block of factor_y by factor_x pixels into one pixel.
+    Blocks along the bottom and right edges which extend past the image only average the pixels which exist.
+
+    Args:
+        img: The source image with shape=(h,w,c), or a grayscale image with shape=(h,w).
+        factor_y: The number of rows averaged into each row of the result.
+        factor_x: The number of columns averaged into each column of the result, defaults to factor_y.
+        dest: The array to write the result to, defaults to a new array of shape=(ceil(h/factor_y),ceil(w/factor_x),c).
+            Any rows or columns of the source beyond the blocks covered by dest are ignored.
+
+    Returns:
+        The destination ndarray with dtype=uint8.
+
+    Raises:
+        ValueError: a factor was less than one.
+        ValueError: dest was larger than the number of blocks in the image.
+    """
+    factor_x = factor_y if factor_x is None else factor_x
+    if factor_y < 1 or factor_x < 1:
+        raise ValueError('Factors must be positive.')
+    if img.ndim == 2:
+        # grayscale is averaged as a single channel and stays grayscale.
+        blocks = box(img[:, :, np.newaxis], factor_y, factor_x, None if dest is None else dest[:, :, np.newaxis])
+        return blocks.reshape(blocks.shape[:2]) if dest is None else dest
+
+    height, width, channels = img.shape
+    blocks = (-(-height // factor_y), -(-width // factor_x), channels)
+    if dest is None:
+        dest = buffers.empty(blocks, np.uint8)
+    elif dest.shape[0] > blocks[0] or dest.shape[1] > blocks[1] or dest.shape[2] != channels:
+        raise ValueError(f'Destination of shape {dest.shape} does not fit {blocks[0]}x{blocks[1]} blocks.')
+
+    # channels of a pixel must be adjacent, rows and pixels may have any stride such as a transposed view.
+    if img.strides[2] != 1:
+        img = np.ascontiguousarray(img)
+    profiling.engine('box_downscale')
+
+    def box_band(start: int, end: int):
+        row_sums = buffers.empty(width * channels, np.uint32)
+        clib.lib.box_downscale(img, img.ctypes.shape, img.ctypes.strides, dest, dest.ctypes.shape,
+                               dest.ctypes.strides, factor_y, factor_x, row_sums, start, end)
+        buffers.release(row_sums)
+
+    parallel.run_bands(box_band, dest.shape[0])
+    return dest
+
+
+class Pyramid:
+    """A mipmap pyramid of an image, where each level is half the size of the one before it.
+    Level 0 is the image itself. Levels are built on first use from the level before them and kept,
+    so reducing one image to several sizes only averages each level once.
+    The image must not be modified while the pyramid is in use.
+
+    Example:
+        pyramid = Pyramid(img)
+        thumbnails = [transform.scale(img, factor, pyramid=pyramid) for factor in (0.3, 0.1, 0.05)]
+    """
+
+    def __init__(self, img: np.ndarray):
+        """
+        Args:
+            img: The source image with shape=(h,w,c), or a grayscale image with shape=(h,w).
+        """
+        self._levels = [img]
+
+    @property
+    def image(self) -> np.ndarray:
+        """The source image the pyramid was built from.
+        """
+        return self._levels[0]
+
+    def level(self, index: int) -> np.ndarray:
+        """Returns the image halved the given number of times, rounding odd sizes up.
+
+        Args:
+            index: The number of halvings, 0 returns the source image.
+        """
+        while len(self._levels) <= index:
+            self._levels.append(box(self._levels[-1], 2))
+        return self._levels[index]
+
+    def release(self):
+        """Gives the memory of the levels built so far back to the active buffer pool, see buffers.
+        Levels used after a release are built again.
+        """
+        buffers.release(*self._levels[1:])
+        del self._levels[1:]
+
+
+def level_for(inv_transform: np.ndarray) -> int:
+    """Returns the deepest pyramid level which can be sampled by the transformation without being enlarged,
+    so the remaining resample reduces by less than half in every direction.
+
+    Args:
+        inv_transform: The inverse matrix which maps destination pixels to source pixels.
+    """
+    # the smallest singular value is the distance in source pixels between destination pixels along the least reduced axis.
+    step = np.linalg.svd(np.asarray(inv_transform, dtype=np.float64)[:2, :2], compute_uv=False)[-1]
+    if not step > 1:
+        return 0
+    # allow for single precision rounding, a reduction of exactly 1/2 should use level 1.
+    return max(0, math.floor(math.log2(step) + 1e-6))
+
+
+def whole_factors(inv_transform: np.ndarray) -> tuple[int, int]:
+    """Returns the block size in rows and columns if the transformation reduces by whole factors without
+    rotating, flipping or moving the image, otherwise None.
+
+    Args:
+        inv_transform: The inverse matrix which maps destination pixels to source pixels.
+    """
+    inv = np.asarray(inv_transform, dtype=np.float64)
+    if inv[0, 1] != 0 or inv[1, 0] != 0 or abs(inv[0, 2]) > 1e-4 or abs(inv[1, 2]) > 1e-4:
+        return None
+    factor_x, factor_y = round(inv[0, 0]), round(inv[1, 1])
+    if factor_x < 1 or factor_y < 1 or max(factor_x, factor_y) < 2:
+        return None
+    if abs(inv[0, 0] - factor_x) > 1e-4 * factor_x or abs(inv[1, 1] - factor_y) > 1e-4 * factor_y:
+        return None
+    return factor_y, factor_x
@@ -1,128 +1,215 @@
 """Functions for filtering images by applying kernels to each pixel using convolution
 """
 import ctypes
+from typing import Callable
 import numpy as np
-
-# load the convovle function written in c and configure so we can invoke it.
-_convolve_clib = ctypes.cdll.LoadLibrary('./bpimage.so')
-_convolve_clib.convolve.restype = None
-_convolve_clib.convolve.argtypes = [np.ctypeslib.ndpointer(np.uint8, ndim=3),
-                                    np.ctypeslib.ndpointer(np.float32, ndim=2),
-                                    np.ctypeslib.ndpointer(np.uint8, ndim=3),
-                                    ctypes.c_float,
-                                    ctypes.POINTER(np.ctypeslib.c_intp),
-                                    ctypes.POINTER(np.ctypeslib.c_intp)]
-
-
-def gaussian_blur(img: np.ndarray, radius: int = 1, sig: float = 1.) -> np.ndarray:
+import buffers
+import clib
+import parallel
+import profiling
+import validation
+
+# declare the convovle function written in c so we can invoke it, the library is loaded on first use.
+clib.declare('convolve', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                np.ctypeslib.ndpointer(np.float32, ndim=2),
+                                np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                ctypes.c_float,
+                                ctypes.POINTER(np.ctypeslib.c_intp),
+                                ctypes.c_size_t,
+                                ctypes.POINTER(np.ctypeslib.c_intp),
+                                ctypes.c_int,
+                                ctypes.c_size_t,
+                                ctypes.c_size_t])
+clib.declare('convolve_separable', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                          np.ctypeslib.ndpointer(np.float32, ndim=1),
+                                          np.ctypeslib.ndpointer(np.float32, ndim=1),
+                                          np.ctypeslib.ndpointer(np.float32, ndim=3),
+                                          np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                          ctypes.c_float,
+                                          ctypes.POINTER(np.ctypeslib.c_intp),
+                                          ctypes.c_size_t,
+                                          ctypes.c_size_t,
+                                          ctypes.c_int,
+                                          ctypes.c_size_t,
+                                          ctypes.c_size_t])
+clib.declare('convolve_fixed', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                      np.ctypeslib.ndpointer(np.float32, ndim=2),
+                                      np.ctypeslib.ndpointer(np.int16, ndim=2),
+                                      np.ctypeslib.ndpointer(np.int32, ndim=1),
+                                      np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                      ctypes.c_float,
+                                      ctypes.c_int,
+                                      ctypes.c_int,
+                                      ctypes.POINTER(np.ctypeslib.c_intp),
+                                      ctypes.c_size_t,
+                                      ctypes.POINTER(np.ctypeslib.c_intp),
+                                      ctypes.c_int,
+                                      ctypes.c_size_t,
+                                      ctypes.c_size_t])
+clib.declare('box_blur', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                np.ctypeslib.ndpointer(np.uint32, ndim=1),
+                                ctypes.POINTER(np.ctypeslib.c_intp),
+                                ctypes.c_size_t,
+                                ctypes.c_size_t,
+                                ctypes.c_int])
+
+# relative cost of one fft element compared to one multiply-add of the direct c loop, used to choose between engines.
+FFT_COST = 6.0
+# largest side length of the fft used by each tile, bounds the memory used by the fft engine.
+FFT_TILE_SIZE = 512
+
+# relative cost of one fixed-point multiply-add compared to a float one, the integer loop is vectorized by the compiler.
+FIXED_POINT_COST = 0.25
+# largest error the fixed-point kernel may add to a pixel (in levels of 0-255) before the float engine is used instead.
+FIXED_POINT_MAX_ERROR = 0.5
+
+# fixed cost of each separate filter (allocating, reading and writing the whole image) in units of one multiply-add per pixel.
+# used by fuse to decide if combining filters into one larger kernel is worthwhile.
+PASS_COST = 24
+
+# strategies for reading pixels beyond the edge of the image, values match the BORDER_ constants in border.h
+BORDER_MODES = {
+    'edge': 0,
+    'reflect': 1,
+    'wrap': 2,
+    'constant': 3
+}
+
+
+def gaussian_blur(img: np.ndarray, radius: int = 1, sig: float = 1., mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
     """Applies a gaussian blur to the image.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
         radius: The number of pixels to take in each direction. A radius of zero or below does nothing.
         sig: The sigma of the gaussian function. Higher values result in more blurring.
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
         ValueError: radius was less than one.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
     """
-    if radius < 1:
-        raise ValueError('Radius must be positive.')
-
-    # generate the gaussian kernel
-    # https://stackoverflow.com/questions/29731726/how-to-calculate-a-gaussian-kernel-matrix-efficiently-in-numpy
-    size = (radius * 2) + 1
-    ax = np.linspace(-(size - 1) / 2., (size - 1) /
-                     2., size, dtype=np.float32)
-    gauss = np.exp(-0.5 * np.square(ax) / np.square(sig))
-    kern = np.outer(gauss, gauss)
-    kern = kern / np.sum(kern)
-
-    return _convolve(img, kern)
+    return _convolve(img, *_gaussian_kernel(radius, sig), mode=mode, out=out)
 
 
-def boxblur(img: np.ndarray, radius: int = 1) -> np.ndarray:
+def boxblur(img: np.ndarray, radius: int = 1, passes: int = 1, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
     """Blurs each pixel by averaging all surrounding pixels extending radius pixels in each direction.
+    The cost per pixel does not depend on the radius. Each pass rounds the average to the nearest value rather than
+    truncating it like the convolution filters, so repeated passes don't darken the image.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
         radius: Number of pixels to take in each direction.
+        passes: Number of times the blur is applied. Repeated box blurs approach a gaussian blur.
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
         ValueError: radius was less than one.
+        ValueError: passes was less than one.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
     """
     if radius < 1:
         raise ValueError('Radius must be positive.')
+    if passes < 1:
+        raise ValueError('Passes must be positive.')
 
-    # create a kernel with the desired radius.
-    size = (radius*2)+1
-    kern = np.full(np.full(2, size), 1/size**2, dtype=np.float32)
+    return _box_blur(img, [radius] * passes, mode, out)
 
-    return _convolve(img, kern)
 
-
-def outline(img: np.ndarray) -> np.ndarray:
-    """Highlights edges of the image. 
+def fast_gaussian_blur(img: np.ndarray, sig: float = 1., passes: int = 3, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
+    """Approximates a gaussian blur by applying several box blurs in a row.
+    Unlike gaussian_blur the cost per pixel does not depend on sigma, making it much faster for large blurs.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        sig: The sigma of the gaussian function. Higher values result in more blurring.
+        passes: Number of box blurs to apply, more passes gives a closer approximation.
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: sig was not positive.
+        ValueError: passes was less than one.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
     """
-    kern = np.array([[-1, -1, -1],
-                     [-1, 8, -1],
-                     [-1, -1, -1]], dtype=np.float32)
-    return _convolve(img, kern)
+    if sig <= 0:
+        raise ValueError('Sigma must be positive.')
+    if passes < 1:
+        raise ValueError('Passes must be positive.')
 
+    radii = [radius for radius in _gaussian_box_radii(sig, passes) if radius > 0]
 
-def sharpen(img: np.ndarray, strength: float = 5.0) -> np.ndarray:
-    """Sharpens the image.
+    # sigma is too small for even the smallest box to be a reasonable approximation.
+    if not radii:
+        dest = validation.output(out, img.shape, img)
+        np.copyto(dest, img)
+        return dest
+
+    return _box_blur(img, radii, mode, out)
+
+
+def outline(img: np.ndarray, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
+    """Highlights edges of the image. 
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
-        strength: The strength of the sharpen affect (higher values may result in artifacts). 
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
     Raises:
-        ValueError: img was not RGB.
-        ValueError: The strength was negative.
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
     """
-    if strength < 0:
-        raise ValueError('Strength must be positive.')
+    return _convolve(img, *_outline_kernel(), mode=mode, out=out)
 
-    # build a sharpening kernel with the specified strength.
-    # use formula defined in: https://en.wikipedia.org/wiki/Unsharp_masking#Digital_unsharp_masking
 
-    a = np.array([[0, 0, 0],
-                  [0, 1, 0],
-                  [0, 0, 0]], dtype=np.float32)
+def sharpen(img: np.ndarray, strength: float = 5.0, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
+    """Sharpens the image.
 
-    b = np.array([[0, 1, 0],
-                  [1, 1, 1],
-                  [0, 1, 0]], dtype=np.float32) / 5
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        strength: The strength of the sharpen affect (higher values may result in artifacts). 
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
-    kern = a + ((a - b) * strength)
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
 
-    return _convolve(img, kern)
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: The strength was negative.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
+    """
+    return _convolve(img, *_sharpen_kernel(strength), mode=mode, out=out)
 
 
-def emboss(img: np.ndarray, direction: str, strength: int = 1) -> np.ndarray:
+def emboss(img: np.ndarray, direction: str, strength: int = 1, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
     """Applies an emboss effect to the image.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
         direction: One of the following supported values.
             'u' 
                 Emboss from top to bottom   
@@ -133,13 +220,500 @@ def emboss(img: np.ndarray, direction: str, strength: int = 1) -> np.ndarray:
             'r'
                 Emboss from right to left
         strength: The number of surrounding pixels to take in each direction.  
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
     
     Raises:
         ValueError: Provided an invalid direction. 
         ValueError: Provided a strength less than one. 
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
+    """
+    return _convolve(img, *_emboss_kernel(direction, strength), mode=mode, out=out)
+
+
+def motion_blur(img: np.ndarray, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
+    """Applies motion blur to the image.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
+    """
+    return _convolve(img, *_motion_blur_kernel(), mode=mode, out=out)
+
+
+def convolve(img: np.ndarray, kern: np.ndarray, bias: float = 0.0, mode: str = 'edge', out: np.ndarray = None) -> np.ndarray:
+    """Applies a custom convolution kernel to the image.
+    The fastest engine for the kernel and image is chosen automatically.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        kern: A NxN kernel where N is an odd number greater than one.
+        bias: A constant value added to each pixel after the kernel is applied.
+        mode: How pixels beyond the edge of the image are read, one of 'edge', 'reflect', 'wrap' or 'constant'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the shape of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: kern was not a NxN square where N is an odd number greater than one.
+        ValueError: kern was larger than the image.
+        ValueError: mode was not a supported border mode.
+        ValueError: out was not a valid destination for the result.
+    """
+    return _convolve(img, np.asarray(kern, dtype=np.float32), bias=bias, mode=mode, out=out)
+
+
+def fuse(ops: list[tuple[Callable, list]], unclamped: bool = False) -> list[tuple[Callable, list]]:
+    """Combines runs of adjacent linear filters into a single convolution, so the image is only processed once.
+
+    Each filter normally clamps its result to the 0-255 range before the next filter reads it.
+    By default a filter is only combined with the next one if its kernel can never leave that range
+    (no negative weights, weights summing to at most one and no bias), so the result matches
+    applying each filter in turn to within one level of rounding.
+    Pixels closer to the edge of the image than the combined kernel radius read the border of the source
+    rather than the border of the intermediate image.
+
+    Args:
+        ops: The operations to perform in order, each is a function and the arguments to invoke it with after the image.
+        unclamped: If true, combines every run of adjacent linear filters, skipping the clamp between them.
+            This is faster but the output may differ from applying each filter in turn.
+
+    Returns:
+        A new list of operations with runs of filters replaced by a single invocation of convolve.
+    """
+    fused = []
+    run, run_kern, run_bias, run_cost, run_clamp_safe = [], None, 0.0, 0.0, False
+
+    for command, args in ops:
+        kern, bias = _linear_kernel(command, args)
+
+        if run and kern is not None and (unclamped or run_clamp_safe):
+            combined = _combine_kernels(run_kern, kern)
+            # combining kernels grows them, only extend the run if one larger convolution is cheaper than separate ones.
+            if _op_cost(convolve, combined) <= run_cost + _op_cost(command, kern):
+                # a bias is just a constant image, so passing it through the next kernel scales it by the kernel sum.
+                run.append((command, args))
+                run_kern, run_bias = combined, run_bias * float(np.sum(kern)) + bias
+                run_cost += _op_cost(command, kern)
+                run_clamp_safe = _clamp_safe(kern, bias)
+                continue
+
+        fused.extend(_end_run(run, run_kern, run_bias))
+        if kern is None:
+            fused.append((command, args))
+            run = []
+        else:
+            run, run_kern, run_bias = [(command, args)], kern, bias
+            run_cost, run_clamp_safe = _op_cost(command, kern), _clamp_safe(kern, bias)
+
+    fused.extend(_end_run(run, run_kern, run_bias))
+    return fused
+
+
+def extent(command: Callable, args: list) -> tuple[int, str] | None:
+    """Returns the number of pixels in each direction which the filter reads to produce a pixel,
+    and the border mode it reads beyond the edges of the image with.
+
+    Args:
+        command: The operation.
+        args: The arguments to invoke it with after the image.
+
+    Returns:
+        The radius and border mode, or None if the operation is not one of the filters.
+    """
+    if command is fast_gaussian_blur:
+        sig, passes, mode = (list(args) + [1., 3, 'edge'][len(args):])[:3]
+        return sum(_gaussian_box_radii(sig, passes)), mode
+    if command in _LINEAR_FILTERS:
+        builder, arg_count = _LINEAR_FILTERS[command]
+        kern, _ = builder(*args[:arg_count])
+        return kern.shape[0] // 2, args[arg_count] if len(args) > arg_count else 'edge'
+    return None
+
+
+def _convolve(img: np.ndarray, kern: np.ndarray, bias=0.0, mode='edge', out: np.ndarray = None) -> np.ndarray:
+    """Applies the kernel to the image with the engine expected to be fastest.
+    """
+    validation.pixels(img)
+    if kern.dtype != np.float32 or kern.ndim != 2 or kern.shape[0] != kern.shape[1] or kern.shape[0] % 2 == 0 or kern.shape[0] <= 1:
+        raise ValueError(
+            'Kernel must be a NxN square of floats where N is an odd number greater than one.')
+    if kern.shape > img.shape[:2]:
+        raise ValueError('Image must be larger than Kernel')
+    _border_mode(mode)
+
+    # rank-1 kernels can be applied as two cheaper 1d passes, very large kernels are cheaper in the frequency domain
+    # and small kernels which can be represented with integers are cheaper with fixed-point math.
+    separated = _separate_kernel(kern)
+    quantized = _quantize_kernel(kern, bias)
+    engine = _choose_engine(img.shape[:2], kern.shape[0], separated is not None, quantized is not None)
+    if engine == 'fft':
+        return _convolve_fft(img, kern, bias=bias, mode=mode, out=out)
+    if engine == 'separable':
+        return _convolve_separable(img, *separated, bias=bias, mode=mode, out=out)
+    if engine == 'fixed':
+        return _convolve_fixed(img, kern, quantized, bias=bias, mode=mode, out=out)
+    return _convolve_direct(img, kern, bias=bias, mode=mode, out=out)
+
+
+def _convolve_direct(img: np.ndarray, kern: np.ndarray, bias=0.0, mode='edge', out: np.ndarray = None) -> np.ndarray:
+    """Applies the kernel to the image with float math, delegating the convolve to the c library.
+    """
+    pixels = validation.pixels(img)
+    border = _border_mode(mode)
+
+    # the c library handles the borders itself, it just needs the pixels laid out how it expects.
+    dest = validation.output(out, img.shape, img)
+    target = dest.reshape(pixels.shape)
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    profiling.engine('convolve')
+
+    # invoke our c function to apply the convolution to each band of rows.
+    def convolve_band(start: int, end: int):
+        clib.lib.convolve(pixels, kern, target, bias, pixels.ctypes.shape, pixels.shape[2], kern.ctypes.shape,
+                          border, start, end)
+
+    parallel.run_bands(convolve_band, pixels.shape[0])
+    return dest
+
+
+def _convolve_separable(img: np.ndarray, kern_y: np.ndarray, kern_x: np.ndarray, bias=0.0, mode='edge',
+                        out: np.ndarray = None) -> np.ndarray:
+    """Applies the separable kernel outer(kern_y, kern_x) to the image as a horizontal then vertical pass,
+    delegating the convolve to the c library.
+    """
+    pixels = validation.pixels(img)
+    if kern_y.shape != kern_x.shape or kern_x.ndim != 1 or kern_x.shape[0] % 2 == 0 or kern_x.shape[0] <= 1:
+        raise ValueError(
+            'Kernels must be 1d arrays of the same length N where N is an odd number greater than one.')
+    if kern_x.shape[0] > min(img.shape[:2]):
+        raise ValueError('Image must be larger than Kernel')
+
+    border = _border_mode(mode)
+    kern_y = np.ascontiguousarray(kern_y, dtype=np.float32)
+    kern_x = np.ascontiguousarray(kern_x, dtype=np.float32)
+    dest = validation.output(out, img.shape, img)
+    target = dest.reshape(pixels.shape)
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    profiling.engine('convolve_separable')
+
+    def convolve_band(start: int, end: int):
+        # holds the result of the horizontal pass, which includes the rows above and below the band so the vertical pass can read them.
+        buffer = buffers.empty((end - start + kern_x.shape[0] - 1, *pixels.shape[1:]), np.float32)
+        clib.lib.convolve_separable(pixels, kern_x, kern_y, buffer, target, bias,
+                                    pixels.ctypes.shape, pixels.shape[2], kern_x.shape[0], border, start, end)
+        buffers.release(buffer)
+
+    parallel.run_bands(convolve_band, pixels.shape[0])
+    return dest
+
+
+def _convolve_fixed(img: np.ndarray, kern: np.ndarray, quantized: tuple[np.ndarray, int, int], bias=0.0, mode='edge',
+                    out: np.ndarray = None) -> np.ndarray:
+    """Applies the kernel to the image with fixed-point integer math, delegating the convolve to the c library.
+    quantized is the result of _quantize_kernel for the kernel and bias.
+    """
+    pixels = validation.pixels(img)
+
+    border = _border_mode(mode)
+    kern_fixed, bias_fixed, shift = quantized
+    dest = validation.output(out, img.shape, img)
+    target = dest.reshape(pixels.shape)
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    profiling.engine('convolve_fixed')
+
+    def convolve_band(start: int, end: int):
+        # each band accumulates its rows in its own scratch memory.
+        acc = buffers.empty(pixels.shape[1] * pixels.shape[2], np.int32)
+        clib.lib.convolve_fixed(pixels, kern, kern_fixed, acc, target, bias, bias_fixed, shift,
+                                pixels.ctypes.shape, pixels.shape[2], kern.ctypes.shape, border, start, end)
+        buffers.release(acc)
+
+    parallel.run_bands(convolve_band, pixels.shape[0])
+    return dest
+
+
+def _quantize_kernel(kern: np.ndarray, bias: float) -> tuple[np.ndarray, int, int] | None:
+    """Converts the kernel and bias to fixed-point integers for the fixed-point engine.
+    Uses as many fractional bits as fit in an int16 kernel and an int32 accumulator.
+
+    Returns:
+        A tuple containing the int16 kernel, the integer bias and the number of fractional bits,
+        or None if the kernel can't be represented without adding more than FIXED_POINT_MAX_ERROR to a pixel.
+    """
+    largest = float(np.max(np.abs(kern)))
+    total = float(np.sum(np.abs(kern)))
+    if largest == 0:
+        return None
+
+    for shift in range(14, -1, -1):
+        scale = 1 << shift
+        # every element must fit in an int16 and the worst case sum must fit in an int32.
+        if largest * scale > np.iinfo(np.int16).max or (total * 255 + abs(bias)) * scale >= np.iinfo(np.int32).max:
+            continue
+        # round so the elements still sum to the scaled kernel sum, otherwise flat areas of the image
+        # (such as a blur of a solid color) would come out a level darker after truncation.
+        scaled = kern.astype(np.float64) * scale
+        kern_fixed = np.floor(scaled)
+        remainder = int(round(float(np.sum(scaled)) - float(np.sum(kern_fixed))))
+        if remainder > 0:
+            largest_fractions = np.argsort(kern_fixed - scaled, axis=None)[:remainder]
+            kern_fixed.flat[largest_fractions] += 1
+        # the worst case error is every rounding error adding up on a fully white or black window.
+        error = float(np.sum(np.abs(kern_fixed / scale - kern))) * 255
+        if error > FIXED_POINT_MAX_ERROR:
+            return None
+        return kern_fixed.astype(np.int16), int(round(bias * scale)), shift
+    return None
+
+
+def _convolve_fft(img: np.ndarray, kern: np.ndarray, bias=0.0, mode='edge', out: np.ndarray = None) -> np.ndarray:
+    """Applies the kernel to the image by multiplication in the frequency domain.
+    The image is processed in tiles so the memory used does not depend on the size of the image.
+    Each tile reads its pixels plus a halo of kernel radius pixels, so the tiles can be stitched together without seams.
+    """
+    pixels = validation.pixels(img)
+    _border_mode(mode)
+
+    height, width = img.shape[:2]
+    ksize = kern.shape[0]
+    krad = ksize // 2
+    fft_shape = _fft_shape(img.shape[:2], ksize)
+    tile_height, tile_width = fft_shape[0] - (ksize - 1), fft_shape[1] - (ksize - 1)
+
+    # the c library correlates rather than convolves, so flip the kernel to get the same result.
+    # every tile is transformed at the same size so the transformed kernel can be shared.
+    kern_fft = np.fft.rfft2(kern[::-1, ::-1], s=fft_shape)[:, :, np.newaxis]
+    profiling.engine('fft')
+
+    dest = validation.output(out, img.shape, img)
+    target = dest.reshape(pixels.shape)
+    for y in range(0, height, tile_height):
+        rows = _border_indices(y - krad, min(y + tile_height, height) + krad, height, mode)
+        for x in range(0, width, tile_width):
+            cols = _border_indices(x - krad, min(x + tile_width, width) + krad, width, mode)
+
+            # gather the tile and its halo, pixels outside of the image in constant mode are zero.
+            window = pixels[np.ix_(np.maximum(rows, 0), np.maximum(cols, 0))].astype(np.float32)
+            window[rows < 0] = 0
+            window[:, cols < 0] = 0
+
+            # the fft convolution is circular, only the pixels which had their full window within the tile are valid.
+            result = np.fft.irfft2(np.fft.rfft2(window, s=fft_shape, axes=(0, 1)) * kern_fft, s=fft_shape, axes=(0, 1))
+            result = result[ksize - 1:window.shape[0], ksize - 1:window.shape[1]]
+
+            # match the clamp and truncation of the c library, the small offset stops
+            # exact integer results which come back as x.99999 from being truncated down.
+            target[y:y + result.shape[0], x:x + result.shape[1]] = np.clip(result + (bias + 1e-4), 0, 255)
+
+    return dest
+
+
+def _choose_engine(img_shape: tuple[int, int], kern_size: int, separable: bool, fixed: bool = False) -> str:
+    """Estimates the cost per pixel of each convolution engine and returns the name of the cheapest.
+
+    Returns:
+        One of 'direct', 'separable', 'fixed' or 'fft'
+    """
+    # the c engines split the rows across the worker threads, the fft engine runs on a single thread.
+    threads = len(parallel.split_rows(img_shape[0]))
+    costs = {'direct': kern_size * kern_size / threads}
+    if separable:
+        costs['separable'] = 2 * kern_size / threads
+    if fixed:
+        costs['fixed'] = FIXED_POINT_COST * kern_size * kern_size / threads
+
+    # the fft of each tile costs n log n, spread over only the valid pixels of the tile.
+    fft_shape = _fft_shape(img_shape, kern_size)
+    fft_area = fft_shape[0] * fft_shape[1]
+    valid_area = min(fft_shape[0] - (kern_size - 1), img_shape[0]) * min(fft_shape[1] - (kern_size - 1), img_shape[1])
+    costs['fft'] = FFT_COST * fft_area * np.log2(fft_area) / valid_area
+
+    return min(costs, key=costs.get)
+
+
+def _fft_shape(img_shape: tuple[int, int], kern_size: int) -> tuple[int, int]:
+    """Returns the size of the fft used for each tile by the fft engine.
+    Tiles are large enough that most of each tile is valid output, but no larger than the image needs.
+    """
+    halo = kern_size - 1
+    side = max(FFT_TILE_SIZE, 1 << (4 * halo).bit_length())
+    # small images don't need a full tile, round up to a power of two which the fft handles efficiently.
+    return tuple(min(side, 1 << (length + halo - 1).bit_length()) for length in img_shape)
+
+
+def _border_indices(start: int, stop: int, length: int, mode: str) -> np.ndarray:
+    """Maps the range of indices, which may fall outside of the image, to the indices that should be read instead.
+    Mirrors border_index in border.h.
+
+    Returns:
+        An array of indices, where -1 means the pixel should be treated as zero.
+    """
+    indices = np.arange(start, stop)
+    if mode == 'reflect':
+        if length == 1:
+            return np.zeros_like(indices)
+        period = 2 * (length - 1)
+        indices = indices % period
+        return np.where(indices < length, indices, period - indices)
+    if mode == 'wrap':
+        return indices % length
+    if mode == 'constant':
+        return np.where((indices >= 0) & (indices < length), indices, -1)
+    return np.clip(indices, 0, length - 1)
+
+
+def _border_mode(mode: str) -> int:
+    """Returns the c library constant for the border mode.
+    """
+    if mode not in BORDER_MODES:
+        raise ValueError(f'Unknown border mode: \'{mode}\'')
+    return BORDER_MODES[mode]
+
+
+def _separate_kernel(kern: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+    """Attempts to decompose the 2d kernel into a vertical and horizontal 1d kernel whose outer product is the kernel.
+
+    Returns:
+        A tuple containing the vertical and horizontal kernels respectively, or None if the kernel is not rank-1.
+    """
+    # pivot on the largest element, for a rank-1 kernel every row is a multiple of the pivot row.
+    # dividing by the pivot keeps integer kernels exact, which matters because the c library truncates the result.
+    row, col = np.unravel_index(np.argmax(np.abs(kern)), kern.shape)
+    pivot = kern[row, col]
+    if pivot == 0:
+        return None
+    kern_y = kern[:, col].astype(np.float32)
+    kern_x = (kern[row, :] / pivot).astype(np.float32)
+    if not np.allclose(np.outer(kern_y, kern_x), kern, rtol=1e-5, atol=1e-7):
+        return None
+    return kern_y, kern_x
+
+
+def _box_blur(img: np.ndarray, radii: list[int], mode='edge', out: np.ndarray = None) -> np.ndarray:
+    """Applies a box blur of each radius to the image in turn, delegating the blur to the c library.
+    """
+    pixels = validation.pixels(img)
+
+    border = _border_mode(mode)
+    dest = validation.output(out, img.shape, img)
+    src = np.ascontiguousarray(pixels, dtype=np.uint8)
+    # the c function keeps a running sum of each column, allocate the memory once and reuse it for every pass.
+    col_sums = buffers.empty(pixels.shape[1] * pixels.shape[2], np.uint32)
+
+    # the blur can't be done in place, so swap between the destination and a scratch image when applying
+    # multiple passes, starting with whichever one leaves the final pass writing to the destination.
+    scratch = buffers.empty(pixels.shape, np.uint8) if len(radii) > 1 else None
+    targets = [dest.reshape(pixels.shape), scratch] if len(radii) % 2 else [scratch, dest.reshape(pixels.shape)]
+    profiling.engine('box_blur')
+
+    for i, radius in enumerate(radii):
+        clib.lib.box_blur(src, targets[i % 2], col_sums, pixels.ctypes.shape, pixels.shape[2], radius, border)
+        src = targets[i % 2]
+
+    buffers.release(col_sums)
+    if scratch is not None:
+        buffers.release(scratch)
+    return dest
+
+
+def _gaussian_box_radii(sig: float, passes: int) -> list[int]:
+    """Calculates the radius of each box blur so that applying them in order approximates a gaussian blur.
+    Uses the method described in http://blog.ivank.net/fastest-gaussian-blur.html
+    """
+    # ideal width of each box so that the combined variance matches the gaussian.
+    ideal = np.sqrt((12 * sig * sig / passes) + 1)
+    lower = int(np.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+
+    # use the smaller box for the first m passes and the larger one for the rest.
+    m = round((12 * sig * sig - passes * lower * lower - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    return [(lower if i < m else upper) // 2 for i in range(passes)]
+
+
+def _gaussian_kernel(radius: int = 1, sig: float = 1.) -> tuple[np.ndarray, float]:
+    """Builds the kernel and bias used by gaussian_blur.
+    """
+    if radius < 1:
+        raise ValueError('Radius must be positive.')
+
+    # generate the gaussian kernel
+    # https://stackoverflow.com/questions/29731726/how-to-calculate-a-gaussian-kernel-matrix-efficiently-in-numpy
+    size = (radius * 2) + 1
+    ax = np.linspace(-(size - 1) / 2., (size - 1) /
+                     2., size, dtype=np.float32)
+    gauss = np.exp(-0.5 * np.square(ax) / np.square(sig))
+
+    # the 2d gaussian kernel is the outer product of the 1d gaussian with itself,
+    # which lets _convolve pick the separable path unless the kernel is large enough for the fft to be faster.
+    gauss = gauss / np.sum(gauss)
+    return np.outer(gauss, gauss).astype(np.float32), 0.0
+
+
+def _box_kernel(radius: int = 1, passes: int = 1) -> tuple[np.ndarray, float]:
+    """Builds a kernel and bias equivalent to boxblur.
+    """
+    if radius < 1:
+        raise ValueError('Radius must be positive.')
+    if passes < 1:
+        raise ValueError('Passes must be positive.')
+
+    size = (radius * 2) + 1
+    box = np.full((size, size), 1 / size**2, dtype=np.float32)
+    kern = box
+    for _ in range(passes - 1):
+        kern = _combine_kernels(kern, box)
+    return kern, 0.0
+
+
+def _outline_kernel() -> tuple[np.ndarray, float]:
+    """Builds the kernel and bias used by outline.
+    """
+    kern = np.array([[-1, -1, -1],
+                     [-1, 8, -1],
+                     [-1, -1, -1]], dtype=np.float32)
+    return kern, 0.0
+
+
+def _sharpen_kernel(strength: float = 5.0) -> tuple[np.ndarray, float]:
+    """Builds the kernel and bias used by sharpen.
+    """
+    if strength < 0:
+        raise ValueError('Strength must be positive.')
+
+    # build a sharpening kernel with the specified strength.
+    # use formula defined in: https://en.wikipedia.org/wiki/Unsharp_masking#Digital_unsharp_masking
+
+    a = np.array([[0, 0, 0],
+                  [0, 1, 0],
+                  [0, 0, 0]], dtype=np.float32)
+
+    b = np.array([[0, 1, 0],
+                  [1, 1, 1],
+                  [0, 1, 0]], dtype=np.float32) / 5
+
+    return a + ((a - b) * strength), 0.0
+
+
+def _emboss_kernel(direction: str, strength: int = 1) -> tuple[np.ndarray, float]:
+    """Builds the kernel and bias used by emboss.
     """
     if strength < 1:
         raise ValueError("Strength must greater than or equal to one.")
@@ -168,50 +742,87 @@ def emboss(img: np.ndarray, direction: str, strength: int = 1) -> np.ndarray:
     else:
         raise ValueError(f'Unknown emboss direction: \'{direction}\'')
 
-    return _convolve(img, kern, bias=128.0)
-
-
-def motion_blur(img: np.ndarray) -> np.ndarray:
-    """Applies motion blur to the image.
-
-    Args:
-        img: The source RGB image with shape=(h,w,3).
+    return kern, 128.0
 
-    Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
 
-    Raises:
-        ValueError: img was not RGB.
+def _motion_blur_kernel() -> tuple[np.ndarray, float]:
+    """Builds the kernel and bias used by motion_blur.
     """
     # create a kernel with ones on a diagonal going from right to left.
     size = 9
     kern = np.zeros((size, size), dtype=np.float32)
     np.fill_diagonal(np.fliplr(kern), (1/size))
+    return kern, 0.0
+
+
+def _custom_kernel(kern: np.ndarray, bias: float = 0.0) -> tuple[np.ndarray, float]:
+    """Returns the kernel and bias passed to convolve.
+    """
+    return np.asarray(kern, dtype=np.float32), bias
+
 
-    return _convolve(img, kern)
+# filters which are a single convolution, mapped to the function that builds their kernel
+# and the number of arguments that function accepts. used by fuse to combine filters.
+_LINEAR_FILTERS = {
+    gaussian_blur: (_gaussian_kernel, 2),
+    boxblur: (_box_kernel, 2),
+    outline: (_outline_kernel, 0),
+    sharpen: (_sharpen_kernel, 1),
+    emboss: (_emboss_kernel, 2),
+    motion_blur: (_motion_blur_kernel, 0),
+    convolve: (_custom_kernel, 2),
+}
 
 
-def _convolve(img: np.ndarray, kern: np.ndarray, bias=0.0) -> np.ndarray:
-    """Applies the kernel to the image, delegating the convolve to the c library.
+def _linear_kernel(command: Callable, args: list) -> tuple[np.ndarray | None, float]:
+    """Returns the kernel and bias the operation would apply, or None if the operation can't be fused.
     """
-    if img.shape[-1] != 3:
-        raise ValueError('Expected RGB Image array of shape (h,w,3).')
-    if kern.dtype != np.float32 or kern.ndim != 2 or kern.shape[0] != kern.shape[1] or kern.shape[0] % 2 == 0 or kern.shape[0] <= 1:
-        raise ValueError(
-            'Kernel must be a NxN square of floats where N is an odd number greater than one.')
-    if kern.shape > img.shape[:2]:
-        raise ValueError('Image must be larger than Kernel')
+    if command not in _LINEAR_FILTERS:
+        return None, 0.0
+    builder, arg_count = _LINEAR_FILTERS[command]
+    # any extra arguments (such as a border mode) change how the filter behaves so leave it alone.
+    if len(args) > arg_count:
+        return None, 0.0
+    return builder(*args)
 
-    # pad source image for easy bounds handling at the expense of memory
-    # also ensures the new array will also be laid out in memory how the convolve method expects
-    krad = kern.shape[0] // 2
-    img_padded = np.ascontiguousarray(
-        np.pad(img, ((krad, krad), (krad, krad), (0, 0)), 'edge'))
 
-    # even though we padded the image for the convolve, the destination image will have the same shape as the unpadded source.
-    dest = np.empty(img.shape, dtype=np.uint8)
+def _end_run(run: list[tuple[Callable, list]], kern: np.ndarray, bias: float) -> list[tuple[Callable, list]]:
+    """Returns the operations which replace a run of fused filters.
+    """
+    if len(run) <= 1:
+        return run
+    return [(convolve, [kern, bias])]
 
-    # invoke our c function to apply the convolution.
-    _convolve_clib.convolve(img_padded, kern, dest, bias,
-                            img.ctypes.shape, kern.ctypes.shape)
-    return dest
+
+def _clamp_safe(kern: np.ndarray, bias: float) -> bool:
+    """Returns true if the kernel can never produce a value outside of 0-255, so skipping its clamp changes nothing.
+    """
+    return bias == 0 and bool(np.all(kern >= 0)) and float(np.sum(kern)) <= 1 + 1e-6
+
+
+def _combine_kernels(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Returns the single kernel equivalent to applying the first kernel and then the second.
+    """
+    size = first.shape[0] + second.shape[0] - 1
+    combined = np.zeros((size, size), dtype=np.float64)
+    # each element of the second kernel adds a shifted and scaled copy of the first.
+    for (y, x), value in np.ndenumerate(second):
+        if value != 0:
+            combined[y:y + first.shape[0], x:x + first.shape[1]] += first * value
+    return combined.astype(np.float32)
+
+
+def _kernel_cost(kern: np.ndarray) -> int:
+    """Estimates the cost per pixel of applying the kernel with the c library.
+    """
+    size = kern.shape[0]
+    return 2 * size if _separate_kernel(kern) is not None else size * size
+
+
+def _op_cost(command: Callable, kern: np.ndarray) -> int:
+    """Estimates the cost per pixel of invoking the filter as its own pass over the image.
+    """
+    # the box blur engine costs the same regardless of the radius.
+    if command is boxblur:
+        return PASS_COST + 4
+    return PASS_COST + _kernel_cost(kern)
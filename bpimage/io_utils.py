@@ -1,28 +1,302 @@
 """Module responsible for loading, saving and displaying images.
 Hides the implementation details of these operations so backing libraries
 can be switched out with ease. Provides standardized exceptions which simplify error handling.
+
+Files with the .npy extension are stored raw, the pixels follow a small header uncompressed.
+They are much faster to open and save than encoded formats, so they suit intermediate results passed between jobs.
+
+Grayscale images are loaded with shape (h,w) and images with transparency as RGBA with shape (h,w,4), every other
+image as RGB with shape (h,w,3). Grayscale is processed as a single channel, so it costs a third of RGB.
 """
+import builtins
+import contextlib
+import io
+import threading
+from pathlib import Path
+from typing import Callable
 import numpy as np
-from PIL import Image, ImageShow, UnidentifiedImageError
+import PIL
+from PIL import Image, UnidentifiedImageError
+
+# extension of the raw format, which holds the pixels of the image uncompressed after a numpy header.
+RAW_EXTENSION = '.npy'
+
+# Pillow modes which are loaded as they are, grayscale, RGB and RGBA. Any other mode is converted to one of them.
+NATIVE_MODES = ('L', 'RGB', 'RGBA')
+
+# Pillow modes which hold transparency, converted to RGBA.
+_ALPHA_MODES = ('LA', 'La', 'PA', 'RGBa')
+
+# formats which can't store transparency, the alpha of RGBA is dropped when saving to them.
+_OPAQUE_FORMATS = ('JPEG', 'MPO', 'PPM', 'PCX', 'EPS')
+
+# bytes Pillow stores each pixel in, for modes other than these it uses four. RGB is padded to four bytes as well.
+_PIXEL_BYTES = {'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2}
+
+# Pillow's limit on the number of pixels is a module global, held while it is lifted for open_into.
+_pixel_limit_lock = threading.Lock()
+
+# open_into and save_from hand Pillow arrays as its own image memory, through map_buffer and the layout Pillow keeps
+# pixels in. Neither is public, so outside the versions this is tested against they go through the public api instead,
+# which holds the whole image in memory while it is decoded or encoded.
+_MAPS_ARRAYS = (9, 1) <= tuple(int(part) for part in PIL.__version__.split('.')[:2]) < (13, 0)
 
 
 def open(path: str) -> np.ndarray:
-    """Attempts to load an image file as RGB and returns an ndarray.
+    """Attempts to load an image file as grayscale, RGB or RGBA and returns an ndarray.
+    Raw .npy files are memory mapped rather than read, pages of the file are only loaded as they are accessed.
 
     Args:
         path: filepath to the image
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        A new ndarray with dtype=uint8 and shape=(h,w) for grayscale, shape=(h,w,4) for images with transparency,
+        otherwise shape=(h,w,3). For raw files a read-only memory mapped array.
 
     Raises:
         ImageOpenError: raised when something goes wrong loading the image 
     """
+    if is_raw(path):
+        return _open_raw(path)
+    with _opening(path), Image.open(path) as img:
+        return _to_array(img)
+
+
+def open_into(path: str, create: Callable[[tuple[int, ...]], np.ndarray], strip_bytes: int,
+              max_pixels: int | None = None) -> np.ndarray:
+    """Attempts to decode an image file straight into arrays made by create, such as memory mapped files,
+    so the image never has to fit in memory. Pillow decodes into the array in its own layout, images which have to be
+    converted to one of the native modes are then converted a strip of rows at a time. Raw .npy files are memory mapped.
+
+    Args:
+        path: filepath to the image
+        create: Makes a new writable uint8 array with the given shape, called at most twice.
+        strip_bytes: The number of bytes of the image to convert at a time.
+        max_pixels: The largest number of pixels to accept in place of Pillow's guard against decompression bombs.
+            By default the guard applies as it does to open.
+
+    Returns:
+        An array made by create, or a view of one, with the same shape as open would return.
+
+    Raises:
+        ImageOpenError: raised when something goes wrong loading the image, or it has more than max_pixels pixels.
+    """
+    if is_raw(path):
+        return _open_raw(path)
+    with _opening(path):
+        if max_pixels is None:
+            img = Image.open(path)
+        else:
+            with _pixel_limit_lock:
+                limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+                try:
+                    img = Image.open(path)
+                finally:
+                    Image.MAX_IMAGE_PIXELS = limit
+        with img:
+            if max_pixels is not None and img.width * img.height > max_pixels:
+                raise ImageOpenError(f'Cannot open \'{path}\': {img.width}x{img.height} image has more than '
+                                     f'{max_pixels} pixels')
+            return _decode_into(img, create, strip_bytes)
+
+
+def save(img: np.ndarray, path: str):
+    """Attempts to save an ndarray of image data as an image with the given file name. 
+    The format is chosen by the extension, a raw .npy file is written as the header followed by the pixels in one write.
+
+    Args:
+        img: The source image with shape=(h,w), (h,w,3) or (h,w,4). The alpha is dropped for formats without transparency.
+        path: The filename to save the image as.
+
+    Raises:
+        ImageSaveError: Raised when something goes wrong saving the image 
+    """
+    if is_raw(path):
+        _save_raw(img, path)
+        return
+    try:
+        _opaque(Image.fromarray(img), _format(Path(path).suffix)).save(path)
+    except ValueError as e:
+        raise ImageSaveError(
+            f'Cannot save \'{path}\': could not determine output image format') from e
+    except OSError as e:
+        raise ImageSaveError(f'Failed to save \'{path}\': {e.strerror}') from e
+
+
+def save_from(img: np.ndarray, path: str, create: Callable[[tuple[int, ...]], np.ndarray], strip_bytes: int):
+    """Attempts to save an image which may not fit in memory, such as a memory mapped array, see save.
+    Pillow encodes from pixels in its own layout, so unless the image already matches it the pixels are copied
+    a strip of rows at a time into an array made by create. Formats which Pillow encodes row by row,
+    such as PNG, TIFF and JPEG, then never hold the whole image in memory.
+
+    Args:
+        img: The source image with shape=(h,w), (h,w,3) or (h,w,4). The alpha is dropped for formats without transparency.
+        path: The filename to save the image as.
+        create: Makes a new writable uint8 array with the given shape, called at most once.
+        strip_bytes: The number of bytes of the image to copy at a time.
+
+    Raises:
+        ImageSaveError: Raised when something goes wrong saving the image
+    """
+    if is_raw(path):
+        _save_raw(img, path)
+        return
+    image_format = _format(Path(path).suffix)
+    if image_format is None:
+        raise ImageSaveError(f'Cannot save \'{path}\': could not determine output image format')
+
+    pixels = img if img.ndim == 3 else img[:, :, np.newaxis]
+    mode = {1: 'L', 3: 'RGB', 4: 'RGBA'}[pixels.shape[2]]
+    if mode == 'RGBA' and image_format in _OPAQUE_FORMATS:
+        mode = 'RGB'
+    pixel_bytes = _PIXEL_BYTES.get(mode, 4) if _MAPS_ARRAYS else len(mode)
+    if pixel_bytes != pixels.shape[2] or not pixels.flags.c_contiguous:
+        padded = create((*pixels.shape[:2], pixel_bytes))
+        channels = min(pixels.shape[2], pixel_bytes)
+        for start, end in _strips(pixels.shape[0], pixels[:1].nbytes, strip_bytes):
+            padded[start:end, :, :channels] = pixels[start:end, :, :channels]
+        pixels = padded
+
+    height, width = pixels.shape[:2]
+    if _MAPS_ARRAYS:
+        image = Image.new(mode, (0, 0))._new(
+            Image.core.map_buffer(pixels, (width, height), 'raw', 0, (mode, width * pixel_bytes, 1)))
+    else:
+        image = Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
+    try:
+        image.save(path, format=image_format)
+    except ValueError as e:
+        raise ImageSaveError(f'Cannot save \'{path}\': {str(e)}') from e
+    except OSError as e:
+        raise ImageSaveError(f'Failed to save \'{path}\': {e.strerror}') from e
+
+
+def decode(data: bytes) -> np.ndarray:
+    """Attempts to load an image from the contents of an image file, in any format open supports.
+
+    Args:
+        data: The bytes of the image file.
+
+    Returns:
+        A new ndarray with dtype=uint8 and shape=(h,w), (h,w,3) or (h,w,4), see open.
+
+    Raises:
+        ImageOpenError: raised when the data is not a supported image.
+    """
+    if data.startswith(np.lib.format.MAGIC_PREFIX):
+        try:
+            img = np.load(io.BytesIO(data), allow_pickle=False)
+        except Exception as e:
+            raise ImageOpenError(f'Failed to decode image: {str(e)}') from e
+        if not _is_image(img):
+            raise ImageOpenError(f'Expected uint8 image of shape (h,w), (h,w,3) or (h,w,4) but found {img.dtype} of shape {img.shape}')
+        return img
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return _to_array(img)
+    except UnidentifiedImageError as e:
+        raise ImageOpenError('Failed to decode image, is this valid image data?') from e
+    except Exception as e:
+        raise ImageOpenError(f'Unexpected error decoding image: {str(e)}') from e
+
+
+def encode(img: np.ndarray, extension: str) -> bytes:
+    """Attempts to encode an ndarray of image data in the format given by a file extension.
+
+    Args:
+        img: The source image with shape=(h,w), (h,w,3) or (h,w,4). The alpha is dropped for formats without transparency.
+        extension: The extension of the format such as '.png', '.jpg' or '.npy'.
+
+    Returns:
+        The bytes of the encoded image file.
+
+    Raises:
+        ImageSaveError: raised when the format is not supported or the image could not be encoded.
+    """
+    buffer = io.BytesIO()
+    if extension.lower() == RAW_EXTENSION:
+        np.lib.format.write_array(buffer, np.asarray(img, dtype=np.uint8), allow_pickle=False)
+        return buffer.getvalue()
+
+    image_format = _format(extension)
+    if image_format is None:
+        raise ImageSaveError(f'Cannot encode image: unknown format \'{extension}\'')
+    try:
+        _opaque(Image.fromarray(img), image_format).save(buffer, format=image_format)
+    except (ValueError, OSError) as e:
+        raise ImageSaveError(f'Failed to encode image as \'{extension}\': {str(e)}') from e
+    return buffer.getvalue()
+
+
+def read(path: str) -> bytes:
+    """Attempts to read the contents of an image file without decoding them, see decode.
+
+    Raises:
+        ImageOpenError: raised when the file could not be read.
+    """
+    try:
+        return Path(path).read_bytes()
+    except IsADirectoryError as e:
+        raise ImageOpenError(
+            f'Cannot open \'{path}\': Expected image but provided directory') from e
+    except FileNotFoundError as e:
+        raise ImageOpenError(
+            f'Cannot open \'{path}\': No such file or directory') from e
+    except OSError as e:
+        raise ImageOpenError(f'Failed to open \'{path}\': {e.strerror}') from e
+
+
+def write(data: bytes, path: str):
+    """Attempts to write the contents of an already encoded image file, see encode.
+
+    Raises:
+        ImageSaveError: raised when the file could not be written.
+    """
+    try:
+        Path(path).write_bytes(data)
+    except OSError as e:
+        raise ImageSaveError(f'Failed to save \'{path}\': {e.strerror}') from e
+
+
+def is_raw(path: str) -> bool:
+    """Returns true if the path has the extension of the raw format.
+    """
+    return Path(path).suffix.lower() == RAW_EXTENSION
+
+
+def _open_raw(path: str) -> np.ndarray:
+    """Memory maps a raw image file.
+    """
+    try:
+        img = np.load(path, mmap_mode='r', allow_pickle=False)
+    except IsADirectoryError as e:
+        raise ImageOpenError(
+            f'Cannot open \'{path}\': Expected image but provided directory') from e
+    except FileNotFoundError as e:
+        raise ImageOpenError(
+            f'Cannot open \'{path}\': No such file or directory') from e
+    except ValueError as e:
+        raise ImageOpenError(
+            f'Cannot open \'{path}\': Failed to open image, is this a valid .npy file?') from e
+    except Exception as e:
+        raise ImageOpenError(
+            f'Unexpected error opening \'{path}\': {str(e)}') from e
+
+    if not _is_image(img):
+        raise ImageOpenError(f'Cannot open \'{path}\': Expected uint8 image of shape (h,w), (h,w,3) or (h,w,4) '
+                             f'but found {img.dtype} of shape {img.shape}')
+    return img
+
+
+@contextlib.contextmanager
+def _opening(path: str):
+    """Raises the errors of opening an image file as ImageOpenError.
+    """
     try:
-        with Image.open(path) as img:
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            return np.asarray(img, dtype=np.uint8)
+        yield
+    except ImageOpenError:
+        raise
     except IsADirectoryError as e:
         raise ImageOpenError(
             f'Cannot open \'{path}\': Expected image but provided directory') from e
@@ -37,21 +311,76 @@ def open(path: str) -> np.ndarray:
             f'Unexpected error opening \'{path}\': {str(e)}') from e
 
 
-def save(img: np.ndarray, path: str):
-    """Attempts to save an ndarray of image data as an image with the given file name. 
+def _decode_into(img: Image.Image, create: Callable[[tuple[int, ...]], np.ndarray], strip_bytes: int) -> np.ndarray:
+    """Decodes the opened image into arrays made by create, see open_into.
+    """
+    width, height = img.size
+    pixel_bytes = _PIXEL_BYTES.get(img.mode, 4)
+    if _MAPS_ARRAYS:
+        decoded = create((height, width, pixel_bytes))
+        mapped = Image.core.map_buffer(decoded, img.size, 'raw', 0, (img.mode, width * pixel_bytes, 1))
+        # an image which already holds memory is decoded into it, so handing Pillow the array makes it the destination.
+        img.im = mapped
+        img.load()
 
-    Args:
-        img: The source RGB image with shape=(h,w,3).
-        path: The filename to save the image as.
+        # Pillow maps uncompressed files itself rather than decoding them, those are copied out like a conversion.
+        if img.im is mapped and img.mode in NATIVE_MODES and 'transparency' not in img.info:
+            return decoded[:, :, 0] if img.mode == 'L' else decoded[:, :, :len(img.mode)]
 
-    Raises:
-        ImageSaveError: Raised when something goes wrong saving the image 
+    result = None
+    for start, end in _strips(height, width * pixel_bytes, strip_bytes):
+        strip = _to_array(img.crop((0, start, width, end)))
+        if result is None:
+            result = create((height, *strip.shape[1:]))
+        result[start:end] = strip
+    return result
+
+
+def _strips(height: int, row_bytes: int, strip_bytes: int) -> list[tuple[int, int]]:
+    """Divides the rows of an image into strips of at most strip_bytes, each at least one row.
+    """
+    rows = max(1, strip_bytes // max(1, row_bytes))
+    return [(start, min(height, start + rows)) for start in range(0, height, rows)]
+
+
+def _to_array(img: Image.Image) -> np.ndarray:
+    """Converts the image to the closest of the native modes and returns its pixels.
+    """
+    if img.mode in _ALPHA_MODES or (img.mode != 'RGBA' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+    elif img.mode not in NATIVE_MODES:
+        img = img.convert('L' if img.mode == '1' else 'RGB')
+    return np.asarray(img, dtype=np.uint8)
+
+
+def _format(extension: str) -> str | None:
+    """Returns the Pillow format of a file extension, or None if it is unknown.
+    """
+    # the common formats are registered by preinit, only load every plugin for the others.
+    Image.preinit()
+    return Image.EXTENSION.get(extension.lower()) or Image.registered_extensions().get(extension.lower())
+
+
+def _is_image(img: np.ndarray) -> bool:
+    """Returns true if the array holds an image in one of the native modes.
+    """
+    return img.dtype == np.uint8 and (img.ndim == 2 or (img.ndim == 3 and img.shape[2] in (3, 4)))
+
+
+def _opaque(image: Image.Image, image_format: str | None) -> Image.Image:
+    """Drops the alpha of an RGBA image when the format can't store it.
+    """
+    if image.mode == 'RGBA' and image_format in _OPAQUE_FORMATS:
+        return image.convert('RGB')
+    return image
+
+
+def _save_raw(img: np.ndarray, path: str):
+    """Writes the image to a raw image file.
     """
     try:
-        Image.fromarray(img).save(path)
-    except ValueError as e:
-        raise ImageSaveError(
-            f'Cannot save \'{path}\': could not determine output image format') from e
+        with builtins.open(path, 'wb') as file:
+            np.lib.format.write_array(file, np.asarray(img, dtype=np.uint8), allow_pickle=False)
     except OSError as e:
         raise ImageSaveError(f'Failed to save \'{path}\': {e.strerror}') from e
 
@@ -60,11 +389,13 @@ def show(img):
     """Attempts to save an ndarray of image data as an image with the given file name. 
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image with shape=(h,w), (h,w,3) or (h,w,4).
 
     Raises:
         ImageShowError: Raised when something goes wrong showing the image 
     """
+    # importing ImageShow loads the viewers it supports, which may include IPython, so only pay for it when previewing.
+    from PIL import ImageShow
     try:
         if not ImageShow.show(Image.fromarray(img)):
             raise ImageShowError("Failed to show image")
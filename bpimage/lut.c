@@ -0,0 +1,19 @@
+#include <stdio.h>
+
+/*
+Maps every value of the source through a lookup table and writes the result to the destination.
+
+@param src: The source values, expected to be contiguous.
+@param table: The lookup table, expected to have 256 entries.
+@param dest: The destination to write the mapped values to, expected to be contiguous and the same size as the source.
+@param start: The index of the first value to map.
+@param end: One past the index of the last value to map.
+*/
+void lut_apply(unsigned char *src, unsigned char *table, unsigned char *dest, size_t start, size_t end)
+{
+    size_t i;
+    for (i = start; i < end; i++)
+    {
+        dest[i] = table[src[i]];
+    }
+}
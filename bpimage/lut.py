@@ -0,0 +1,83 @@
+"""Functions for applying lookup tables to 8bit images.
+A lookup table maps each of the 256 possible channel values to a new value. Any pointwise operation
+can be expressed as a table and applied with a single read of each pixel, and consecutive
+operations can be composed into one table before the image is touched.
+"""
+import ctypes
+import numpy as np
+import clib
+import parallel
+import profiling
+import validation
+
+# declare the lookup function written in c so we can invoke it, the library is loaded on first use.
+clib.declare('lut_apply', None, [np.ctypeslib.ndpointer(np.uint8, flags='C_CONTIGUOUS'),
+                                 np.ctypeslib.ndpointer(np.uint8, ndim=1, flags='C_CONTIGUOUS'),
+                                 np.ctypeslib.ndpointer(np.uint8, flags='C_CONTIGUOUS'),
+                                 ctypes.c_size_t,
+                                 ctypes.c_size_t])
+
+# number of values histogram counts at a time.
+_HISTOGRAM_CHUNK = 2**16
+
+# the table which maps every value to itself.
+IDENTITY = np.arange(256, dtype=np.uint8)
+
+
+def apply(img: np.ndarray, table: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Maps every channel value of the image through the table.
+
+    Args:
+        img: The source image with dtype=uint8.
+        table: An array with dtype=uint8 and shape=(256,)
+        out: The array to write the result to, with the same shape as the image. May be the image itself.
+            Defaults to a new array.
+
+    Returns:
+        The destination ndarray. If the image is contiguous no other memory is allocated.
+
+    Raises:
+        ValueError: out was not a valid destination, see validation.output.
+    """
+    dest = validation.output(out, img.shape, img, in_place=True)
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    table = np.ascontiguousarray(table, dtype=np.uint8)
+    if img.size == 0:
+        return dest
+
+    # split the image into bands of rows, each band is a contiguous range of values.
+    row_size = img.size // img.shape[0]
+    profiling.engine('lut_apply')
+
+    def apply_band(start: int, end: int):
+        clib.lib.lut_apply(img, table, dest, start * row_size, end * row_size)
+
+    parallel.run_bands(apply_band, img.shape[0])
+    return dest
+
+
+def compose(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Returns a table which is equivalent to applying the first table then the second.
+    """
+    return second[first]
+
+
+def histogram(img: np.ndarray) -> np.ndarray:
+    """Counts how many times each of the 256 values appears in the image.
+    """
+    # bincount converts its input to intp, counting in chunks bounds the copy rather than making it 8x the image.
+    values = img.reshape(-1)
+    hist = np.zeros(256, dtype=np.intp)
+    for start in range(0, values.size, _HISTOGRAM_CHUNK):
+        hist += np.bincount(values[start:start + _HISTOGRAM_CHUNK], minlength=256)
+    return hist
+
+
+def mean(hist: np.ndarray, table: np.ndarray = IDENTITY) -> float:
+    """Calculates the mean channel value of an image after the table is applied to it, without applying the table.
+
+    Args:
+        hist: The histogram of the image before the table is applied.
+        table: The table which would be applied to the image.
+    """
+    return float(np.dot(hist, table.astype(np.float64))) / float(np.sum(hist))
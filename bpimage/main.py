@@ -4,11 +4,15 @@
 import sys
 from argparse import ArgumentParser, Action, ArgumentTypeError
 from pathlib import Path
+from typing import Callable
 import collections.abc
-import io_utils
-import filters
-import transform
-import color
+import importlib
+import cache
+import parallel
+import profiling
+
+# the interpolations supported by transform, listed here so the parser can be built without importing numpy.
+INTERPOLATIONS = ['nearest', 'bilinear', 'bicubic']
 
 
 class ParseMultipleTypes(Action):
@@ -47,6 +51,19 @@ def str_to_bool(v):
         raise ArgumentTypeError('Boolean value expected.')
 
 
+def positive_int(v):
+    """Attempts to parse the string value as an integer greater than zero.
+    Can be used with argparse to support positive int arguments.
+    """
+    try:
+        value = int(v)
+    except ValueError:
+        raise ArgumentTypeError('Integer value expected.')
+    if value < 1:
+        raise ArgumentTypeError('Value must be greater than zero.')
+    return value
+
+
 ACTIONS = {
     'color modifications': {
         'rgb2gray': {
@@ -55,7 +72,7 @@ ACTIONS = {
                 'help': 'Converts the image to Grayscale.',
                 'const': []
             },
-            'command': color.rgb2grayscale
+            'command': 'color.rgb2grayscale'
         },
         'gray2rgb': {
             'args': {
@@ -63,7 +80,7 @@ ACTIONS = {
                 'help': 'Converts the shape of an image from grayscale (w,h,1) to RGB (w,h,3).',
                 'const': []
             },
-            'command': color.grayscale2rgb
+            'command': 'color.grayscale2rgb'
         },
         'sepia': {
             'args': {
@@ -71,7 +88,7 @@ ACTIONS = {
                 'help': 'Applies a sepia effect to the image.',
                 'const': []
             },
-            'command': color.sepia
+            'command': 'color.sepia'
         },
         'brightness': {
             'args': {
@@ -80,7 +97,7 @@ ACTIONS = {
                 'type': float,
                 'metavar': 'strength'
             },
-            'command': color.brightness
+            'command': 'color.brightness'
         },
         'invert': {
             'args': {
@@ -88,7 +105,7 @@ ACTIONS = {
                 'help': 'Invert the colors of the image, producing a negative.',
                 'const': []
             },
-            'command': color.invert
+            'command': 'color.invert'
         },
         'contrast': {
             'args': {
@@ -97,7 +114,7 @@ ACTIONS = {
                 'type': float,
                 'metavar': 'strength'
             },
-            'command': color.contrast
+            'command': 'color.contrast'
         },
         'saturation': {
             'args': {
@@ -106,7 +123,7 @@ ACTIONS = {
                 'type': float,
                 'metavar': 'strength'
             },
-            'command': color.saturation
+            'command': 'color.saturation'
         },
     },
     'image transformations': {
@@ -116,7 +133,7 @@ ACTIONS = {
                 'help': 'Flips the image across the vertical, from left to right.',
                 'const': []
             },
-            'command': transform.flipv
+            'command': 'transform.flipv'
         },
         'fliph': {
             'args': {
@@ -124,7 +141,7 @@ ACTIONS = {
                 'help': 'Flips the image across the horizontal, from bottom to top.',
                 'const': []
             },
-            'command': transform.fliph
+            'command': 'transform.fliph'
         },
         'rotate90': {
             'args': {
@@ -134,7 +151,7 @@ ACTIONS = {
                 'type': int,
                 'metavar': 'times'
             },
-            'command': transform.rotate90
+            'command': 'transform.rotate90'
         },
         'rotate': {
             'args': {
@@ -144,7 +161,8 @@ ACTIONS = {
                 'types': [float, str_to_bool],
                 'metavar': ('angle', 'expand')
             },
-            'command': transform.rotate
+            'command': 'transform.rotate',
+            'interpolated': True
         },
         'scale': {
             'args': {
@@ -153,7 +171,8 @@ ACTIONS = {
                 'type': float,
                 'metavar': 'factor'
             },
-            'command': transform.scale
+            'command': 'transform.scale',
+            'interpolated': True
         },
         'shear': {
             'args': {
@@ -163,7 +182,8 @@ ACTIONS = {
                 'types': [float, float, str_to_bool],
                 'metavar': ('shear_x', 'shear_y', 'expand')
             },
-            'command': transform.shear
+            'command': 'transform.shear',
+            'interpolated': True
         }
     },
     'convolution filters': {
@@ -175,7 +195,7 @@ ACTIONS = {
                 'const': 1,
                 'metavar': 'radius'
             },
-            'command': filters.boxblur
+            'command': 'filters.boxblur'
         },
         'outline': {
             'args': {
@@ -183,7 +203,7 @@ ACTIONS = {
                 'const': [],
                 'action': 'store_const'
             },
-            'command': filters.outline
+            'command': 'filters.outline'
         },
         'sharpen': {
             'args': {
@@ -192,7 +212,7 @@ ACTIONS = {
                 'type': float,
                 'metavar': 'strength'
             },
-            'command': filters.sharpen
+            'command': 'filters.sharpen'
         },
         'motionblur': {
             'args': {
@@ -200,7 +220,7 @@ ACTIONS = {
                 'const': [],
                 'action': 'store_const'
             },
-            'command': filters.motion_blur
+            'command': 'filters.motion_blur'
         },
         'emboss': {
             'args': {
@@ -210,7 +230,7 @@ ACTIONS = {
                 'action': ParseMultipleTypes,
                 'types': [str, int]
             },
-            'command': filters.emboss
+            'command': 'filters.emboss'
         },
         'gaussian': {
             'args': {
@@ -220,14 +240,49 @@ ACTIONS = {
                 'action': ParseMultipleTypes,
                 'types': [int, float]
             },
-            'command': filters.gaussian_blur
+            'command': 'filters.gaussian_blur'
+        },
+        'fastgaussian': {
+            'args': {
+                'help': 'Approximates a gaussian blur by applying three box blurs. Much faster than gaussian for large blurs. Sigma determines the strength of the blur. (type:%(type)s)',
+                'nargs': 1,
+                'type': float,
+                'metavar': 'sig'
+            },
+            'command': 'filters.fast_gaussian_blur'
         }
     }
 }
 
 
+def add_operation_arguments(parser: ArgumentParser):
+    """Adds an argument for every command in ACTIONS, along with the options which change how they are applied.
+    The operations can then be read from the parsed arguments with _get_ops.
+    """
+    parser.add_argument('-i', '--interpolation', choices=INTERPOLATIONS, default='nearest',
+                        help='how rotate, scale and shear sample between source pixels (default:%(default)s)')
+    parser.add_argument('--fast', action='store_true',
+                        help='combine every run of adjacent convolution filters into one, skipping the clamp between them. faster, but the result may differ')
+
+    # create each argument group and add all group commands.
+    for group_key, group_value in ACTIONS.items():
+        argument_group = parser.add_argument_group(group_key)
+        for command_key, command_value in group_value.items():
+            argument_group.add_argument(
+                f'--{command_key}', **command_value['args'])
+
+
+def add_cache_arguments(parser: ArgumentParser):
+    """Adds the arguments which enable the result cache, which can then be opened with _get_cache.
+    """
+    parser.add_argument('--cache', type=Path, metavar='dir',
+                        help='store results in the directory and reuse them for identical sources and edits')
+    parser.add_argument('--cache-size', type=positive_int, default=cache.DEFAULT_MAX_BYTES // 2**20, metavar='megabytes',
+                        help='size the cache is kept within, removing the least recently used results (default:%(default)s)')
+
+
 def _get_cli_args():
-    parser = ArgumentParser(description='CLI for bpimage library. Performs image editing on RGB images.')
+    parser = ArgumentParser(description='CLI for bpimage library. Performs image editing on grayscale, RGB and RGBA images.')
     parser.add_argument('source', help='source image file path', type=Path)
 
     # make user to choose to output to a file or to preview the image.
@@ -235,38 +290,112 @@ def _get_cli_args():
     output_group.add_argument('-d', '--dest', help='destination image file path', type=Path)
     output_group.add_argument('-p', '--preview', action='store_true',
                         help='creates a temporary image and displays using the default image viewer')
-
-    # create each argument group and add all group commands.
-    for group_key, group_value in ACTIONS.items():
-        argument_group = parser.add_argument_group(group_key)
-        for command_key, command_value in group_value.items():
-            argument_group.add_argument(
-                f'--{command_key}', **command_value['args'])
+    output_group.add_argument('--plan', action='store_true',
+                        help='prints the optimized operations which would be applied to the image, without applying them')
+    parser.add_argument('-t', '--threads', type=positive_int, metavar='count',
+                        help='number of worker threads used to process the image (default: number of cpus)')
+    parser.add_argument('-m', '--memory-budget', type=positive_int, metavar='megabytes',
+                        help='process the image in tiles, keeping memory use within the budget. requires dest')
+    parser.add_argument('--max-pixels', type=positive_int, metavar='megapixels',
+                        help='accept sources up to this size in place of the limit against decompression bombs. requires -m')
+    parser.add_argument('--profile', nargs='?', const='table', choices=['table', 'json'],
+                        help='print the time, memory and engine of each stage to stderr, as a table or as JSON lines (default:table)')
+    add_cache_arguments(parser)
+    add_operation_arguments(parser)
 
     # if no args provided, output the help message
     if len(sys.argv) < 2:
         parser.print_help(sys.stderr)
         exit(1)
 
-    return parser.parse_args()
-
+    args = parser.parse_args()
+    if args.memory_budget and not args.dest:
+        parser.error('argument -m/--memory-budget: requires -d/--dest')
+    if args.max_pixels and not args.memory_budget:
+        parser.error('argument --max-pixels: requires -m/--memory-budget')
+    if args.cache and not args.dest:
+        parser.error('argument --cache: requires -d/--dest')
+    if args.cache and args.memory_budget:
+        parser.error('argument --cache: not allowed with argument -m/--memory-budget')
+    return args
 
-def _process_img(args):
-    img = io_utils.open(args.source)
 
-    # execute each command provided to generate the final image.
+def _get_ops(args) -> list[tuple[Callable, list]]:
+    """Returns the command and arguments of each action specified on the command line, in the order they are applied.
+    """
+    ops = []
     for group in ACTIONS.values():
         for (command_key, command_args) in group.items():
-            # if command was specified as an argument then invoke it. 
+            # if command was specified as an argument then queue it.
             if (action_args := getattr(args, command_key)) is not None:
                 if isinstance(action_args, collections.abc.Sequence):
                     # ensure multiple args get unpacked.
-                    img = command_args['command'](img, *action_args)
+                    action_args = list(action_args)
                 else:
-                    img = command_args['command'](img, action_args)
+                    action_args = [action_args]
+                # commands which resample the image also take the interpolation.
+                if command_args.get('interpolated'):
+                    action_args.append(args.interpolation)
+                ops.append((_command(command_args['command']), action_args))
+    return ops
+
+
+def _command(name: str) -> Callable:
+    """Returns the function of a command named as 'module.function', importing the module on first use.
+    Commands are named rather than imported with the CLI, so printing help or reporting a bad argument never loads
+    numpy, Pillow or the c library.
+    """
+    module, function = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def _get_cache(args) -> cache.ResultCache | None:
+    """Opens the result cache specified on the command line, if any.
+    """
+    return cache.ResultCache(args.cache, args.cache_size * 2**20) if args.cache else None
+
+
+def _process_img(args):
+    import io_utils
+    import pipeline
+    import tiled
+
+    if args.threads:
+        parallel.set_threads(args.threads)
+
+    # tiled processing reads the source itself, a piece at a time.
+    if args.memory_budget:
+        max_pixels = args.max_pixels * 10**6 if args.max_pixels else None
+        profiling.run('tiled', tiled.process, args.source, _get_ops(args), args.dest, args.memory_budget * 2**20, args.fast,
+                      None, max_pixels)
+        return
+
+    # identical sources and edits are answered from the cache without decoding the source.
+    if result_cache := _get_cache(args):
+        source = profiling.run('read', io_utils.read, args.source)
+        ops = pipeline.optimize(_get_ops(args), unclamped=args.fast)
+
+        def compute() -> bytes:
+            img = pipeline.apply(profiling.run('decode', io_utils.decode, source), ops)
+            return profiling.run('encode', io_utils.encode, img, args.dest.suffix)
+
+        data, _ = profiling.run('cache', result_cache.get_or_compute, result_cache.key(source, ops, args.dest.suffix), compute)
+        profiling.run('write', io_utils.write, data, args.dest)
+        return
+
+    # record each command provided, the pipeline optimizes them as a whole before anything is applied.
+    img_pipeline = pipeline.Pipeline(profiling.run('open', io_utils.open, args.source))
+    for command, command_args in _get_ops(args):
+        img_pipeline = img_pipeline.apply(command, *command_args)
+
+    if args.plan:
+        print(img_pipeline.plan(unclamped=args.fast))
+        return
+
+    img = img_pipeline.compute(unclamped=args.fast)
 
     if args.dest:
-        io_utils.save(img, args.dest)
+        profiling.run('save', io_utils.save, img, args.dest)
 
     if args.preview:
         io_utils.show(img)
@@ -274,9 +403,16 @@ def _process_img(args):
 
 def _main():
     args = _get_cli_args()
+    # the image libraries are only imported once the arguments are known to be valid.
+    import io_utils
 
     try:
-        _process_img(args)
+        if not args.profile:
+            _process_img(args)
+            return
+        with profiling.Profile() as profile:
+            _process_img(args)
+        print(profile.table() if args.profile == 'table' else profile.json_lines(), file=sys.stderr)
     except (io_utils.ImageOpenError, io_utils.ImageSaveError, io_utils.ImageShowError) as e:
         return str(e)
 
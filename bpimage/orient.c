@@ -0,0 +1,97 @@
+#include <stdint.h>
+#include <string.h>
+
+// Pixels are copied in square tiles when rows of the view run down columns of the source, so the source rows
+// a tile reads from stay in cache until every pixel of them in the tile has been written.
+#define TILE_SIZE 64
+
+/*
+Copies the pixels of a strided view of an image into a contiguous destination.
+Flips and transposes of an image are views with negative or swapped strides, copying them in order produces the
+flipped or rotated image. Rows which are contiguous in the source are copied whole, rows which are reversed are
+copied pixel by pixel, and views which walk down the columns of the source are copied in tiles.
+
+@param img: The first pixel of the view, strides may be negative so the view may begin anywhere in the source buffer.
+@param img_shape: The height, width and channels of the view and the destination.
+@param img_strides: The number of bytes between rows, pixels and channels of the view. Channels are expected to be adjacent.
+@param dest: The destination image, expected to be contiguous.
+@param row_start: The first row of the view to copy.
+@param row_end: One past the last row of the view to copy.
+*/
+void orient_copy(const unsigned char *restrict img, size_t *img_shape, long *img_strides, unsigned char *restrict dest,
+                 size_t row_start, size_t row_end)
+{
+    const size_t width = img_shape[1];
+    const size_t channels = img_shape[2];
+    const size_t row_size = width * channels;
+    const long s0 = img_strides[0], s1 = img_strides[1];
+    size_t y, x, tile_y, tile_x, tile_end_y, tile_end_x;
+
+    // rows of the view are contiguous in the source, for example a vertical flip (fliph).
+    if (s1 == (long)channels)
+    {
+        for (y = row_start; y < row_end; y++)
+        {
+            memcpy(dest + y * row_size, img + (long)y * s0, row_size);
+        }
+        return;
+    }
+
+    // rows of the view run backwards along a row of the source, for example a horizontal flip (flipv).
+    if (s1 == -(long)channels)
+    {
+        for (y = row_start; y < row_end; y++)
+        {
+            const unsigned char *src = img + (long)y * s0;
+            unsigned char *out = dest + y * row_size;
+            if (channels == 3)
+            {
+                for (x = 0; x < width; x++)
+                {
+                    out[x * 3] = src[-(long)x * 3];
+                    out[x * 3 + 1] = src[-(long)x * 3 + 1];
+                    out[x * 3 + 2] = src[-(long)x * 3 + 2];
+                }
+            }
+            else
+            {
+                for (x = 0; x < width; x++)
+                {
+                    memcpy(out + x * channels, src - (long)(x * channels), channels);
+                }
+            }
+        }
+        return;
+    }
+
+    // rows of the view run down a column of the source, for example a transpose or quarter turn.
+    for (tile_y = row_start; tile_y < row_end; tile_y += TILE_SIZE)
+    {
+        tile_end_y = tile_y + TILE_SIZE < row_end ? tile_y + TILE_SIZE : row_end;
+        for (tile_x = 0; tile_x < width; tile_x += TILE_SIZE)
+        {
+            tile_end_x = tile_x + TILE_SIZE < width ? tile_x + TILE_SIZE : width;
+            for (y = tile_y; y < tile_end_y; y++)
+            {
+                const unsigned char *src = img + (long)y * s0;
+                unsigned char *out = dest + y * row_size;
+                if (channels == 3)
+                {
+                    for (x = tile_x; x < tile_end_x; x++)
+                    {
+                        out[x * 3] = src[(long)x * s1];
+                        out[x * 3 + 1] = src[(long)x * s1 + 1];
+                        out[x * 3 + 2] = src[(long)x * s1 + 2];
+                    }
+                }
+                else
+                {
+                    for (x = tile_x; x < tile_end_x; x++)
+                    {
+                        memcpy(out + x * channels, src + (long)x * s1, channels);
+                    }
+                }
+            }
+        }
+    }
+}
@@ -0,0 +1,87 @@
+"""Functions for splitting work on an image across multiple threads.
+The c library is invoked through ctypes which releases the GIL, so each band of rows can be processed on its own core.
+"""
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# images are not split into bands smaller than this, the cost of dispatching would outweigh the gains.
+MIN_BAND_ROWS = 32
+
+_threads = os.cpu_count() or 1
+_executor = None
+# guards creating and replacing the executor, and submitting work to it.
+_lock = threading.Lock()
+
+
+def set_threads(threads: int):
+    """Sets the number of worker threads used by operations which support splitting work.
+
+    Args:
+        threads: The number of threads, a value of one runs everything on the calling thread.
+
+    Raises:
+        ValueError: threads was less than one.
+    """
+    global _threads, _executor
+    if threads < 1:
+        raise ValueError('Threads must be positive.')
+    with _lock:
+        if threads != _threads and _executor is not None:
+            # bands already submitted by other threads still finish, the old executor only stops taking new ones.
+            _executor.shutdown(wait=False)
+            _executor = None
+        _threads = threads
+
+
+def get_threads() -> int:
+    """Returns the number of worker threads used by operations which support splitting work.
+    """
+    return _threads
+
+
+def split_rows(height: int, threads: int = None) -> list[tuple[int, int]]:
+    """Divides the rows of an image into contiguous bands of roughly equal size.
+
+    Args:
+        height: The number of rows in the image.
+        threads: The number of bands to aim for, defaults to the configured number of threads.
+
+    Returns:
+        A list of (start, end) tuples where start is inclusive and end is exclusive.
+    """
+    threads = threads or _threads
+    count = max(1, min(threads, height // MIN_BAND_ROWS))
+    bounds = [(height * i) // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def run_bands(func: Callable[[int, int], None], height: int):
+    """Invokes the function once for each band of rows, running the bands across the worker threads.
+    Each band runs in a copy of the caller's context, so it sees the buffer pool and profile the caller activated.
+    Blocks until every band has finished.
+
+    Args:
+        func: Function which processes the rows [start, end) of the image.
+        height: The number of rows in the image.
+    """
+    global _executor
+    bands = split_rows(height)
+
+    # don't pay for dispatching if there is no work to split.
+    if len(bands) == 1:
+        func(*bands[0])
+        return
+
+    # submit under the lock, so set_threads can't shut the executor down between fetching it and using it.
+    # a context can only be entered by one thread at a time, so each band gets its own copy.
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(_threads)
+        futures = [_executor.submit(contextvars.copy_context().run, func, *band) for band in bands]
+
+    # wait for every band so that any exception raised in a band is raised here.
+    for future in futures:
+        future.result()
@@ -0,0 +1,277 @@
+"""Lazy pipeline of image operations.
+Operations are recorded rather than applied, so the whole sequence can be optimized before the image is touched.
+Redundant operations are removed and runs of operations which can be combined are replaced with a single operation.
+"""
+import contextlib
+from typing import Callable
+import numpy as np
+import buffers
+import filters
+import profiling
+import transform
+import color
+
+
+class Pipeline:
+    """Records a sequence of operations to apply to an image, which are only applied when compute is invoked.
+    Every method which adds an operation returns a new pipeline, so a pipeline can be shared and extended independently.
+
+    Example:
+        Pipeline(img).rotate(30).brightness(1.2).gaussian(3, 2).compute()
+    """
+
+    def __init__(self, img: np.ndarray, ops: list[tuple[Callable, list]] = None):
+        """
+        Args:
+            img: The source image the operations are applied to.
+            ops: The operations recorded so far, each is a function and the arguments to invoke it with after the image.
+        """
+        self._img = img
+        self._ops = list(ops) if ops is not None else []
+
+    @property
+    def ops(self) -> list[tuple[Callable, list]]:
+        """The operations in the order they were recorded, before optimization.
+        """
+        return list(self._ops)
+
+    def apply(self, command: Callable, *args) -> 'Pipeline':
+        """Returns a new pipeline with the operation appended.
+
+        Args:
+            command: A function which accepts the image followed by the arguments and returns a new image.
+            args: The arguments to invoke the command with after the image.
+        """
+        return Pipeline(self._img, self._ops + [(command, list(args))])
+
+    def rgb2gray(self) -> 'Pipeline':
+        """Appends color.rgb2grayscale."""
+        return self.apply(color.rgb2grayscale)
+
+    def gray2rgb(self) -> 'Pipeline':
+        """Appends color.grayscale2rgb."""
+        return self.apply(color.grayscale2rgb)
+
+    def sepia(self) -> 'Pipeline':
+        """Appends color.sepia."""
+        return self.apply(color.sepia)
+
+    def brightness(self, strength: float) -> 'Pipeline':
+        """Appends color.brightness."""
+        return self.apply(color.brightness, strength)
+
+    def invert(self) -> 'Pipeline':
+        """Appends color.invert."""
+        return self.apply(color.invert)
+
+    def contrast(self, strength: float) -> 'Pipeline':
+        """Appends color.contrast."""
+        return self.apply(color.contrast, strength)
+
+    def saturation(self, strength: float) -> 'Pipeline':
+        """Appends color.saturation."""
+        return self.apply(color.saturation, strength)
+
+    def flipv(self) -> 'Pipeline':
+        """Appends transform.flipv."""
+        return self.apply(transform.flipv)
+
+    def fliph(self) -> 'Pipeline':
+        """Appends transform.fliph."""
+        return self.apply(transform.fliph)
+
+    def rotate90(self, times: int = 1) -> 'Pipeline':
+        """Appends transform.rotate90."""
+        return self.apply(transform.rotate90, times)
+
+    def transpose(self) -> 'Pipeline':
+        """Appends transform.transpose."""
+        return self.apply(transform.transpose)
+
+    def orient(self, orientation: int) -> 'Pipeline':
+        """Appends transform.orient."""
+        return self.apply(transform.orient, orientation)
+
+    def rotate(self, angle: float = 45, expand=True, interpolation: str = 'nearest') -> 'Pipeline':
+        """Appends transform.rotate."""
+        return self.apply(transform.rotate, angle, expand, interpolation)
+
+    def scale(self, factor: float, interpolation: str = 'nearest') -> 'Pipeline':
+        """Appends transform.scale."""
+        return self.apply(transform.scale, factor, interpolation)
+
+    def shear(self, shear_x: float, shear_y: float, expand=True, interpolation: str = 'nearest') -> 'Pipeline':
+        """Appends transform.shear."""
+        return self.apply(transform.shear, shear_x, shear_y, expand, interpolation)
+
+    def boxblur(self, radius: int = 1) -> 'Pipeline':
+        """Appends filters.boxblur."""
+        return self.apply(filters.boxblur, radius)
+
+    def outline(self) -> 'Pipeline':
+        """Appends filters.outline."""
+        return self.apply(filters.outline)
+
+    def sharpen(self, strength: float = 5.0) -> 'Pipeline':
+        """Appends filters.sharpen."""
+        return self.apply(filters.sharpen, strength)
+
+    def motionblur(self) -> 'Pipeline':
+        """Appends filters.motion_blur."""
+        return self.apply(filters.motion_blur)
+
+    def emboss(self, direction: str, strength: int = 1) -> 'Pipeline':
+        """Appends filters.emboss."""
+        return self.apply(filters.emboss, direction, strength)
+
+    def gaussian(self, radius: int = 1, sig: float = 1.) -> 'Pipeline':
+        """Appends filters.gaussian_blur."""
+        return self.apply(filters.gaussian_blur, radius, sig)
+
+    def fastgaussian(self, sig: float = 1.) -> 'Pipeline':
+        """Appends filters.fast_gaussian_blur."""
+        return self.apply(filters.fast_gaussian_blur, sig)
+
+    def convolve(self, kern: np.ndarray, bias: float = 0.0) -> 'Pipeline':
+        """Appends filters.convolve."""
+        return self.apply(filters.convolve, kern, bias)
+
+    def optimize(self, unclamped: bool = False) -> list[tuple[Callable, list]]:
+        """Returns the operations which will actually be applied by compute.
+
+        Args:
+            unclamped: If true, combines every run of adjacent linear filters, skipping the clamp between them.
+                This is faster but the output may differ from applying each filter in turn.
+        """
+        return optimize(self._ops, unclamped)
+
+    def plan(self, unclamped: bool = False) -> str:
+        """Describes the optimized operations, one numbered line per operation.
+
+        Args:
+            unclamped: If true, describes the plan used by compute when it is invoked with unclamped.
+        """
+        ops = self.optimize(unclamped)
+        if not ops:
+            return '(no operations)'
+        return '\n'.join(f'{index}. {_describe(command, args)}' for index, (command, args) in enumerate(ops, 1))
+
+    def compute(self, unclamped: bool = False, pool: buffers.BufferPool = None) -> np.ndarray:
+        """Optimizes the recorded operations then applies them to the image.
+
+        Args:
+            unclamped: If true, combines every run of adjacent linear filters, skipping the clamp between them.
+                This is faster but the output may differ from applying each filter in turn.
+            pool: A pool to take the intermediate images and the result from, see apply.
+
+        Returns:
+            A new ndarray holding the result, the source image is never modified.
+        """
+        ops = self.optimize(unclamped)
+        if not ops:
+            # return copy because method specifies a new ndarray is returned.
+            return self._img.copy()
+
+        return apply(self._img, ops, pool)
+
+
+def optimize(ops: list[tuple[Callable, list]], unclamped: bool = False) -> list[tuple[Callable, list]]:
+    """Rewrites a sequence of operations into an equivalent sequence which is cheaper to apply.
+    Operations which do nothing are removed, consecutive quarter turns and flips are merged,
+    and runs of transformations, filters and color modifications are each combined into a single pass.
+
+    Args:
+        ops: The operations to perform in order, each is a function and the arguments to invoke it with after the image.
+        unclamped: If true, combines every run of adjacent linear filters, skipping the clamp between them.
+
+    Returns:
+        A new list of operations.
+    """
+    ops = _remove_noops(_merge_quarter_turns(_remove_noops(ops)))
+    return color.fuse(filters.fuse(transform.fuse(ops), unclamped=unclamped))
+
+
+def apply(img: np.ndarray, ops: list[tuple[Callable, list]], pool: buffers.BufferPool = None) -> np.ndarray:
+    """Applies operations which have already been optimized, each is recorded as a stage while profiling.
+
+    With a pool every image and scratch buffer the operations allocate is taken from it, and each intermediate image
+    is given back as soon as the next operation has read it. A chain of operations on images of the same size then
+    swaps between the same few buffers, and once the pool has warmed up applying it again allocates nothing.
+    The result is also taken from the pool, give it back with pool.release once it is no longer needed.
+
+    Args:
+        img: The source image.
+        ops: The operations to perform in order, as returned by optimize.
+        pool: The pool to take memory from, defaults to allocating as usual.
+
+    Returns:
+        The result of the final operation, or the source image if there are no operations.
+    """
+    source = img
+    with pool if pool is not None else contextlib.nullcontext():
+        for command, args in ops:
+            if profiling.active():
+                result = profiling.run(_describe(command, args), command, img, *args)
+            else:
+                result = command(img, *args)
+            if pool is not None and img is not source and not np.may_share_memory(result, img):
+                pool.release(img)
+            img = result
+    return img
+
+
+def _remove_noops(ops: list[tuple[Callable, list]]) -> list[tuple[Callable, list]]:
+    """Drops every operation whose arguments mean it returns a copy of the image.
+    """
+    return [(command, args) for command, args in ops if not (command in _NOOPS and _NOOPS[command](*args))]
+
+
+def _merge_quarter_turns(ops: list[tuple[Callable, list]]) -> list[tuple[Callable, list]]:
+    """Merges adjacent rotate90 operations into one and cancels adjacent pairs of identical flips.
+    """
+    merged = []
+    for command, args in ops:
+        if merged and command is transform.rotate90 and merged[-1][0] is transform.rotate90:
+            # quarter turns add up, rotate90 ignores negative counts so normalize each before adding.
+            merged[-1] = (transform.rotate90, [(_quarter_turns(*merged[-1][1]) + _quarter_turns(*args)) % 4])
+        elif merged and command in (transform.flipv, transform.fliph) and merged[-1][0] is command:
+            merged.pop()
+        else:
+            merged.append((command, args))
+    return merged
+
+
+def _quarter_turns(times: int = 1) -> int:
+    """Returns the number of quarter turns rotate90 actually performs for the given count.
+    """
+    return max(0, times) % 4
+
+
+def _describe(command: Callable, args: list) -> str:
+    """Formats an operation as a call, listing the operations which were combined into it.
+    """
+    if command in (color.apply_pointwise, color.apply_matrices, transform.apply_affines):
+        return f'{command.__name__}[{", ".join(_describe(*op) for op in args[0])}]'
+    return f'{command.__name__}({", ".join(_describe_arg(arg) for arg in args)})'
+
+
+def _describe_arg(arg) -> str:
+    """Formats an argument of an operation, summarizing arrays by their shape.
+    """
+    if isinstance(arg, np.ndarray):
+        return f'<{"x".join(str(size) for size in arg.shape)} kernel>'
+    return repr(arg)
+
+
+# operations mapped to a function which returns true if the arguments mean the operation has no effect.
+_NOOPS = {
+    transform.rotate90: lambda times=1: _quarter_turns(times) == 0,
+    transform.orient: lambda orientation: orientation == 1,
+    transform.rotate: lambda angle=45, expand=True, interpolation='nearest': angle % 360 == 0,
+    transform.scale: lambda factor, interpolation='nearest': factor == 1,
+    transform.shear: lambda shear_x, shear_y, expand=True, interpolation='nearest': shear_x == 0 and shear_y == 0,
+    color.brightness: lambda strength: strength == 1,
+    color.contrast: lambda strength: strength == 1,
+    color.saturation: lambda strength: strength == 1,
+    filters.sharpen: lambda strength=5.0: strength == 0,
+}
@@ -0,0 +1,155 @@
+"""Optional profiling of the stages of processing an image.
+While a Profile is active every stage run through run is recorded with its wall time, cpu time, the memory it
+allocated, the shapes of its input and output and the engines which did the work, as noted by the library with engine.
+When no profile is active run only invokes the function and engine returns immediately, so the hooks cost
+next to nothing.
+
+Example:
+    with profiling.Profile() as profile:
+        img = profiling.run('open', io_utils.open, 'example.png')
+        img = pipeline.Pipeline(img).gaussian(3, 1.5).compute()
+    print(profile.table())
+"""
+import contextvars
+import json
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+# the active profile of the current context, None while profiling is disabled.
+_profile = contextvars.ContextVar('bpimage_profile', default=None)
+
+# tracing is shared by the whole process, so it is started for the first active profile and stopped after the last.
+_tracing_lock = threading.Lock()
+_tracing_profiles = 0
+_started_tracing = False
+
+
+class Profile:
+    """Records every stage run on the current thread while it is active, use as a context manager.
+    Allocations are measured with tracemalloc, which is started while any profile is active if it isn't already
+    tracing. Tracing covers the whole process, so profiles active on several threads at once see each other's
+    allocations.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._open = []
+        self._token = None
+
+    def __enter__(self) -> 'Profile':
+        global _tracing_profiles, _started_tracing
+        self._token = _profile.set(self)
+        with _tracing_lock:
+            if _tracing_profiles == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracing = True
+            _tracing_profiles += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        global _tracing_profiles, _started_tracing
+        _profile.reset(self._token)
+        self._token = None
+        with _tracing_lock:
+            _tracing_profiles -= 1
+            if _tracing_profiles == 0 and _started_tracing:
+                tracemalloc.stop()
+                _started_tracing = False
+
+    def table(self) -> str:
+        """Formats the stages as a table, one line per stage followed by the total.
+        Stages run inside another stage are indented beneath it and not counted again in the total.
+        """
+        lines = [f'{"stage":<40}{"wall ms":>10}{"cpu ms":>10}{"alloc MB":>10}  {"input":<16}{"output":<16}engine']
+        for stage in self.stages:
+            name = '  ' * stage['depth'] + stage['stage']
+            lines.append(f'{_truncate(name, 39):<40}{stage["wall_s"] * 1e3:>10.2f}{stage["cpu_s"] * 1e3:>10.2f}'
+                         f'{stage["alloc_bytes"] / 2**20:>10.2f}  {_format_shape(stage["input_shape"]):<16}'
+                         f'{_format_shape(stage["output_shape"]):<16}{", ".join(stage["engines"])}')
+        outer = [stage for stage in self.stages if stage['depth'] == 0]
+        lines.append(f'{"total":<40}{sum(stage["wall_s"] for stage in outer) * 1e3:>10.2f}'
+                     f'{sum(stage["cpu_s"] for stage in outer) * 1e3:>10.2f}')
+        return '\n'.join(lines)
+
+    def json_lines(self) -> str:
+        """Formats the stages as JSON, one object per line.
+        """
+        return '\n'.join(json.dumps(stage) for stage in self.stages)
+
+
+def active() -> bool:
+    """Returns true if a profile is recording on the current thread.
+    """
+    return _profile.get() is not None
+
+
+def run(name: str, func: Callable, *args):
+    """Invokes the function with the arguments, recording it as a stage if a profile is active.
+
+    Args:
+        name: The name of the stage.
+        func: The function to invoke.
+        args: The arguments to invoke the function with, if the first is an image its shape is recorded.
+
+    Returns:
+        The result of the function.
+    """
+    profile = _profile.get()
+    if profile is None:
+        return func(*args)
+
+    stage = {'stage': name, 'depth': len(profile._open), 'wall_s': 0.0, 'cpu_s': 0.0, 'alloc_bytes': 0,
+             'input_shape': _shape(args[0]) if args else None, 'output_shape': None, 'engines': []}
+    profile.stages.append(stage)
+    start_memory, peak_memory = tracemalloc.get_traced_memory()
+    # each stage resets the peak, so open stages keep the highest peak seen before the stages inside them.
+    if profile._open:
+        profile._open[-1][1] = max(profile._open[-1][1], peak_memory)
+    profile._open.append([stage, start_memory])
+    tracemalloc.reset_peak()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        result = func(*args)
+    finally:
+        stage['wall_s'] = time.perf_counter() - start_wall
+        stage['cpu_s'] = time.process_time() - start_cpu
+        _, peak_memory = profile._open.pop()
+        peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+        stage['alloc_bytes'] = peak_memory - start_memory
+        if profile._open:
+            profile._open[-1][1] = max(profile._open[-1][1], peak_memory)
+    stage['output_shape'] = _shape(result)
+    return result
+
+
+def engine(name: str, detail=None):
+    """Notes the engine which does the work of the current stage, does nothing unless a profile is active.
+
+    Args:
+        name: The name of the engine, usually the c function invoked.
+        detail: Optional value appended to the name, such as the interpolation. Only formatted while profiling.
+    """
+    profile = _profile.get()
+    if profile is not None and profile._open:
+        if detail is not None:
+            name = f'{name} {detail}'
+        engines = profile._open[-1][0]['engines']
+        if name not in engines:
+            engines.append(name)
+
+
+def _shape(value) -> list[int] | None:
+    """Returns the shape of the value if it is an image.
+    """
+    shape = getattr(value, 'shape', None)
+    return list(shape) if shape is not None else None
+
+
+def _format_shape(shape: list[int] | None) -> str:
+    return 'x'.join(map(str, shape)) if shape is not None else '-'
+
+
+def _truncate(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length - 3] + '...'
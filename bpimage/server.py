@@ -0,0 +1,381 @@
+"""Server for bpimage library.
+Keeps the library loaded in a pool of worker processes and accepts jobs over HTTP, either on a localhost port
+or on a Unix domain socket, so each edit only pays for the work itself rather than for starting python.
+
+Jobs are posted to /jobs as a JSON object:
+ - source: the path of the source image, or data: the bytes of the source image file encoded as base64.
+ - args: the edits as command line arguments, exactly as they would be passed to main.py,
+   or ops: a list of [command, [arguments]] pairs applied in order, where command is one of the commands of main.py.
+ - interpolation and fast: optional, apply to ops in the same way as the -i and --fast arguments of main.py.
+ - dest: the path to save the result to, or format: the extension of the format to return the result in (default .png).
+
+Jobs which are saved respond with a JSON object describing the result, otherwise the response is the encoded image.
+With --cache, identical jobs are answered from the result cache without using a worker.
+Once every worker is busy and the queue is full new jobs are refused with 503, the caller should retry after a delay.
+
+The server has no authentication, anyone who can connect runs jobs as the user running the server. A job which names
+paths reads any image and writes to any file that user can, so by default the server only listens on a loopback address
+or a Unix domain socket, whose file permissions decide who may connect. --root confines source and dest to a directory,
+relative paths are relative to it. Listening on any other address needs --allow-remote, and without --root such a server
+refuses paths so remote callers can only send images as data.
+"""
+import base64
+import binascii
+import ipaddress
+import json
+import mimetypes
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+import buffers
+import io_utils
+import main
+import parallel
+import pipeline
+
+# largest request body accepted, large enough for the base64 of a big image.
+MAX_REQUEST_BYTES = 256 * 2**20
+
+# seconds a refused caller is asked to wait before retrying.
+RETRY_AFTER = 1
+
+# the buffer pool of each worker process, created by _init_worker.
+_pool = None
+
+
+class JobError(Exception):
+    """Raised when a job is invalid and can't be run"""
+    pass
+
+
+class _JobArgumentParser(ArgumentParser):
+    """Parser for the edits of a job, which raises rather than exiting so an invalid job doesn't stop the server.
+    """
+    def error(self, message):
+        raise JobError(message)
+
+
+class _Jobs:
+    """Runs jobs on a pool of worker processes, refusing jobs once the workers are busy and the queue is full.
+    """
+    def __init__(self, workers: int, queue_size: int, threads: int):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        # workers are started from a clean process, a forked worker would inherit the listening socket
+        # and keep accepting connections after the server stopped.
+        self._executor = ProcessPoolExecutor(workers, multiprocessing.get_context('forkserver'),
+                                             initializer=_init_worker, initargs=(threads,))
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.active = 0
+
+    def run(self, *job) -> bytes | None:
+        """Runs the job on a worker and waits for the result.
+
+        Raises:
+            _Busy: every worker was busy and the queue was full.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise _Busy()
+        with self._lock:
+            self.active += 1
+        try:
+            return self._executor.submit(_run_job, *job).result()
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class _Busy(Exception):
+    """Raised when a job is refused because the queue is full"""
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Handles the requests of a single connection.
+    """
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': f'Not found: \'{self.path}\''})
+            return
+        jobs = self.server.jobs
+        health = {'workers': jobs.workers, 'capacity': jobs.capacity, 'active': jobs.active}
+        if self.server.cache is not None:
+            health['cache'] = self.server.cache.stats()
+        self._send_json(HTTPStatus.OK, health)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': f'Not found: \'{self.path}\''})
+            return
+
+        # without a valid length the body can't be read safely, a negative one would read until the client closes.
+        if 'Content-Length' not in self.headers:
+            self._send_json(HTTPStatus.LENGTH_REQUIRED, {'error': 'Request must have a Content-Length header.'})
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_json(HTTPStatus.BAD_REQUEST, {'error': 'Content-Length must be a non-negative integer.'})
+            return
+        if length > MAX_REQUEST_BYTES:
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': f'Request is larger than {MAX_REQUEST_BYTES} bytes.'})
+            return
+
+        try:
+            source, data, ops, dest, extension = _parse_job(self.rfile.read(length))
+            source = _job_path(source, self.server.root, self.server.paths)
+            dest = _job_path(dest, self.server.root, self.server.paths)
+            data, cached = self._run(source, data, ops, dest, extension)
+        except _Busy:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'Every worker is busy, retry later.'},
+                            {'Retry-After': str(RETRY_AFTER)})
+            return
+        except (JobError, io_utils.ImageOpenError, io_utils.ImageSaveError, ValueError) as e:
+            self._send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'Unexpected error: {str(e)}'})
+            return
+
+        if dest is not None:
+            self._send_json(HTTPStatus.OK, {'dest': dest, 'cached': cached})
+            return
+        self._send(HTTPStatus.OK, data, mimetypes.guess_type(f'result{extension}')[0] or 'application/octet-stream',
+                   {'X-Cached': str(cached).lower()})
+
+    def _run(self, source: str | None, data: bytes | None, ops: list[tuple[Callable, list]], dest: str | None,
+             extension: str) -> tuple[bytes | None, bool]:
+        """Runs the job, through the cache if the server has one.
+        Returns the encoded result, or None if it was saved to the destination, and whether it came from the cache.
+        """
+        result_cache = self.server.cache
+        if result_cache is None:
+            return self.server.jobs.run(source, data, ops, dest, extension), False
+
+        # the key needs the source bytes, which are then passed on so the worker doesn't read the file again.
+        if data is None:
+            data = io_utils.read(source)
+        if dest is not None:
+            extension = os.path.splitext(dest)[1]
+        result, cached = result_cache.get_or_compute(result_cache.key(data, ops, extension),
+                                                     lambda: self.server.jobs.run(None, data, ops, None, extension))
+        if dest is None:
+            return result, cached
+        io_utils.write(result, dest)
+        return None, cached
+
+    def address_string(self) -> str:
+        # connections over a unix socket have no address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send_json(self, status: HTTPStatus, body: dict, headers: dict = None):
+        self._send(status, json.dumps(body).encode(), 'application/json', headers)
+
+    def _send(self, status: HTTPStatus, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """HTTP server listening on a Unix domain socket rather than a port.
+    """
+    daemon_threads = True
+
+
+def _init_worker(threads: int):
+    """Configures each worker process before it receives any jobs.
+    """
+    global _pool
+    parallel.set_threads(threads)
+    _pool = buffers.BufferPool()
+
+
+def _run_job(source: str | None, data: bytes | None, ops: list[tuple[Callable, list]], dest: str | None,
+             extension: str) -> bytes | None:
+    """Applies the optimized operations to the source in a worker process.
+    Returns the encoded result, or None if it was saved to the destination.
+    """
+    img = pipeline.apply(io_utils.open(source) if source is not None else io_utils.decode(data), ops, _pool)
+    try:
+        if dest is not None:
+            io_utils.save(img, dest)
+            return None
+        return io_utils.encode(img, extension)
+    finally:
+        _pool.release(img)
+
+
+def _parse_job(body: bytes) -> tuple[str | None, bytes | None, list[tuple[Callable, list]], str | None, str]:
+    """Validates the body of a job request and returns the arguments for _run_job.
+
+    Raises:
+        JobError: the job was invalid.
+    """
+    try:
+        job = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise JobError(f'Job is not valid JSON: {str(e)}') from e
+    if not isinstance(job, dict):
+        raise JobError('Job must be a JSON object.')
+
+    if ('source' in job) == ('data' in job):
+        raise JobError('Job must have exactly one of source or data.')
+    source = job.get('source')
+    data = None
+    if 'data' in job:
+        try:
+            data = base64.b64decode(job['data'], validate=True)
+        except (TypeError, binascii.Error) as e:
+            raise JobError(f'Job data is not valid base64: {str(e)}') from e
+
+    if 'args' in job:
+        if not isinstance(job['args'], list) or not all(isinstance(arg, (str, int, float)) for arg in job['args']):
+            raise JobError(f'Job args must be a list of strings or numbers, not {json.dumps(job["args"])}.')
+        args = _OPS_PARSER.parse_args([_format_arg(arg) for arg in job['args']])
+        ops = main._get_ops(args)
+        fast = args.fast
+    else:
+        ops = []
+        for op in job.get('ops', []):
+            if not isinstance(op, list) or len(op) != 2 or not isinstance(op[1], list):
+                raise JobError(f'Each op must be a [command, [arguments]] pair, not {json.dumps(op)}.')
+            name, op_args = op
+            if name not in _COMMANDS:
+                raise JobError(f'Unknown command: \'{name}\'')
+            # parse each edit on its own so they are applied in the order given.
+            args = _OPS_PARSER.parse_args([f'--{name}', *map(_format_arg, op_args),
+                                           '-i', str(job.get('interpolation', 'nearest'))])
+            ops.extend(main._get_ops(args))
+        fast = bool(job.get('fast', False))
+
+    extension = job.get('format', '.png')
+    return source, data, pipeline.optimize(ops, unclamped=fast), job.get('dest'), extension
+
+
+def _job_path(path: str | None, root: str | None, allowed: bool) -> str | None:
+    """Resolves the source or dest path of a job. With a root directory, relative paths are relative to it
+    and the path, after following any symbolic links, has to lie within it.
+
+    Raises:
+        JobError: the server doesn't accept paths, or the path was outside of the root directory.
+    """
+    if path is None:
+        return None
+    if not allowed:
+        raise JobError('This server only accepts images as data, paths need --root.')
+    if not isinstance(path, str):
+        raise JobError(f'Paths must be strings, not {json.dumps(path)}.')
+    if root is None:
+        return path
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise JobError(f'Path \'{path}\' is outside of the root directory.')
+    return resolved
+
+
+def _is_loopback(host: str) -> bool:
+    """Returns true if every address the host name resolves to is a loopback address.
+    """
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (socket.gaierror, ValueError):
+        return False
+
+
+def _format_arg(arg) -> str:
+    """Formats an argument of an edit the way it would be typed on the command line.
+    """
+    return str(arg).lower() if isinstance(arg, bool) else str(arg)
+
+
+def _get_cli_args():
+    parser = ArgumentParser(description='Server for bpimage library. Keeps the library loaded and applies edits posted as jobs.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default:%(default)s)')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on (default:%(default)s)')
+    parser.add_argument('--socket', metavar='path', help='listen on a Unix domain socket at the path instead of a port')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='allow listening on an address other than loopback, anyone who can reach it can run jobs')
+    parser.add_argument('--root', metavar='directory',
+                        help='only read sources and write results within the directory, relative paths of jobs are relative to it')
+    parser.add_argument('-w', '--workers', type=main.positive_int, default=os.cpu_count() or 1, metavar='count',
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('-q', '--queue', type=int, default=16, metavar='count',
+                        help='number of jobs which may wait for a worker before new jobs are refused (default:%(default)s)')
+    parser.add_argument('-t', '--threads', type=main.positive_int, default=1, metavar='count',
+                        help='number of threads each worker uses to process an image (default:%(default)s)')
+    main.add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.socket and not args.allow_remote and not _is_loopback(args.host):
+        parser.error(f'argument --host: {args.host} is not a loopback address and the server has no authentication, '
+                     'pass --allow-remote to listen on it anyway')
+    if args.root and not os.path.isdir(args.root):
+        parser.error(f'argument --root: {args.root} is not a directory')
+    return args
+
+
+def _main():
+    args = _get_cli_args()
+    # stop cleanly when terminated, shutting down the workers and removing the socket.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if args.socket:
+        # a socket left behind by a previous server would stop the new one from binding.
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = _UnixHTTPServer(args.socket, _Handler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), _Handler)
+        address = f'http://{args.host}:{server.server_address[1]}'
+
+    server.jobs = _Jobs(args.workers, max(0, args.queue), args.threads)
+    server.root = os.path.realpath(args.root) if args.root else None
+    # remote callers may only name paths within a root directory.
+    server.paths = server.root is not None or not args.allow_remote
+    server.cache = main._get_cache(args)
+    print(f'listening on {address} with {args.workers} workers', file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.jobs.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+# parser for the edits of jobs, shared by every request as parsing doesn't modify it.
+_OPS_PARSER = _JobArgumentParser(prog='job', add_help=False, allow_abbrev=False)
+main.add_operation_arguments(_OPS_PARSER)
+
+# every command which may be named in the ops of a job.
+_COMMANDS = {command for group in main.ACTIONS.values() for command in group}
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(_main())
+    except KeyboardInterrupt:
+        sys.exit()
+    except Exception as e:
+        sys.exit(f'Unexpected exception: {str(e)}')
@@ -0,0 +1,272 @@
+"""Engine for applying operations to images which are too large to hold in memory.
+The image is processed a piece at a time and each finished piece is written straight to a memory mapped file,
+so the memory used is bounded by a budget rather than by the size of the image.
+
+Operations are grouped into stages, each stage reads its input once and writes its output once:
+ - color modifications and filters run on bands of full rows. Filters read a halo of extra rows above and below
+   each band, equal to the radius of their kernel, so the rows kept from each band match filtering the whole image.
+ - transformations run on square tiles of the result. The inverse matrix maps the corners of each tile back into the source
+   to find the window of source pixels the tile samples from, only that window is read.
+ - contrast depends on the mean of the whole image, so the histogram of its input is gathered in a pass of its own
+   and it is then applied as a lookup table like any other color modification.
+
+Intermediate results between stages are kept in raw .npy files. Sources in the .npy format are memory mapped,
+other formats are decoded by Pillow straight into a raw file of their own, and results are encoded from one,
+so neither has to fit in memory.
+"""
+import itertools
+import math
+import os
+import tempfile
+from typing import Callable
+import numpy as np
+import color
+import downscale
+import filters
+import io_utils
+import lut
+import pipeline
+import transform
+import validation
+
+# the default number of bytes the engine aims to stay within.
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+
+# bytes held for each byte of a band of rows, covering the band, the result of each filter and the scratch of the engines.
+ROW_WORKING_SET = 8
+
+# largest side length of the tiles used for transformations.
+MAX_TILE_SIZE = 4096
+# tiles smaller than this would spend more time mapping windows than sampling them.
+MIN_TILE_SIZE = 16
+
+
+def process(source: str | np.ndarray, ops: list[tuple[Callable, list]], dest: str, memory_budget: int = DEFAULT_MEMORY_BUDGET,
+            unclamped: bool = False, workdir: str = None, max_pixels: int = None):
+    """Optimizes the operations then applies them to the source piece by piece, writing the result to the destination.
+    The result matches computing a pipeline of the same operations, except that transformations may round differently
+    along the edges of their tiles.
+
+    Args:
+        source: The path of the source image, or an ndarray such as a memory mapped array with shape=(h,w), (h,w,3) or (h,w,4).
+        ops: The operations to perform in order, each is a function and the arguments to invoke it with after the image.
+        dest: The path to save the result to. A .npy destination is written incrementally, any other format is encoded
+            by Pillow from a memory mapped copy of the result.
+        memory_budget: The number of bytes the engine aims to stay within, on top of memory mapped pages.
+        unclamped: If true, combines every run of adjacent linear filters, skipping the clamp between them.
+        workdir: The directory to keep intermediate results in, defaults to the system temporary directory.
+        max_pixels: The largest source to decode, in place of Pillow's guard against decompression bombs, see open_into.
+
+    Raises:
+        ValueError: an operation can't be applied piece by piece, such as a filter which wraps around the image.
+        ValueError: memory_budget was too small to process a single band or tile.
+        ImageOpenError: the source could not be opened.
+        ImageSaveError: the result could not be saved.
+    """
+    stages = _plan(pipeline.optimize(ops, unclamped))
+    with tempfile.TemporaryDirectory(dir=workdir) as scratch:
+        def create_scratch(shape: tuple[int, ...], names=itertools.count()) -> np.ndarray:
+            path = os.path.join(scratch, f'pixels{next(names)}.npy')
+            return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+
+        # a strip being converted is held by Pillow, by its conversion and by numpy, leave room for all three.
+        strip_bytes = memory_budget // 4
+        img = source if isinstance(source, np.ndarray) else io_utils.open_into(source, create_scratch, strip_bytes, max_pixels)
+
+        for index, (kind, stage_ops) in enumerate(stages):
+            last = index == len(stages) - 1
+            if last and io_utils.is_raw(dest):
+                path = dest
+            else:
+                path = os.path.join(scratch, f'stage{index}.npy')
+
+            def create(shape: tuple[int, ...], path=path) -> np.ndarray:
+                return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+
+            if kind == 'mean':
+                # replace the modifications with the table they would apply to this image, then run them on bands.
+                histogram = _histogram(img, memory_budget)
+                table = color.pointwise_table(stage_ops[0][1][0], lambda: histogram)
+                kind, stage_ops = 'rows', [(color.apply_table, [table])] + stage_ops[1:]
+            if kind == 'rows':
+                result = _run_rows(img, stage_ops, create, memory_budget)
+            else:
+                result = _run_tiles(img, stage_ops, create, memory_budget)
+
+            result.flush()
+            img = np.load(path, mmap_mode='r')
+
+        if not io_utils.is_raw(dest):
+            io_utils.save_from(img, dest, create_scratch, strip_bytes)
+
+
+def _plan(ops: list[tuple[Callable, list]]) -> list[tuple[str, list[tuple[Callable, list]]]]:
+    """Groups the operations into stages which each make one pass over the image.
+    """
+    stages = []
+    for command, args in ops:
+        if transform.is_affine(command):
+            stages.append(('tiles', [(command, args)]))
+        elif color.needs_mean(command, args):
+            # the histogram pass reads the input of the modification, so it starts a stage.
+            modifications = args[0] if command is color.apply_pointwise else [(command, args)]
+            stages.append(('mean', [(color.apply_pointwise, [modifications])]))
+        elif stages and stages[-1][0] in ('rows', 'mean'):
+            _halo(command, args)
+            stages[-1][1].append((command, args))
+        else:
+            _halo(command, args)
+            stages.append(('rows', [(command, args)]))
+
+    # with nothing to apply the source is copied to the destination.
+    return stages or [('rows', [])]
+
+
+def _halo(command: Callable, args: list) -> int:
+    """Returns the number of rows above and below a pixel which the operation reads to produce it.
+
+    Raises:
+        ValueError: the operation can't be applied to bands of rows.
+    """
+    # color modifications and lookup tables only read the pixel they produce.
+    if color.is_modification(command) or command is lut.apply:
+        return 0
+
+    if (extent := filters.extent(command, args)) is None:
+        raise ValueError(f'Cannot process \'{command.__name__}\' in tiles.')
+    radius, mode = extent
+
+    # a band holds the rows near it, but wrapping would read rows from the opposite edge of the image.
+    if mode == 'wrap':
+        raise ValueError(f'Cannot process \'{command.__name__}\' in tiles with the wrap border mode.')
+    return radius
+
+
+def _histogram(img: np.ndarray, memory_budget: int) -> np.ndarray:
+    """Counts how many times each of the 256 values appears in the color channels of the image, reading it one band at a time.
+    """
+    hist = np.zeros(256, dtype=np.int64)
+    for start, end in _bands(img, 0, memory_budget):
+        hist += color.histogram(img[start:end])
+    return hist
+
+
+def _bands(img: np.ndarray, halo: int, memory_budget: int) -> list[tuple[int, int]]:
+    """Divides the rows of the image into bands which fit the budget along with their halo.
+
+    Raises:
+        ValueError: the budget could not fit a band of twice the halo.
+    """
+    row_bytes = img.size // max(1, img.shape[0]) * ROW_WORKING_SET
+    rows = memory_budget // max(1, row_bytes) - 2 * halo
+    # each band has to be at least as tall as the kernels reading it.
+    if rows < max(1, 2 * halo + 1):
+        raise ValueError(f'Memory budget of {memory_budget} bytes is too small for rows of {row_bytes} bytes '
+                         f'with a halo of {halo} rows.')
+    count = max(1, math.ceil(img.shape[0] / rows))
+    bounds = [(img.shape[0] * i) // count for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _run_rows(img: np.ndarray, ops: list[tuple[Callable, list]], create: Callable, memory_budget: int) -> np.ndarray:
+    """Applies the color modifications and filters to bands of rows, writing each band once it is finished.
+    """
+    # every filter reads its halo from the result of the filter before it, so the halos add up.
+    halo = sum(_halo(command, args) for command, args in ops)
+    dest = None
+    for start, end in _bands(img, halo, memory_budget):
+        top = max(0, start - halo)
+        band = np.ascontiguousarray(img[top:min(img.shape[0], end + halo)])
+        for command, args in ops:
+            band = command(band, *args)
+
+        # the rows near the edges of the band read the border, keep only the rows which saw a full halo.
+        if dest is None:
+            dest = create((img.shape[0], *band.shape[1:]))
+        dest[start:end] = band[start - top:end - top]
+    return dest
+
+
+def _run_tiles(img: np.ndarray, ops: list[tuple[Callable, list]], create: Callable, memory_budget: int) -> np.ndarray:
+    """Applies a transformation to square tiles of the result, reading only the window of the source each tile samples.
+    """
+    channels = validation.pixels(img).shape[2]
+    command, args = ops[0]
+    tform, shape, interpolation = transform.compose(img.shape, args[0] if command is transform.apply_affines else ops)
+    dest = create((*shape, *img.shape[2:]))
+
+    # whole factor reductions average exact blocks, so each window has to start on a block.
+    # other reductions sample a mipmap level, windows start on a pixel of the level so the levels match the whole image.
+    factors = downscale.whole_factors(tform)
+    if factors is not None:
+        align, margin = factors, (0, 0)
+    else:
+        step = 2 ** downscale.level_for(tform)
+        # interpolation reads up to two pixels beyond the one sampled, with one more for rounding.
+        align, margin = (step, step), (3 * step, 3 * step)
+
+    size = _tile_size(tform, channels, align, margin, factors is not None, memory_budget)
+    for top in range(0, shape[0], size):
+        for left in range(0, shape[1], size):
+            bottom, right = min(shape[0], top + size), min(shape[1], left + size)
+            window = _source_window(tform, img.shape, (top, left, bottom, right), align, margin, factors is not None)
+            tile = dest[top:bottom, left:right]
+            if window is None:
+                tile[:] = 0
+                continue
+
+            # move the origin of the matrix to the corner of the tile in the result and the corner of the window in the source.
+            (y0, x0, y1, x1) = window
+            tile_tform = (np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]]) @ tform
+                          @ np.array([[1, 0, left], [0, 1, top], [0, 0, 1]]))
+            transform.resample(img[y0:y1, x0:x1], tile_tform, tile, interpolation)
+    return dest
+
+
+def _window_bounds(tform: np.ndarray, tile: tuple[int, int, int, int], align: tuple[int, int], margin: tuple[int, int],
+                   exact: bool) -> tuple[int, int, int, int]:
+    """Returns the rows and columns (top, left, bottom, right) the tile samples from, which may lie beyond the source.
+    """
+    top, left, bottom, right = tile
+    if exact:
+        # whole factor reductions read exactly the blocks of the tile.
+        return top * align[0], left * align[1], bottom * align[0], right * align[1]
+
+    corners = np.array([[left, right, left, right], [top, top, bottom, bottom], [1, 1, 1, 1]], dtype=np.float64)
+    xs, ys, _ = tform @ corners
+    return (math.floor((ys.min() - margin[0]) / align[0]) * align[0],
+            math.floor((xs.min() - margin[1]) / align[1]) * align[1],
+            math.ceil((ys.max() + margin[0]) / align[0]) * align[0],
+            math.ceil((xs.max() + margin[1]) / align[1]) * align[1])
+
+
+def _source_window(tform: np.ndarray, shape: tuple[int, ...], tile: tuple[int, int, int, int], align: tuple[int, int],
+                   margin: tuple[int, int], exact: bool) -> tuple[int, int, int, int] | None:
+    """Returns the rows and columns (top, left, bottom, right) of the source the tile samples from,
+    or None if the tile lies entirely outside of the source.
+    """
+    window = _window_bounds(tform, tile, align, margin, exact)
+    y0, x0 = max(0, window[0]), max(0, window[1])
+    y1, x1 = min(shape[0], window[2]), min(shape[1], window[3])
+    if y1 <= y0 or x1 <= x0:
+        return None
+    return y0, x0, y1, x1
+
+
+def _tile_size(tform: np.ndarray, channels: int, align: tuple[int, int], margin: tuple[int, int], exact: bool,
+               memory_budget: int) -> int:
+    """Returns the largest tile size whose tile and source window fit the budget.
+
+    Raises:
+        ValueError: the budget could not fit the smallest tile.
+    """
+    size = MAX_TILE_SIZE
+    while size >= MIN_TILE_SIZE:
+        # windows only move with the tile, so every window is the same size before it is clipped to the source.
+        y0, x0, y1, x1 = _window_bounds(tform, (0, 0, size, size), align, margin, exact)
+        window_bytes = (y1 - y0) * (x1 - x0) * channels
+        # the window may be copied to make it contiguous and reduced into a mipmap level a third of its size.
+        if 2 * window_bytes + size * size * channels <= memory_budget:
+            return size
+        size //= 2
+    raise ValueError(f'Memory budget of {memory_budget} bytes is too small for a tile of {MIN_TILE_SIZE} pixels.')
@@ -2,96 +2,403 @@
 """
 import ctypes
 import math
+from typing import Callable
 import numpy as np
+import buffers
+import clib
+import downscale
+import parallel
+import profiling
+import validation
+
+# declare the affine function written in c so we can invoke it, the library is loaded on first use.
+clib.declare('affine_transform', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                        ctypes.POINTER(np.ctypeslib.c_intp),
+                                        ctypes.POINTER(np.ctypeslib.c_intp),
+                                        np.ctypeslib.ndpointer(
+                                            np.float32, ndim=2, flags='C_CONTIGUOUS'),
+                                        np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                        ctypes.POINTER(np.ctypeslib.c_intp),
+                                        ctypes.POINTER(np.ctypeslib.c_intp),
+                                        ctypes.c_int,
+                                        ctypes.c_int,
+                                        ctypes.c_size_t,
+                                        ctypes.c_size_t])
+clib.declare('affine_resample_axis', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                            ctypes.POINTER(np.ctypeslib.c_intp),
+                                            ctypes.POINTER(np.ctypeslib.c_intp),
+                                            np.ctypeslib.ndpointer(np.float32, ndim=2, flags='C_CONTIGUOUS'),
+                                            np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                            ctypes.POINTER(np.ctypeslib.c_intp),
+                                            ctypes.POINTER(np.ctypeslib.c_intp),
+                                            ctypes.c_int,
+                                            ctypes.c_int,
+                                            np.ctypeslib.ndpointer(np.int32, ndim=1, flags='C_CONTIGUOUS'),
+                                            np.ctypeslib.ndpointer(np.int16, ndim=2, flags='C_CONTIGUOUS'),
+                                            np.ctypeslib.ndpointer(np.int16, ndim=2, flags='C_CONTIGUOUS'),
+                                            ctypes.c_size_t,
+                                            ctypes.c_size_t])
+clib.declare('orient_copy', None, [np.ctypeslib.ndpointer(np.uint8, ndim=3),
+                                   ctypes.POINTER(np.ctypeslib.c_intp),
+                                   ctypes.POINTER(np.ctypeslib.c_intp),
+                                   np.ctypeslib.ndpointer(np.uint8, ndim=3, flags='C_CONTIGUOUS'),
+                                   ctypes.c_size_t,
+                                   ctypes.c_size_t])
+
+# supported strategies for sampling the source image between pixels, mapped to the constant the c library uses.
+# ordered from fastest to highest quality.
+INTERPOLATIONS = {
+    'nearest': 0,
+    'bilinear': 1,
+    'bicubic': 2
+}
+
+# the name of each interpolation constant, for describing the engine used.
+_SAMPLING_NAMES = {value: name for name, value in INTERPOLATIONS.items()}
+
+
+def flipv(img: np.ndarray, view=False, out: np.ndarray = None) -> np.ndarray:
+    """Flips the image across the vertical, from left to right.
 
-# load the affine function written in c and configure so we can invoke it.
-bp_clib = ctypes.cdll.LoadLibrary('./bpimage.so')
-bp_clib.affine_transform.restype = None
-bp_clib.affine_transform.argtypes = [np.ctypeslib.ndpointer(np.uint8, ndim=3),
-                                     ctypes.POINTER(np.ctypeslib.c_intp),
-                                     ctypes.POINTER(np.ctypeslib.c_intp),
-                                     np.ctypeslib.ndpointer(
-                                         np.float32, ndim=2),
-                                     np.ctypeslib.ndpointer(np.uint8, ndim=3),
-                                     ctypes.POINTER(np.ctypeslib.c_intp),
-                                     ctypes.POINTER(np.ctypeslib.c_intp)]
+    Args:
+        img: The source image with shape=(h,w,c) or shape=(h,w).
+        view: If true, returns a view of the source rather than copying it, see orient for the guarantees of each mode.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
+    Returns:
+        An ndarray with dtype=uint8 and the same shape as the source.
+
+    Raises:
+        ValueError: out was not a valid destination for the result.
+    """
+    return _reorient(img[:, ::-1], view, out)
 
-def flipv(img: np.ndarray) -> np.ndarray:
-    """Flips the image across the vertical, from left to right.
+
+def fliph(img: np.ndarray, view=False, out: np.ndarray = None) -> np.ndarray:
+    """Flips the image across the horizontal, from bottom to top.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image with shape=(h,w,c) or shape=(h,w).
+        view: If true, returns a view of the source rather than copying it, see orient for the guarantees of each mode.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        An ndarray with dtype=uint8 and the same shape as the source.
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: out was not a valid destination for the result.
     """
-    dest = np.empty(img.shape, dtype=np.uint8)
+    return _reorient(img[::-1], view, out)
 
-    # create matrix which flips at the origin then slides it back "in frame"
-    tform = _inverse_transform(scale_x=-1, offset_x=img.shape[1]-1)
-    
-    return _affine_transformation(img, tform, dest)
 
-
-def fliph(img: np.ndarray) -> np.ndarray:
-    """Flips the image across the horizontal, from bottom to top.
+def rotate90(img: np.ndarray, times: int = 1, view=False, out: np.ndarray = None) -> np.ndarray:
+    """Rotates the image counter-clockwise 90 degrees around the center.
 
     Args:
-        img: The source RGB image with shape=(h,w,3).
+        img: The source image with shape=(h,w,c) or shape=(h,w).
+        times: The number of times that the image should be rotated 90 degrees.
+        view: If true, returns a view of the source rather than copying it, see orient for the guarantees of each mode.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        An ndarray with dtype=uint8 and shape=(w,h,c) for an odd number of turns, otherwise shape=(h,w,c).
 
     Raises:
-        ValueError: img was not RGB.
+        ValueError: out was not a valid destination for the result.
     """
-    dest = np.empty(img.shape, dtype=np.uint8)
+    return _reorient(np.rot90(img, max(0, times) % 4), view, out)
 
-    # create matrix which flips at the origin then slides it back "in frame"
-    tform = _inverse_transform(scale_y=-1, offset_y=img.shape[0] - 1)
 
-    return _affine_transformation(img, tform, dest)
+def transpose(img: np.ndarray, view=False, out: np.ndarray = None) -> np.ndarray:
+    """Swaps the rows and columns of the image, mirroring it across the diagonal from the top left corner.
 
+    Args:
+        img: The source image with shape=(h,w,c) or shape=(h,w).
+        view: If true, returns a view of the source rather than copying it, see orient for the guarantees of each mode.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
-def rotate90(img: np.ndarray, times: int = 1) -> np.ndarray:
-    """Rotates the image counter-clockwise 90 degrees around the center.
+    Returns:
+        An ndarray with dtype=uint8 and shape=(w,h,c).
+
+    Raises:
+        ValueError: out was not a valid destination for the result.
+    """
+    return _reorient(np.swapaxes(img, 0, 1), view, out)
+
+
+def orient(img: np.ndarray, orientation: int, view=False, out: np.ndarray = None) -> np.ndarray:
+    """Rotates and flips the image so it is upright, given the orientation recorded in its EXIF metadata.
+
+    Two modes are supported. By default the result is a new C contiguous ndarray which owns its memory, the pixels are
+    copied in a single pass which copies whole rows where the orientation keeps them intact and copies in cache sized
+    tiles otherwise. If view is true no pixels are copied, the result is a view of the source with negative or swapped
+    strides. A view shares memory with the source, so writing to either modifies both, and it is not contiguous unless
+    the orientation is 1. Operations which need contiguous input will copy a view when they are applied to it.
 
     Args:
-        img: The source RGB image with shape=(h,w,3). 
-        times: The number of times that the image should be rotated 90 degrees.
+        img: The source image with shape=(h,w,c) or shape=(h,w).
+        orientation: The EXIF orientation tag between 1 and 8, where 1 is already upright.
+        view: If true, returns a view of the source rather than copying it.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        An ndarray with dtype=uint8, shape=(w,h,c) if the orientation is 5 to 8 otherwise shape=(h,w,c).
+
+    Raises:
+        ValueError: orientation was not between 1 and 8.
+        ValueError: out was not a valid destination for the result.
     """
-    times = max(0, times) % 4
-    # No need to do anything if the number of rotations brings us back to the original image.
-    if times == 0:
-        # return copy because method specifies a new ndarray is returned.
-        return img.copy()
-    # Handle 180 degree rotations
-    if times == 2:
-        return flipv(fliph(img))
-    # Handle 270 degree rotations
-    if times == 3:
-        return flipv(np.transpose(img, axes=(1, 0, 2)))
-    # Handle just 90
-    return np.transpose(flipv(img), axes=(1, 0, 2))
+    if orientation not in _ORIENTATIONS:
+        raise ValueError(f'Unknown orientation: {orientation}')
+    oriented = img
+    for command, args in _ORIENTATIONS[orientation]:
+        oriented = command(oriented, *args, view=True)
+    return _reorient(oriented, view, out)
 
 
-def rotate(img: np.ndarray, angle: float = 45, expand=True) -> np.ndarray:
+def rotate(img: np.ndarray, angle: float = 45, expand=True, interpolation: str = 'nearest', out: np.ndarray = None) -> np.ndarray:
     """Rotates the image counter-clockwise by a specified angle around the center
 
     Args:
-        img: The source RGB image with shape=(h,w,3). 
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
         angle: The amount to rotate in degrees. 
         expand: If true, expands the dimensions of resulting image so it's large enough to hold the entire rotated image. 
+        interpolation: How to sample between source pixels, one of 'nearest', 'bilinear' or 'bicubic'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the channels of img.
+
+    Raises:
+        ValueError: interpolation was not supported.
+        ValueError: out was not a valid destination for the result.
+    """
+    tform, (height, width) = _rotate_transform(img.shape, angle, expand)
+    dest = validation.output(out, (height, width, *img.shape[2:]), img)
+
+    return _affine_transformation(img, tform, dest, interpolation)
+
+
+def scale(img: np.ndarray, scale: float, interpolation: str = 'nearest', pyramid: downscale.Pyramid = None, out: np.ndarray = None) -> np.ndarray:
+    """Re-sizes the image uniformly based on a scale factor.
+    Reductions average the source pixels rather than sampling them. Whole factors (1/2, 1/3, ...) average
+    each block of pixels directly, other reductions by half or more resample a mipmap level of the image
+    with at least bilinear interpolation.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        scale: Non-zero positive number multiplied by the width and height of the image
+            to determine the dimensions of the resulting image.  
+        interpolation: How to sample between source pixels, one of 'nearest', 'bilinear' or 'bicubic'.
+        pyramid: A pyramid of the image to take mipmap levels from, so reducing the same image to several sizes
+            only builds each level once. Defaults to building the levels needed for this reduction.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8, shape=(h * scale,w * scale) and the channels of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: scale was less than or equal than zero.
+        ValueError: interpolation was not supported.
+        ValueError: out was not a valid destination for the result.
+    """
+    tform, (height, width) = _scale_transform(img.shape, scale)
+    dest = validation.output(out, (height, width, *img.shape[2:]), img)
+
+    return _affine_transformation(img, tform, dest, interpolation, pyramid)
+
+
+def shear(img: np.ndarray, shear_x: float, shear_y: float, expand=True, interpolation: str = 'nearest', out: np.ndarray = None) -> np.ndarray:
+    """Shears the image in the specified dimension(s)
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        shear_x: The amount to shear the image in the x axis (0.0 does nothing)
+        shear_y: The amount to shear the image in the y axis (0.0 does nothing)
+        expand: If true, expands the dimensions of resulting image so it's large enough to hold the entire skewed image. 
+        interpolation: How to sample between source pixels, one of 'nearest', 'bilinear' or 'bicubic'.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the channels of img.
+
+    Raises:
+        ValueError: interpolation was not supported.
+        ValueError: out was not a valid destination for the result.
+    """
+    tform, (height, width) = _shear_transform(img.shape, shear_x, shear_y, expand)
+    dest = validation.output(out, (height, width, *img.shape[2:]), img)
+
+    return _affine_transformation(img, tform, dest, interpolation)
+
+
+def apply_affines(img: np.ndarray, ops: list[tuple[Callable, list]], out: np.ndarray = None) -> np.ndarray:
+    """Applies a sequence of transformations (flipv, fliph, rotate90, transpose, orient, rotate, scale and shear) by multiplying
+    their inverse matrices into one, so the image is only resampled once.
+    The size of the result matches applying each transformation in turn, because each transformation
+    determines its canvas from the size of the image produced by the previous one.
+    The single resample uses the highest quality interpolation requested by any of the transformations,
+    and reductions average the source the same way scale does.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        ops: The transformations to apply in order, each is a function and the arguments to invoke it with after the image.
+        out: The array to write the result to, see validation.output. Defaults to a new array.
+
+    Returns:
+        A new ndarray, or out if provided, with dtype=uint8 and the channels of img.
+
+    Raises:
+        ValueError: img was not grayscale, RGB or RGBA.
+        ValueError: ops contained a function which is not an affine transformation.
+        ValueError: out was not a valid destination for the result.
+    """
+    tform, shape, interpolation = compose(img.shape, ops)
+    dest = validation.output(out, (*shape, *img.shape[2:]), img)
+    return _affine_transformation(img, tform.astype(np.float32), dest, interpolation)
+
+
+def fuse(ops: list[tuple[Callable, list]]) -> list[tuple[Callable, list]]:
+    """Combines runs of adjacent transformations into a single invocation of apply_affines, so the image is only resampled once.
+    Each transformation rounds to the nearest source pixel, so the combined result is sharper than applying each in turn
+    and may differ from it along edges. A transformation which crops the image (rotate or shear without expand) ends a run,
+    otherwise the combined matrix would bring the cropped pixels back into view.
+
+    Args:
+        ops: The operations to perform in order, each is a function and the arguments to invoke it with after the image.
+
+    Returns:
+        A new list of operations with runs of transformations replaced.
+    """
+    fused = []
+    run = []
+    for command, args in ops + [(None, [])]:
+        if command in _AFFINE:
+            run.append((command, args))
+            if not _crops(command, args):
+                continue
+            command = None
+        if len(run) > 1:
+            fused.append((apply_affines, [run]))
+        else:
+            fused.extend(run)
+        run = []
+        if command is not None:
+            fused.append((command, args))
+    return fused
+
+
+def is_affine(command: Callable) -> bool:
+    """Returns true if the operation is a transformation which compose accepts, or a combination of them.
+    """
+    return command in _AFFINE or command is apply_affines
+
+
+def compose(shape: tuple[int, int], ops: list[tuple[Callable, list]]) -> tuple[np.ndarray, tuple[int, int], str]:
+    """Multiplies the inverse matrices of a sequence of transformations into one, in double precision, see resample.
+
+    Args:
+        shape: The shape of the image the transformations are applied to.
+        ops: The transformations to apply in order, each is a function and the arguments to invoke it with after the image.
 
     Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+        The inverse matrix, which maps pixels of the result to the source, the (h,w) size of the result
+        and the highest quality interpolation requested by any of the transformations.
+
+    Raises:
+        ValueError: ops contained a function which is not an affine transformation.
+    """
+    tform = np.identity(3)
+    shape = tuple(shape[:2])
+    interpolation = 'nearest'
+    for command, args in ops:
+        if command not in _AFFINE:
+            raise ValueError(f'Not an affine transformation: \'{command.__name__}\'')
+        builder, argcount = _AFFINE[command]
+        # each inverse matrix maps its destination back into the destination of the previous transformation.
+        step, shape = builder(shape, *args[:argcount])
+        tform = tform @ step
+        if len(args) > argcount:
+            interpolation = max(interpolation, args[argcount], key=_interpolation)
+    return tform, shape, interpolation
+
+
+def resample(img: np.ndarray, inv_transform: np.ndarray, dest: np.ndarray, interpolation: str = 'nearest') -> np.ndarray:
+    """Samples the source through an inverse matrix, such as one returned by compose, to fill the destination.
+    The matrix may be moved so the source and destination are windows of larger images, as long as the
+    window of the source holds every pixel the destination samples.
+
+    Args:
+        img: The source image, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
+        inv_transform: The 3x3 matrix which maps each pixel of the destination to the point of the source it samples.
+        dest: The array to write the result to, with the channels of img.
+        interpolation: How to sample between source pixels, see INTERPOLATIONS.
+
+    Returns:
+        dest.
+
+    Raises:
+        ValueError: img or dest was not grayscale, RGB or RGBA, or they had different channels.
+        ValueError: interpolation was not supported.
+    """
+    return _affine_transformation(img, np.asarray(inv_transform, dtype=np.float32), dest, interpolation)
+
+
+def _crops(command: Callable, args: list) -> bool:
+    """Returns true if the transformation discards pixels which fall outside of the original canvas.
+    """
+    # the expand argument follows the amounts and defaults to true.
+    position = 1 if command is rotate else 2
+    return command in (rotate, shear) and len(args) > position and args[position] == False
+
+
+def _flipv_transform(shape: tuple[int, int]) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix used by flipv and the size of its result.
+    """
+    # create matrix which flips at the origin then slides it back "in frame"
+    return _inverse_transform(scale_x=-1, offset_x=shape[1] - 1), tuple(shape[:2])
+
+
+def _fliph_transform(shape: tuple[int, int]) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix used by fliph and the size of its result.
+    """
+    # create matrix which flips at the origin then slides it back "in frame"
+    return _inverse_transform(scale_y=-1, offset_y=shape[0] - 1), tuple(shape[:2])
+
+
+def _rotate90_transform(shape: tuple[int, int], times: int = 1) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns an inverse matrix equivalent to rotate90 and the size of its result.
+    """
+    height, width = shape[:2]
+    times = max(0, times) % 4
+    # a quarter turn maps the destination pixel (x,y) to the source pixel (w-1-y,x).
+    if times == 1:
+        return np.array([[0, -1, width - 1], [1, 0, 0], [0, 0, 1]], dtype=np.float32), (width, height)
+    if times == 2:
+        return np.array([[-1, 0, width - 1], [0, -1, height - 1], [0, 0, 1]], dtype=np.float32), (height, width)
+    if times == 3:
+        return np.array([[0, 1, 0], [-1, 0, height - 1], [0, 0, 1]], dtype=np.float32), (width, height)
+    return np.identity(3, dtype=np.float32), (height, width)
+
+
+def _transpose_transform(shape: tuple[int, int]) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix equivalent to transpose and the size of its result.
+    """
+    return np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=np.float32), (shape[1], shape[0])
+
+
+def _orient_transform(shape: tuple[int, int], orientation: int) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix equivalent to orient and the size of its result.
+    """
+    if orientation not in _ORIENTATIONS:
+        raise ValueError(f'Unknown orientation: {orientation}')
+    tform, shape, _ = compose(shape, _ORIENTATIONS[orientation])
+    return tform.astype(np.float32), shape
+
+
+def _rotate_transform(shape: tuple[int, int], angle: float = 45, expand=True) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix used by rotate and the size of its result.
     """
     # convert angle to radians and precalculate values
     rads = math.radians(angle)
@@ -104,14 +411,13 @@ def rotate(img: np.ndarray, angle: float = 45, expand=True) -> np.ndarray:
                     [0, 0, 1]], dtype=np.float32)
 
     # matrix to translate the image so the center moves to the (0,0) origin point.
-    center = np.array([[1, 0, img.shape[1] // 2],
-                       [0, 1, img.shape[0] // 2],
+    center = np.array([[1, 0, shape[1] // 2],
+                       [0, 1, shape[0] // 2],
                        [0, 0, 1]], dtype=np.float32)
 
     # calculate the size destination image based on the rotation
-    height, width = img.shape[:2] if expand == False else _calc_new_img_size(
-        img.shape, rot)
-    dest = np.zeros((height, width, 3), dtype=np.uint8)
+    height, width = shape[:2] if expand == False else _calc_new_img_size(
+        shape, rot)
 
     # matrix to move the center of the image from the origin to the center of the destination image.
     back = np.array([[1, 0, -width//2],
@@ -123,23 +429,11 @@ def rotate(img: np.ndarray, angle: float = 45, expand=True) -> np.ndarray:
     # to accomodate the new image size due to rotation.
     tform = center @ rot @ back
 
-    return _affine_transformation(img, tform, dest)
+    return tform, (height, width)
 
 
-def scale(img: np.ndarray, scale: float) -> np.ndarray:
-    """Re-sizes the image uniformly based on a scale factor
-
-    Args:
-        img: The source RGB image with shape=(h,w,3).
-        scale: Non-zero positive number multiplied by the width and height of the image
-            to determine the dimensions of the resulting image.  
-
-    Returns:
-        A new ndarray with dtype=uint8 and shape=(h * scale,w * scale, 3).
-
-    Raises:
-        ValueError: img was not RGB.
-        ValueError: scale was less than or equal than zero.
+def _scale_transform(shape: tuple[int, int], scale: float) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix used by scale and the size of its result.
     """
     if(scale <= 0):
         raise ValueError('Scale must be greater than zero')
@@ -148,40 +442,27 @@ def scale(img: np.ndarray, scale: float) -> np.ndarray:
     tform = _inverse_transform(scale_x=scale, scale_y=scale)
 
     # calculate the dimensions of the image after scaling is applied
-    height, width = _calc_new_img_size(img.shape, tform)
-    dest = np.empty((height, width, 3), dtype=np.uint8)
+    return tform, _calc_new_img_size(shape, tform)
 
-    return _affine_transformation(img, tform, dest)
 
-
-def shear(img: np.ndarray, shear_x: float, shear_y: float, expand=True) -> np.ndarray:
-    """Shears the image in the specified dimension(s)
-
-    Args:
-        img: The source RGB image with shape=(h,w,3).
-        shear_x: The amount to shear the image in the x axis (0.0 does nothing)
-        shear_y: The amount to shear the image in the y axis (0.0 does nothing)
-        expand: If true, expands the dimensions of resulting image so it's large enough to hold the entire skewed image. 
-
-    Returns:
-        A new ndarray with dtype=uint8 and shape=(h,w,3).
+def _shear_transform(shape: tuple[int, int], shear_x: float, shear_y: float, expand=True) -> tuple[np.ndarray, tuple[int, int]]:
+    """Returns the inverse matrix used by shear and the size of its result.
     """
     # start with a basic shear matrix
     tform = _inverse_transform(shear_x=shear_x, shear_y=shear_y)
 
     # calculate the new dimensions of the image based after the shear is applied
-    height, width = img.shape[:2] if expand == False else _calc_new_img_size(
-        img.shape, tform)
-    dest = np.zeros((height, width, 3), dtype=np.uint8)
+    height, width = shape[:2] if expand == False else _calc_new_img_size(
+        shape, tform)
 
     # if applying a negative shear factor then we need to apply an
     # offset to the images final position so it remains "in frame"
     if shear_x < 0 and expand == True:
-        tform = tform @ _inverse_transform(offset_x=abs(width - img.shape[1]))
+        tform = tform @ _inverse_transform(offset_x=abs(width - shape[1]))
     if shear_y < 0 and expand == True:
-        tform = tform @ _inverse_transform(offset_y=abs(height - img.shape[0]))
+        tform = tform @ _inverse_transform(offset_y=abs(height - shape[0]))
 
-    return _affine_transformation(img, tform, dest)
+    return tform, (height, width)
 
 
 def _calc_new_img_size(src_shape: tuple[int, int], inv_transform: np.ndarray) -> tuple[int, int]:
@@ -218,12 +499,145 @@ def _inverse_transform(scale_x: float = 1., shear_x: float = 0., offset_x: float
                                    [0, 0, 1]], dtype=np.float32))
 
 
-def _affine_transformation(src: np.ndarray, inv_transform: np.ndarray, dest: np.ndarray):
-    """Applies the affine transformation to the source and writes the result to the destination.
+def _interpolation(interpolation: str) -> int:
+    """Returns the c library constant for the interpolation.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f'Unknown interpolation: \'{interpolation}\'')
+    return INTERPOLATIONS[interpolation]
+
+
+def _reorient(oriented: np.ndarray, view=False, dest: np.ndarray = None) -> np.ndarray:
+    """Returns the flipped or transposed view of an image, or copies it into the destination or a new contiguous array.
     """
-    if src.shape[-1] != 3 or dest.shape[-1] != 3:
-        raise ValueError('Expected RGB Image array of shape (h,w,3).')
+    if view:
+        if dest is not None:
+            raise ValueError('out can not be used with view.')
+        return oriented
+    dest = validation.output(dest, oriented.shape, oriented)
+    if oriented.size == 0:
+        return dest
+
+    # the c library works with pixels of any number of channels, so treat grayscale as one channel.
+    pixels = oriented if oriented.ndim == 3 else oriented[:, :, np.newaxis]
+    if pixels.strides[2] != 1:
+        pixels = np.ascontiguousarray(pixels)
+    out = dest if dest.ndim == 3 else dest[:, :, np.newaxis]
+    profiling.engine('orient_copy')
+
+    def copy_band(start: int, end: int):
+        clib.lib.orient_copy(pixels, pixels.ctypes.shape, pixels.ctypes.strides, out, start, end)
+
+    parallel.run_bands(copy_band, pixels.shape[0])
+    return dest
 
-    bp_clib.affine_transform(src, src.ctypes.shape, src.ctypes.strides, inv_transform,
-                             dest, dest.ctypes.shape, dest.ctypes.strides)
+
+def _oriented_view(img: np.ndarray, inv_transform: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    """Returns a view of the image equivalent to the transformation if it only flips, transposes or turns the whole image
+    onto a destination of the given size, otherwise None.
+    """
+    inv = np.asarray(inv_transform, dtype=np.float64)
+    linear = np.rint(inv[:2, :2])
+    if not np.allclose(inv[:2, :2], linear, atol=1e-5) or np.count_nonzero(linear) != 2 or np.abs(linear).sum() != 2:
+        return None
+
+    # the first row of the matrix gives the source column and the second the source row.
+    transposed = linear[0, 0] == 0
+    height, width = img.shape[:2]
+    if tuple(shape) != ((width, height) if transposed else (height, width)):
+        return None
+    flip_cols = linear[0].sum() < 0
+    flip_rows = linear[1].sum() < 0
+    offsets = (width - 1 if flip_cols else 0, height - 1 if flip_rows else 0)
+    if not np.allclose(inv[:2, 2], offsets, atol=1e-3):
+        return None
+
+    oriented = img[::-1 if flip_rows else 1, ::-1 if flip_cols else 1]
+    return np.swapaxes(oriented, 0, 1) if transposed else oriented
+
+
+def _affine_transformation(src: np.ndarray, inv_transform: np.ndarray, dest: np.ndarray, interpolation: str = 'nearest',
+                           pyramid: downscale.Pyramid = None):
+    """Applies the affine transformation to the source and writes the result to the destination.
+    """
+    if validation.pixels(src).shape[2] != validation.pixels(dest).shape[2]:
+        raise ValueError('Expected the source and destination to have the same number of channels.')
+    sampling = _interpolation(interpolation)
+
+    # flips and quarter turns move whole pixels without resampling, so copy them instead.
+    if (oriented := _oriented_view(src, inv_transform, dest.shape[:2])) is not None:
+        return _reorient(oriented, dest=dest)
+
+    # reductions by whole factors average each block of source pixels, which is a single streaming read of the source.
+    factors = downscale.whole_factors(inv_transform)
+    if factors is not None and all(-(-size // factor) >= dest_size
+                                   for size, factor, dest_size in zip(src.shape, factors, dest.shape)):
+        return downscale.box(src, *factors, dest=dest)
+
+    # larger reductions sample the mipmap level closest to the destination size, so at most a 2x reduction is sampled.
+    level = downscale.level_for(inv_transform)
+    temporary = None
+    if level > 0:
+        profiling.engine('pyramid level', level)
+        # levels of a pyramid built just for this transformation are scratch memory, given back once it is done.
+        if pyramid is None:
+            pyramid = temporary = downscale.Pyramid(src)
+        src = pyramid.level(level)
+        inv_transform = np.diag([0.5 ** level, 0.5 ** level, 1]) @ inv_transform
+        sampling = max(sampling, INTERPOLATIONS['bilinear'])
+
+    inv_transform = np.ascontiguousarray(inv_transform, dtype=np.float32)
+    # the c library samples every channel of a pixel, so view grayscale as one channel.
+    pixels, target = validation.pixels(src), validation.pixels(dest)
+    channels = pixels.shape[2]
+
+    # every destination row is independent, so split the destination into bands of rows.
+    def transform_band(start: int, end: int):
+        clib.lib.affine_transform(pixels, pixels.ctypes.shape, pixels.ctypes.strides, inv_transform,
+                                  target, target.ctypes.shape, target.ctypes.strides, channels, sampling, start, end)
+
+    # without rotation or shear every row samples the same columns, so interpolation can be done in two separable passes.
+    if sampling != INTERPOLATIONS['nearest'] and inv_transform[0, 1] == 0 and inv_transform[1, 0] == 0:
+        def transform_band(start: int, end: int):
+            col_taps = buffers.empty(target.shape[1], np.int32)
+            col_weights = buffers.empty((target.shape[1], 4), np.int16)
+            # the row is padded with copies of the edge pixels for the taps which fall outside of the source.
+            row_buffer = buffers.empty((pixels.shape[1] + 5, channels), np.int16)
+            clib.lib.affine_resample_axis(pixels, pixels.ctypes.shape, pixels.ctypes.strides, inv_transform,
+                                          target, target.ctypes.shape, target.ctypes.strides, channels, sampling,
+                                          col_taps, col_weights, row_buffer, start, end)
+            buffers.release(col_taps, col_weights, row_buffer)
+        profiling.engine('affine_resample_axis', _SAMPLING_NAMES[sampling])
+    else:
+        profiling.engine('affine_transform', _SAMPLING_NAMES[sampling])
+
+    parallel.run_bands(transform_band, dest.shape[0])
+    if temporary is not None:
+        temporary.release()
     return dest
+
+
+# transformations which can be expressed as an inverse matrix, mapped to the function which builds their matrix and result size
+# and the number of arguments the function takes. Any argument after those is the interpolation.
+_AFFINE = {
+    flipv: (_flipv_transform, 0),
+    fliph: (_fliph_transform, 0),
+    rotate90: (_rotate90_transform, 1),
+    transpose: (_transpose_transform, 0),
+    orient: (_orient_transform, 1),
+    rotate: (_rotate_transform, 2),
+    scale: (_scale_transform, 1),
+    shear: (_shear_transform, 3),
+}
+
+# EXIF orientations mapped to the transformations which make the image upright, applied in order.
+_ORIENTATIONS = {
+    1: [],
+    2: [(flipv, [])],
+    3: [(fliph, []), (flipv, [])],
+    4: [(fliph, [])],
+    5: [(transpose, [])],
+    6: [(rotate90, [3])],
+    7: [(fliph, []), (flipv, []), (transpose, [])],
+    8: [(rotate90, [1])],
+}
@@ -1,16 +1,59 @@
 """Functions for modifying the colors of images.
 """
 import numpy as np
+import buffers
 
+# numbers of channels the library supports, grayscale, RGB and RGBA.
+CHANNELS = (1, 3, 4)
 
-def ensure_8bit_rgb(img: np.ndarray):
-    """Raises an exception if the img is not an RGB image. 
+
+def pixels(img: np.ndarray) -> np.ndarray:
+    """Returns the image with shape=(h,w,c), viewing a grayscale image with shape=(h,w) as having one channel.
+    The c library walks every image as rows of pixels with a number of channels, so the view lets it handle grayscale natively.
 
     Args
-        img: The image to validate. 
+        img: The image to view, grayscale with shape=(h,w), RGB with shape=(h,w,3) or RGBA with shape=(h,w,4).
 
     Raises
-        ValueError: The image was not an RGB image with and shape=(h,w,3).
+        ValueError: The image was not grayscale, RGB or RGBA.
+    """
+    if img.ndim == 2:
+        return img[:, :, np.newaxis]
+    if img.ndim != 3 or img.shape[2] not in CHANNELS:
+        raise ValueError('img must be grayscale with shape (h,w), RGB with shape (h,w,3) or RGBA with shape (h,w,4).')
+    return img
+
+
+def output(out: np.ndarray, shape: tuple[int, ...], *sources: np.ndarray, in_place: bool = False) -> np.ndarray:
+    """Returns the array an operation writes its result to.
+    A new array is taken with buffers.empty if out is None, otherwise out is checked and returned.
+
+    Args
+        out: The array provided by the caller, or None.
+        shape: The shape of the result.
+        sources: The arrays the operation reads from.
+        in_place: True if the operation may write to the same memory it reads from.
+
+    Raises
+        ValueError: out was not a writeable C contiguous uint8 array of the given shape.
+        ValueError: out overlapped a source, and the operation can not work in place or the overlap was not exact.
+    """
+    if out is None:
+        return buffers.empty(shape, np.uint8)
+    if not isinstance(out, np.ndarray) or out.dtype != np.uint8:
+        raise ValueError('out must be an ndarray with dtype=uint8.')
+    if out.shape != tuple(shape):
+        raise ValueError(f'out must have shape {tuple(shape)} but has shape {out.shape}.')
+    if not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError('out must be C contiguous and writeable.')
+    for source in sources:
+        if np.may_share_memory(out, source) and not (in_place and _same_memory(out, source)):
+            raise ValueError('out must not overlap the source image.' if not in_place else
+                             'out must either be the source image or not overlap it.')
+    return out
+
+
+def _same_memory(a: np.ndarray, b: np.ndarray) -> bool:
+    """Returns true if both arrays cover exactly the same memory in the same layout.
     """
-    if img.ndim != 3 and img.shape[-1] != 3:
-        raise ValueError("img must be RGB with shape (h,w,3).")
+    return a.ctypes.data == b.ctypes.data and a.shape == b.shape and a.strides == b.strides
@@ -0,0 +1,6 @@
+"""Makes the modules of bpimage importable by the tests, which import them by name as the modules do themselves.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bpimage'))
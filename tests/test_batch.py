@@ -0,0 +1,55 @@
+"""Tests for running the batch CLI over a directory of images with a pool of worker processes.
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+import color
+import filters
+import io_utils
+import pipeline
+
+BATCH = Path(__file__).resolve().parent.parent / 'bpimage' / 'batch.py'
+
+
+def _batch(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, str(BATCH), *args], capture_output=True, text=True, timeout=120)
+
+
+def _sources(directory: Path) -> dict[str, np.ndarray]:
+    directory.mkdir()
+    rng = np.random.default_rng(0)
+    images = {f'{name}.png': rng.integers(0, 256, shape, dtype=np.uint8)
+              for name, shape in [('gray', (40, 30)), ('rgb', (40, 30, 3)), ('rgba', (30, 40, 4)), ('raw', (20, 20, 3))]}
+    images['raw.npy'] = images.pop('raw.png')
+    for name, img in images.items():
+        io_utils.save(img, str(directory / name))
+    return images
+
+
+def test_batch_matches_pipeline(tmp_path):
+    images = _sources(tmp_path / 'sources')
+    result = _batch(str(tmp_path / 'sources'), '-o', str(tmp_path / 'out'), '-n', 'edited_{name}', '-w', '2',
+                    '--gaussian', '2', '1.2', '--brightness', '1.3')
+    assert result.returncode == 0, result.stderr
+    assert f'processed {len(images)} of {len(images)} images' in result.stdout
+
+    # the edits are applied by group, color modifications before filters, whatever their order on the command line.
+    ops = [(color.brightness, [1.3]), (filters.gaussian_blur, [2, 1.2])]
+    for name, img in images.items():
+        np.testing.assert_array_equal(io_utils.open(str(tmp_path / 'out' / f'edited_{name}')),
+                                      pipeline.Pipeline(img, ops).compute())
+
+
+def test_batch_reports_failed_files(tmp_path):
+    images = _sources(tmp_path / 'sources')
+    (tmp_path / 'sources' / 'broken.png').write_bytes(b'not an image')
+    result = _batch(str(tmp_path / 'sources'), '-o', str(tmp_path / 'out'), '-w', '2', '--invert')
+
+    # the other files are still processed, and the exit status reports the failure.
+    assert result.returncode == 1
+    assert 'broken.png' in result.stderr and f'1 of {len(images) + 1} images failed.' in result.stderr
+    for name, img in images.items():
+        np.testing.assert_array_equal(io_utils.open(str(tmp_path / 'out' / name)), color.invert(img))
@@ -0,0 +1,102 @@
+"""Tests for the buffer pool and the pool each thread sees as active.
+"""
+import threading
+
+import numpy as np
+
+import buffers
+import parallel
+
+
+def test_pool_reuses_released_buffers():
+    pool = buffers.BufferPool()
+    with pool:
+        first = buffers.empty((100, 100, 3))
+        buffers.release(first)
+        second = buffers.empty((100, 100, 3))
+    assert pool.allocations == 1
+    assert pool.reuses == 1
+    assert pool.owns(second)
+    assert buffers.active() is None
+
+
+def test_nested_pools_restore_previous():
+    outer, inner = buffers.BufferPool(), buffers.BufferPool()
+    with outer:
+        with inner:
+            assert buffers.active() is inner
+        assert buffers.active() is outer
+    assert buffers.active() is None
+
+
+def test_threads_have_their_own_pools():
+    # both threads enter their pool before either exits, which leaked a pool when the active pool was global.
+    entered = threading.Barrier(2)
+    exiting = threading.Barrier(2)
+    seen = {}
+
+    def work(name):
+        pool = buffers.BufferPool()
+        with pool:
+            entered.wait()
+            array = buffers.empty((64, 64))
+            seen[name] = (buffers.active() is pool, pool.owns(array))
+            exiting.wait()
+        seen[name + ' after'] = buffers.active()
+
+    threads = [threading.Thread(target=work, args=(name,)) for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert seen['a'] == (True, True)
+    assert seen['b'] == (True, True)
+    assert seen['a after'] is None
+    assert seen['b after'] is None
+    assert buffers.active() is None
+
+
+def test_shared_pool_entered_by_two_threads():
+    pool = buffers.BufferPool()
+    entered = threading.Barrier(2)
+    first_exited = threading.Event()
+    seen = {}
+
+    def work(name, exit_first):
+        with pool:
+            entered.wait()
+            if not exit_first:
+                first_exited.wait()
+            seen[name] = buffers.active() is pool
+        if exit_first:
+            first_exited.set()
+        seen[name + ' after'] = buffers.active()
+
+    threads = [threading.Thread(target=work, args=('a', True)), threading.Thread(target=work, args=('b', False))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert seen == {'a': True, 'b': True, 'a after': None, 'b after': None}
+
+
+def test_bands_see_the_callers_pool():
+    threads = parallel.get_threads()
+    parallel.set_threads(4)
+    try:
+        pool = buffers.BufferPool()
+        seen = []
+        with pool:
+            parallel.run_bands(lambda start, end: seen.append(buffers.active()), 4 * parallel.MIN_BAND_ROWS)
+        assert len(seen) == 4
+        assert all(active is pool for active in seen)
+    finally:
+        parallel.set_threads(threads)
+
+
+def test_empty_without_pool():
+    array = buffers.empty((3, 4), np.float32)
+    assert array.shape == (3, 4)
+    assert array.dtype == np.float32
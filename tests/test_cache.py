@@ -0,0 +1,97 @@
+"""Tests for the on-disk cache of encoded results.
+"""
+import os
+
+import numpy as np
+
+import cache
+import color
+import filters
+
+
+OPS = [(filters.gaussian_blur, [2, 1.5]), (color.brightness, [1.2])]
+
+
+def _entry_sizes(directory) -> list[int]:
+    return sorted(path.stat().st_size for path in directory.iterdir())
+
+
+def test_key_changes_with_each_input():
+    key = cache.ResultCache.key(b'source', OPS, '.png')
+    # numbers are compared as floats and extensions without case.
+    assert cache.ResultCache.key(b'source', [(filters.gaussian_blur, [2.0, 1.5]), (color.brightness, [1.2])], '.PNG') == key
+
+    assert cache.ResultCache.key(b'other', OPS, '.png') != key
+    assert cache.ResultCache.key(b'source', OPS[:1], '.png') != key
+    assert cache.ResultCache.key(b'source', [(filters.gaussian_blur, [2, 1.5]), (color.brightness, [1.3])], '.png') != key
+    assert cache.ResultCache.key(b'source', OPS, '.jpg') != key
+
+    # kernels are compared by their contents.
+    kern = np.ones((3, 3), dtype=np.float32)
+    assert (cache.ResultCache.key(b'source', [(filters.convolve, [kern])], '.png')
+            == cache.ResultCache.key(b'source', [(filters.convolve, [kern.copy()])], '.png'))
+    assert (cache.ResultCache.key(b'source', [(filters.convolve, [kern])], '.png')
+            != cache.ResultCache.key(b'source', [(filters.convolve, [kern * 2])], '.png'))
+
+
+def test_get_or_compute_hit_and_miss(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return b'result'
+
+    result_cache = cache.ResultCache(str(tmp_path))
+    key = result_cache.key(b'source', OPS, '.png')
+    assert result_cache.get_or_compute(key, compute) == (b'result', False)
+    assert result_cache.get_or_compute(key, compute) == (b'result', True)
+    assert len(calls) == 1
+
+    # another instance sharing the directory finds the entry.
+    assert cache.ResultCache(str(tmp_path)).get_or_compute(key, compute) == (b'result', True)
+    stats = result_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (1, 1, 1, len(b'result'))
+
+
+def test_library_version_invalidates_entries(tmp_path, monkeypatch):
+    result_cache = cache.ResultCache(str(tmp_path))
+    result_cache.put(result_cache.key(b'source', OPS, '.png'), b'old')
+
+    monkeypatch.setattr(cache, 'library_version', lambda: 'rebuilt')
+    data, hit = result_cache.get_or_compute(result_cache.key(b'source', OPS, '.png'), lambda: b'new')
+    assert (data, hit) == (b'new', False)
+
+
+def test_evict_keeps_cache_within_cap(tmp_path):
+    result_cache = cache.ResultCache(str(tmp_path), max_bytes=1000)
+    for index in range(30):
+        result_cache.put(f'entry{index}', bytes(index * 5))
+        # entries written in the same instant would tie, so age each one explicitly.
+        os.utime(tmp_path / f'entry{index}', (index, index))
+        assert sum(_entry_sizes(tmp_path)) <= 1000
+    assert result_cache.evictions > 0
+    # the least recently used are the ones removed, leaving the largest entries which were written last.
+    assert (tmp_path / 'entry29').exists() and not (tmp_path / 'entry0').exists()
+
+    # results larger than the cap are never stored.
+    result_cache.put('huge', bytes(1001))
+    assert not (tmp_path / 'huge').exists()
+
+
+def test_evict_only_lists_directory_past_cap(tmp_path, monkeypatch):
+    result_cache = cache.ResultCache(str(tmp_path), max_bytes=1000)
+    listings = []
+    entries = result_cache._entries
+    monkeypatch.setattr(result_cache, '_entries', lambda: listings.append(None) or entries())
+
+    for index in range(100):
+        result_cache.put(f'entry{index}', bytes(50))
+    # the first put lists the directory, then only every time the running total passes the cap.
+    assert 1 < len(listings) <= 100 * 50 // (1000 - int(1000 * cache._LOW_WATER))
+    assert sum(_entry_sizes(tmp_path)) <= 1000
+
+    # replacing an entry counts only the difference in size.
+    listings.clear()
+    for _ in range(10):
+        result_cache.put('entry99', bytes(50))
+    assert not listings
@@ -0,0 +1,54 @@
+"""Tests for sending jobs to a running server with the client CLI.
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import color
+import io_utils
+
+BPIMAGE = Path(__file__).resolve().parent.parent / 'bpimage'
+
+
+def _client(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, str(BPIMAGE / 'client.py'), *args], capture_output=True, text=True, timeout=60)
+
+
+@pytest.fixture(scope='module')
+def url():
+    server = subprocess.Popen([sys.executable, str(BPIMAGE / 'server.py'), '--port', '0', '-w', '1'],
+                              stderr=subprocess.PIPE, text=True)
+    try:
+        # the server announces its address once it is listening.
+        line = server.stderr.readline()
+        assert line.startswith('listening on '), line
+        yield line.split()[2]
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def test_client_saves_result(url, tmp_path):
+    img = np.random.default_rng(0).integers(0, 256, (40, 30, 4), dtype=np.uint8)
+    io_utils.save(img, str(tmp_path / 'source.png'))
+
+    result = _client(str(tmp_path / 'source.png'), '-d', str(tmp_path / 'dest.png'), '--url', url, '--invert')
+    assert result.returncode == 0, result.stderr
+    np.testing.assert_array_equal(io_utils.open(str(tmp_path / 'dest.png')), color.invert(img))
+
+
+def test_client_reports_refused_job(url, tmp_path):
+    io_utils.save(np.zeros((10, 10), dtype=np.uint8), str(tmp_path / 'source.png'))
+    result = _client(str(tmp_path / 'source.png'), '-d', str(tmp_path / 'dest.png'), '--url', url, '--brightness', 'bright')
+    assert result.returncode == 1
+    assert 'brightness' in result.stderr
+    assert not (tmp_path / 'dest.png').exists()
+
+
+def test_client_reports_unreachable_server(tmp_path):
+    result = _client(str(tmp_path / 'source.png'), '-d', str(tmp_path / 'dest.png'), '--url', 'http://127.0.0.1:1')
+    assert result.returncode == 1
+    assert 'Could not reach the server' in result.stderr
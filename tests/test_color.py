@@ -0,0 +1,61 @@
+"""Tests for color modifications on grayscale, RGB and RGBA images, and the lookup table and color matrix c kernels.
+"""
+import numpy as np
+import pytest
+
+import color
+import colormatrix
+import lut
+import pipeline
+
+
+def _image(shape: tuple[int, ...]) -> np.ndarray:
+    return np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize('strength', [0.0, 0.5, 1.0, 1.8])
+def test_saturation_keeps_grayscale(strength):
+    img = _image((50, 40))
+    np.testing.assert_array_equal(color.saturation(img, strength), img)
+
+
+@pytest.mark.parametrize('shape', [(50, 40), (50, 40, 3), (50, 40, 4)])
+@pytest.mark.parametrize('strength', [1.0, 1.5])
+def test_pipeline_saturation_matches_direct(shape, strength):
+    # a strength of one is dropped from the pipeline, which has to give the shape saturation would.
+    img = _image(shape)
+    np.testing.assert_array_equal(pipeline.Pipeline(img).saturation(strength).compute(), color.saturation(img, strength))
+
+
+def test_fused_saturation_after_grayscale():
+    img = _image((50, 40, 3))
+    fused = color.apply_matrices(img, [(color.rgb2grayscale, []), (color.saturation, [1.3])])
+    np.testing.assert_array_equal(fused, color.saturation(color.rgb2grayscale(img), 1.3))
+
+
+@pytest.mark.parametrize('shape', [(50, 40), (50, 40, 3), (50, 40, 4)])
+def test_lut_matches_indexing(shape):
+    img = _image(shape)
+    table = np.random.default_rng(1).integers(0, 256, 256, dtype=np.uint8)
+    np.testing.assert_array_equal(lut.apply(img, table), table[img])
+    # the table may be applied in place, and to a view which has to be copied first.
+    view = img[:, ::2]
+    np.testing.assert_array_equal(lut.apply(view, table), table[view])
+    lut.apply(img, table, out=img)
+    np.testing.assert_array_equal(img, table[_image(shape)])
+
+
+@pytest.mark.parametrize('in_channels, out_channels', [(1, 1), (1, 3), (3, 1), (3, 3), (4, 4), (3, 4)])
+def test_color_matrix_matches_reference(in_channels, out_channels):
+    img = _image((50, 40, in_channels))
+    # weights above one and below zero, with offsets, so the clamp on both ends is exercised.
+    matrix = np.random.default_rng(2).uniform(-1.0, 1.5, (out_channels, in_channels + 1)).astype(np.float32)
+    matrix[:, -1] *= 100
+
+    expected = img.astype(np.float64) @ matrix[:, :-1].T.astype(np.float64) + matrix[:, -1]
+    expected = np.clip(expected, 0, 255).astype(np.uint8)
+    source = img[:, :, 0] if in_channels == 1 else img
+    result = colormatrix.apply(source, matrix)
+    assert result.shape == ((50, 40) if out_channels == 1 else (50, 40, out_channels))
+    # the c library sums in single precision, which can truncate a value that lands on an integer one level lower.
+    assert np.max(np.abs(result.reshape(expected.shape).astype(np.int16) - expected)) <= 1
@@ -0,0 +1,44 @@
+"""Tests for the block averaging c kernel, against a reference which rounds each block mean to the nearest integer.
+"""
+import numpy as np
+import pytest
+
+import downscale
+
+
+def _image(shape: tuple[int, ...]) -> np.ndarray:
+    return np.random.default_rng(5).integers(0, 256, shape, dtype=np.uint8)
+
+
+def _reference(img: np.ndarray, factor_y: int, factor_x: int) -> np.ndarray:
+    """Averages every block, blocks along the bottom and right edges only cover the pixels which exist.
+    """
+    pixels = img if img.ndim == 3 else img[:, :, np.newaxis]
+    height, width = pixels.shape[:2]
+    result = np.empty((-(-height // factor_y), -(-width // factor_x), pixels.shape[2]), dtype=np.uint8)
+    for y in range(result.shape[0]):
+        for x in range(result.shape[1]):
+            block = pixels[y * factor_y:(y + 1) * factor_y, x * factor_x:(x + 1) * factor_x].astype(np.int64)
+            count = block.shape[0] * block.shape[1]
+            result[y, x] = (block.sum(axis=(0, 1)) + count // 2) // count
+    return result.reshape(result.shape[:2] + img.shape[2:])
+
+
+@pytest.mark.parametrize('factors', [(2, 2), (3, 3), (4, 3), (1, 5), (7, 7)])
+@pytest.mark.parametrize('shape', [(45, 61), (45, 61, 3), (45, 61, 4)])
+def test_box_matches_reference(factors, shape):
+    img = _image(shape)
+    np.testing.assert_array_equal(downscale.box(img, *factors), _reference(img, *factors))
+
+
+@pytest.mark.parametrize('shape', [(45, 61, 3), (45, 61, 4)])
+def test_box_reads_strided_views(shape):
+    # a transposed view strides its rows and pixels differently, which the c kernel reads without a copy.
+    img = _image(shape).transpose(1, 0, 2)
+    np.testing.assert_array_equal(downscale.box(img, 3, 2), _reference(np.ascontiguousarray(img), 3, 2))
+
+
+def test_pyramid_levels_halve():
+    img = _image((45, 61, 3))
+    pyramid = downscale.Pyramid(img)
+    np.testing.assert_array_equal(pyramid.level(2), _reference(_reference(img, 2, 2), 2, 2))
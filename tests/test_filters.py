@@ -0,0 +1,134 @@
+"""Tests for the convolution engines and the box blur c kernel, against each other and a floating point reference.
+"""
+import numpy as np
+import pytest
+
+import filters
+
+IMAGES = {
+    'gray': (41, 57),
+    'rgb': (41, 57, 3),
+    'rgba': (41, 57, 4),
+}
+
+MODES = ['edge', 'reflect', 'wrap', 'constant']
+
+# filters which _convolve runs on the fixed-point engine, with the arguments to build their kernel.
+FIXED_POINT_FILTERS = [
+    (filters.gaussian_blur, [1, 1.0]),
+    (filters.gaussian_blur, [3, 1.5]),
+    (filters.boxblur, [1, 1]),
+    (filters.boxblur, [2, 1]),
+    (filters.outline, []),
+    (filters.sharpen, [5.0]),
+    (filters.sharpen, [2.0]),
+    (filters.emboss, ['u', 1]),
+    (filters.emboss, ['l', 3]),
+    (filters.motion_blur, []),
+]
+
+
+def _image(shape: tuple[int, ...]) -> np.ndarray:
+    return np.random.default_rng(3).integers(0, 256, shape, dtype=np.uint8)
+
+
+def _padded(img: np.ndarray, radius: int, mode: str) -> np.ndarray:
+    """Pads the rows and columns of the image as the c library reads pixels beyond its edges.
+    """
+    pixels = img if img.ndim == 3 else img[:, :, np.newaxis]
+    return np.pad(pixels, ((radius, radius), (radius, radius), (0, 0)), mode=mode).astype(np.float64)
+
+
+def _reference(img: np.ndarray, kern: np.ndarray, bias: float, mode: str) -> np.ndarray:
+    """Correlates the image with the kernel in floating point, then clamps and truncates like the c library.
+    """
+    radius = kern.shape[0] // 2
+    padded = _padded(img, radius, mode)
+    height, width = img.shape[:2]
+    result = np.full((height, width, padded.shape[2]), bias, dtype=np.float64)
+    for y in range(kern.shape[0]):
+        for x in range(kern.shape[1]):
+            result += kern[y, x] * padded[y:y + height, x:x + width]
+    return np.clip(result, 0, 255).astype(np.uint8).reshape(img.shape)
+
+
+def _max_diff(first: np.ndarray, second: np.ndarray) -> int:
+    assert first.shape == second.shape
+    return int(np.max(np.abs(first.astype(np.int16) - second)))
+
+
+@pytest.mark.parametrize('command, args', FIXED_POINT_FILTERS,
+                         ids=[f'{command.__name__}{args}' for command, args in FIXED_POINT_FILTERS])
+@pytest.mark.parametrize('name', IMAGES)
+def test_fixed_point_matches_float(command, args, name):
+    img = _image(IMAGES[name])
+    kern, bias = filters._linear_kernel(command, args)
+    quantized = filters._quantize_kernel(kern, bias)
+    separated = filters._separate_kernel(kern)
+    # the filter has to actually take the fixed-point engine, on the test image and on a photo sized one.
+    for shape in (img.shape[:2], (4000, 6000)):
+        assert filters._choose_engine(shape, kern.shape[0], separated is not None, quantized is not None) == 'fixed'
+
+    fixed = filters._convolve_fixed(img, kern, quantized, bias=bias)
+    assert _max_diff(fixed, filters._convolve_direct(img, kern, bias=bias)) <= 1
+    if separated is not None:
+        assert _max_diff(fixed, filters._convolve_separable(img, *separated, bias=bias)) <= 1
+    assert _max_diff(fixed, _reference(img, kern, bias, 'edge')) <= 1
+
+
+@pytest.mark.parametrize('engine', ['direct', 'separable', 'fixed', 'fft'])
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('name', IMAGES)
+def test_engines_match_reference(engine, mode, name):
+    img = _image(IMAGES[name])
+    kern, bias = filters._gaussian_kernel(2, 1.2)
+    if engine == 'direct':
+        result = filters._convolve_direct(img, kern, bias=bias, mode=mode)
+    elif engine == 'separable':
+        result = filters._convolve_separable(img, *filters._separate_kernel(kern), bias=bias, mode=mode)
+    elif engine == 'fixed':
+        result = filters._convolve_fixed(img, kern, filters._quantize_kernel(kern, bias), bias=bias, mode=mode)
+    else:
+        result = filters._convolve_fft(img, kern, bias=bias, mode=mode)
+    assert _max_diff(result, _reference(img, kern, bias, mode)) <= 1
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('name', IMAGES)
+def test_direct_matches_reference_with_bias(mode, name):
+    # an asymmetric kernel with negative weights and a bias catches flipped kernels and a wrong clamp.
+    img = _image(IMAGES[name])
+    kern, bias = filters._emboss_kernel('l', 2)
+    result = filters._convolve_direct(img, kern, bias=bias, mode=mode)
+    assert _max_diff(result, _reference(img, kern, bias, mode)) <= 1
+
+
+@pytest.mark.parametrize('radii', [[1], [3], [2, 2, 3]])
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('name', IMAGES)
+def test_box_blur_matches_reference(radii, mode, name):
+    img = _image(IMAGES[name])
+    expected = img
+    for radius in radii:
+        # every pass is the window sum rounded to the nearest integer.
+        size = 2 * radius + 1
+        padded = _padded(expected, radius, mode)
+        height, width = img.shape[:2]
+        sums = sum(padded[y:y + height, x:x + width] for y in range(size) for x in range(size))
+        expected = ((sums + size * size // 2) // (size * size)).astype(np.uint8).reshape(img.shape)
+    np.testing.assert_array_equal(filters._box_blur(img, radii, mode=mode), expected)
+
+
+@pytest.mark.parametrize('sig', [1.5, 3.0, 5.0])
+@pytest.mark.parametrize('mode', ['edge', 'reflect', 'constant'])
+def test_fast_gaussian_approximates_gaussian(sig, mode):
+    img = _image(IMAGES['rgb'])
+    radius = int(np.ceil(3 * sig))
+    fast = filters.fast_gaussian_blur(img, sig, 3, mode).astype(np.int16)[radius:-radius, radius:-radius]
+    exact = filters.gaussian_blur(img, radius, sig, mode)[radius:-radius, radius:-radius]
+    # away from the border, where each box pass pads the image again, three boxes stay within a few levels of the gaussian.
+    diff = fast - exact
+    assert np.max(np.abs(diff)) <= 4
+    assert np.mean(np.abs(diff)) <= 1.0
+    # the boxes round and the gaussian truncates, so the approximation is about half a level brighter, never darker.
+    assert 0.0 <= np.mean(diff) <= 0.75
@@ -0,0 +1,96 @@
+"""Tests for running bands of rows on the worker threads while other threads change the number of threads.
+"""
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import parallel
+
+
+@pytest.fixture
+def switch_often():
+    # switching threads as often as possible makes the races between them likely to show.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def _fill(height: int) -> np.ndarray:
+    rows = np.zeros(height, dtype=np.int64)
+
+    def band(start, end):
+        rows[start:end] += 1
+    parallel.run_bands(band, height)
+    return rows
+
+
+def test_bands_cover_every_row_once():
+    threads = parallel.get_threads()
+    try:
+        parallel.set_threads(4)
+        assert np.all(_fill(1000) == 1)
+    finally:
+        parallel.set_threads(threads)
+
+
+def test_first_use_creates_one_executor(monkeypatch, switch_often):
+    created = []
+
+    class CountingExecutor(parallel.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            created.append(self)
+            # a slow start leaves time for the other threads to find no executor either.
+            time.sleep(0.01)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(parallel, 'ThreadPoolExecutor', CountingExecutor)
+    monkeypatch.setattr(parallel, '_executor', None)
+    monkeypatch.setattr(parallel, '_threads', 4)
+    start = threading.Barrier(8)
+
+    def work():
+        start.wait()
+        _fill(1000)
+    workers = [threading.Thread(target=work) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for executor in created:
+        executor.shutdown()
+    assert len(created) == 1
+
+
+def test_set_threads_while_bands_run(switch_often):
+    # changing the thread count used to shut down the executor other threads were submitting to.
+    threads = parallel.get_threads()
+    stop = threading.Event()
+    errors = []
+    runs = []
+
+    def work():
+        try:
+            while not stop.is_set():
+                assert np.all(_fill(500) == 1)
+                runs.append(1)
+        except Exception as e:
+            errors.append(e)
+    workers = [threading.Thread(target=work) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline and not errors:
+            parallel.set_threads(2 + len(runs) % 3)
+            time.sleep(0.001)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+        parallel.set_threads(threads)
+    assert errors == []
+    assert runs
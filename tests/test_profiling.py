@@ -0,0 +1,46 @@
+"""Tests for recording stages with a profile.
+"""
+import threading
+import tracemalloc
+
+import profiling
+
+
+def test_records_nested_stages():
+    with profiling.Profile() as profile:
+        profiling.run('outer', lambda: profiling.run('inner', lambda: profiling.engine('kernel', 3)))
+    assert [(stage['stage'], stage['depth']) for stage in profile.stages] == [('outer', 0), ('inner', 1)]
+    assert profile.stages[1]['engines'] == ['kernel 3']
+    assert not profiling.active()
+    assert not tracemalloc.is_tracing()
+
+
+def test_threads_have_their_own_profiles():
+    entered = threading.Barrier(2)
+    exiting = threading.Barrier(2)
+    profiles = {}
+    after = {}
+
+    def work(name):
+        with profiling.Profile() as profile:
+            entered.wait()
+            profiling.run(name, lambda: None)
+            exiting.wait()
+        profiles[name] = profile
+        after[name] = profiling.active()
+
+    threads = [threading.Thread(target=work, args=(name,)) for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [stage['stage'] for stage in profiles['a'].stages] == ['a']
+    assert [stage['stage'] for stage in profiles['b'].stages] == ['b']
+    assert after == {'a': False, 'b': False}
+    assert not profiling.active()
+    assert not tracemalloc.is_tracing()
+
+
+def test_run_without_profile():
+    assert profiling.run('stage', lambda value: value + 1, 1) == 2
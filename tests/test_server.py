@@ -0,0 +1,97 @@
+"""Tests for the paths jobs may name and the addresses the server may listen on.
+"""
+import http.client
+import json
+import os
+import socket
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'images').mkdir(parents=True)
+    return os.path.realpath(root)
+
+
+def test_paths_within_root(root):
+    assert server._job_path('images/a.png', root, True) == os.path.join(root, 'images', 'a.png')
+    assert server._job_path(os.path.join(root, 'b.png'), root, True) == os.path.join(root, 'b.png')
+    assert server._job_path(None, root, True) is None
+
+
+@pytest.mark.parametrize('path', ['../a.png', 'images/../../a.png', '/etc/passwd'])
+def test_paths_outside_root_are_refused(root, path):
+    with pytest.raises(server.JobError):
+        server._job_path(path, root, True)
+
+
+def test_symbolic_links_out_of_root_are_refused(root, tmp_path):
+    os.symlink(tmp_path, os.path.join(root, 'escape'))
+    with pytest.raises(server.JobError):
+        server._job_path('escape/a.png', root, True)
+
+
+def test_paths_refused_when_not_allowed():
+    with pytest.raises(server.JobError):
+        server._job_path('a.png', None, False)
+    assert server._job_path(None, None, False) is None
+    assert server._job_path('/any/a.png', None, True) == '/any/a.png'
+
+
+@pytest.mark.parametrize('host, loopback', [('127.0.0.1', True), ('::1', True), ('localhost', True),
+                                            ('0.0.0.0', False), ('', False), ('8.8.8.8', False)])
+def test_loopback_hosts(host, loopback):
+    assert server._is_loopback(host) == loopback
+
+
+@pytest.fixture(scope='module')
+def address():
+    # the requests tested are refused before reaching a worker, so the server runs without any.
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), server._Handler)
+    httpd.jobs, httpd.cache, httpd.root, httpd.paths = None, None, None, True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _post(address, headers: list[str], body: bytes = b'') -> tuple[int, dict]:
+    """Sends a raw request to /jobs so the headers can be malformed, and returns the status and JSON body.
+    """
+    # a request the server keeps reading would otherwise hang the test rather than fail it.
+    with socket.create_connection(address, timeout=5) as connection:
+        connection.sendall('\r\n'.join(['POST /jobs HTTP/1.1', 'Host: localhost', *headers, '', '']).encode() + body)
+        response = http.client.HTTPResponse(connection)
+        response.begin()
+        return response.status, json.loads(response.read())
+
+
+def test_missing_length_is_refused(address):
+    assert _post(address, [])[0] == 411
+
+
+@pytest.mark.parametrize('length', ['ten', '-1', '1.5'])
+def test_invalid_length_is_refused(address, length):
+    status, body = _post(address, [f'Content-Length: {length}'], b'{}')
+    assert status == 400
+    assert 'Content-Length' in body['error']
+
+
+@pytest.mark.parametrize('args', [5, None, 'invert', [['--invert']], [{'a': 1}]])
+def test_invalid_args_are_refused(address, args):
+    body = json.dumps({'data': '', 'args': args}).encode()
+    status, response = _post(address, [f'Content-Length: {len(body)}'], body)
+    assert status == 400
+    assert 'args' in response['error']
+
+
+def test_args_may_be_numbers():
+    _, _, ops, _, _ = server._parse_job(json.dumps({'data': '', 'args': ['--brightness', 1.5]}).encode())
+    assert len(ops) == 1
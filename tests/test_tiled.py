@@ -0,0 +1,108 @@
+"""Tests for decoding and encoding images for the tiled engine without holding them in memory.
+"""
+import itertools
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import color
+import filters
+import io_utils
+import pipeline
+import tiled
+import transform
+
+
+def _image(shape: tuple[int, ...]) -> np.ndarray:
+    return np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+
+
+@pytest.fixture
+def create(tmp_path):
+    names = itertools.count()
+
+    def create(shape):
+        return np.lib.format.open_memmap(tmp_path / f'pixels{next(names)}.npy', mode='w+', dtype=np.uint8, shape=shape)
+    return create
+
+
+@pytest.fixture(params=[True, False], ids=['mapped', 'public'])
+def maps_arrays(request, monkeypatch):
+    # both the arrays handed to Pillow as its memory and the fallback through the public api.
+    monkeypatch.setattr(io_utils, '_MAPS_ARRAYS', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA', 'LA', 'P', '1', 'I;16'])
+@pytest.mark.parametrize('extension', ['.png', '.tif'])
+def test_open_into_matches_open(tmp_path, create, maps_arrays, mode, extension):
+    path = str(tmp_path / f'source{extension}')
+    if mode == 'I;16':
+        # older Pillow can't convert RGB to 16 bit grayscale.
+        Image.fromarray(_image((61, 47)).astype(np.uint16) * 257).save(path)
+    else:
+        Image.fromarray(_image((61, 47, 4))).convert(mode).save(path)
+
+    # a strip of a few rows makes conversions take several strips.
+    img = io_utils.open_into(path, create, 500)
+    assert isinstance(img, np.memmap)
+    np.testing.assert_array_equal(img, io_utils.open(path))
+
+
+def test_open_into_converts_transparency(tmp_path, create, maps_arrays):
+    path = str(tmp_path / 'source.png')
+    Image.fromarray(_image((61, 47, 3))).convert('P').save(path, transparency=3)
+    img = io_utils.open_into(path, create, 500)
+    assert img.shape == (61, 47, 4)
+    np.testing.assert_array_equal(img, io_utils.open(path))
+
+
+def test_open_into_keeps_pixel_limit(tmp_path, create, monkeypatch):
+    path = str(tmp_path / 'source.png')
+    Image.fromarray(_image((61, 47, 3))).save(path)
+    expected = io_utils.open(path)
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+
+    with pytest.raises(io_utils.ImageOpenError):
+        io_utils.open_into(path, create, 500)
+    with pytest.raises(io_utils.ImageOpenError, match='more than 2000 pixels'):
+        io_utils.open_into(path, create, 500, max_pixels=2000)
+    np.testing.assert_array_equal(io_utils.open_into(path, create, 500, max_pixels=61 * 47), expected)
+    assert Image.MAX_IMAGE_PIXELS == 1000
+
+
+@pytest.mark.parametrize('shape', [(61, 47), (61, 47, 3), (61, 47, 4)])
+@pytest.mark.parametrize('extension', ['.png', '.tif', '.jpg'])
+def test_save_from_matches_save(tmp_path, create, maps_arrays, shape, extension):
+    img = _image(shape)
+    io_utils.save(img, str(tmp_path / f'whole{extension}'))
+    io_utils.save_from(img, str(tmp_path / f'packed{extension}'), create, 500)
+    # a view of some of the columns has to be copied into Pillow's layout.
+    wide = np.zeros((shape[0], shape[1] + 2, *shape[2:]), dtype=np.uint8)
+    wide[:, 1:-1] = img
+    io_utils.save_from(wide[:, 1:-1], str(tmp_path / f'view{extension}'), create, 500)
+
+    expected = io_utils.open(str(tmp_path / f'whole{extension}'))
+    np.testing.assert_array_equal(io_utils.open(str(tmp_path / f'packed{extension}')), expected)
+    np.testing.assert_array_equal(io_utils.open(str(tmp_path / f'view{extension}')), expected)
+
+
+def test_process_encoded_source_and_dest(tmp_path):
+    source, dest = str(tmp_path / 'source.png'), str(tmp_path / 'dest.png')
+    img = _image((200, 150, 3))
+    io_utils.save(img, source)
+    ops = [(filters.gaussian_blur, [3, 1.5]), (color.brightness, [1.1])]
+
+    tiled.process(source, ops, dest, memory_budget=64 * 2**10, workdir=str(tmp_path))
+    np.testing.assert_array_equal(io_utils.open(dest), pipeline.Pipeline(img, ops).compute())
+
+
+def test_process_raw_source_matches_pipeline(tmp_path):
+    # a modification which reads the mean of the image, a filter with a halo and a transformation resampled in tiles.
+    dest = str(tmp_path / 'dest.npy')
+    img = _image((200, 150, 4))
+    ops = [(color.contrast, [1.4]), (filters.fast_gaussian_blur, [2.0]), (transform.scale, [0.5])]
+
+    tiled.process(img, ops, dest, memory_budget=256 * 2**10, workdir=str(tmp_path))
+    np.testing.assert_array_equal(io_utils.open(dest), pipeline.Pipeline(img, ops).compute())
@@ -0,0 +1,221 @@
+"""Tests for the interpolating paths of the affine c kernels, against a floating point reference,
+for fused transformations, against applying each in turn, and for the orientation copy, against numpy and Pillow.
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import transform
+
+IMAGES = {
+    'gray': (37, 53),
+    'rgb': (37, 53, 3),
+    'rgba': (37, 53, 4),
+}
+
+
+def _image(shape: tuple[int, ...]) -> np.ndarray:
+    return np.random.default_rng(7).integers(0, 256, shape, dtype=np.uint8)
+
+
+def _bicubic(distance: np.ndarray) -> np.ndarray:
+    d = np.abs(distance)
+    return np.where(d <= 1, (1.5 * d - 2.5) * d * d + 1, np.where(d < 2, ((-0.5 * d + 2.5) * d - 4) * d + 2, 0))
+
+
+def _reference(img: np.ndarray, inv: np.ndarray, shape: tuple[int, int], interpolation: str):
+    """Samples the image at the center of each destination pixel in floating point, repeating the edge pixels.
+    Returns the result and a mask of the pixels which land too close to the border of the source to compare.
+    """
+    pixels = (img if img.ndim == 3 else img[:, :, np.newaxis]).astype(np.float64)
+    height, width = pixels.shape[:2]
+    inv = inv.astype(np.float64)
+    ys, xs = np.mgrid[0:shape[0], 0:shape[1]] + 0.5
+    sx = inv[0, 0] * xs + inv[0, 1] * ys + inv[0, 2] - 0.5
+    sy = inv[1, 0] * xs + inv[1, 1] * ys + inv[1, 2] - 0.5
+    inside = (sx >= -0.5) & (sx < width - 0.5) & (sy >= -0.5) & (sy < height - 0.5)
+    border = np.zeros_like(inside)
+    for coord, size in ((sx, width), (sy, height)):
+        border |= (np.abs(coord + 0.5) < 1e-3) | (np.abs(coord - size + 0.5) < 1e-3)
+
+    ix, iy = np.floor(sx).astype(int), np.floor(sy).astype(int)
+    fx, fy = sx - ix, sy - iy
+    if interpolation == 'bilinear':
+        offsets = [0, 1]
+        wx, wy = [1 - fx, fx], [1 - fy, fy]
+    else:
+        offsets = [-1, 0, 1, 2]
+        wx = [_bicubic(fx - offset) for offset in offsets]
+        wy = [_bicubic(fy - offset) for offset in offsets]
+
+    result = np.zeros((*shape, pixels.shape[2]))
+    for j, dy in enumerate(offsets):
+        rows = np.clip(iy + dy, 0, height - 1)
+        for i, dx in enumerate(offsets):
+            cols = np.clip(ix + dx, 0, width - 1)
+            result += (wy[j] * wx[i])[:, :, np.newaxis] * pixels[rows, cols]
+    result = np.where(inside[:, :, np.newaxis], np.clip(np.rint(result), 0, 255), 0)
+    return result.reshape(shape + img.shape[2:]), border
+
+
+def _check(img: np.ndarray, inv: np.ndarray, shape: tuple[int, int], interpolation: str):
+    dest = np.empty(shape + img.shape[2:], np.uint8)
+    transform._affine_transformation(img, np.asarray(inv, np.float32), dest, interpolation)
+    expected, border = _reference(img, np.asarray(inv, np.float32), shape, interpolation)
+    difference = np.abs(dest.astype(int) - expected.astype(int))
+    assert difference[~border].max() <= 1
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+@pytest.mark.parametrize('name', IMAGES)
+@pytest.mark.parametrize('scale_x, scale_y, offset_x, offset_y', [(1.5, 1.5, 0, 0), (0.7, 0.7, 0, 0), (1.7, 0.6, 3.2, -2.5),
+                                                                   (-1.3, 1.1, 60, 0)])
+def test_resample_axis_matches_reference(name, interpolation, scale_x, scale_y, offset_x, offset_y):
+    img = _image(IMAGES[name])
+    inv = transform._inverse_transform(scale_x=scale_x, scale_y=scale_y, offset_x=offset_x, offset_y=offset_y)
+    _check(img, inv, (round(img.shape[0] * abs(scale_y)) + 3, round(img.shape[1] * abs(scale_x)) + 3), interpolation)
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+@pytest.mark.parametrize('name', IMAGES)
+@pytest.mark.parametrize('angle', [30, -7, 135])
+def test_transform_matches_reference(name, interpolation, angle):
+    img = _image(IMAGES[name])
+    inv, shape = transform._rotate_transform(img.shape, angle)
+    _check(img, inv, shape, interpolation)
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+def test_strided_pixels_match_packed(interpolation):
+    # a view which drops the alpha channel has pixels 4 bytes apart, which takes the paths for unpacked pixels.
+    rgba = _image(IMAGES['rgba'])
+    view, packed = rgba[:, :, :3], np.ascontiguousarray(rgba[:, :, :3])
+    for func, args in ((transform.scale, [1.5]), (transform.scale, [0.7]), (transform.rotate, [30])):
+        assert np.array_equal(func(view, *args, interpolation=interpolation), func(packed, *args, interpolation=interpolation))
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+@pytest.mark.parametrize('name', IMAGES)
+def test_flat_areas_stay_flat(name, interpolation):
+    img = np.full(IMAGES[name], 173, np.uint8)
+    assert np.all(transform.scale(img, 1.37, interpolation) == 173)
+    # pixels outside of the source are cleared, every other pixel keeps the value.
+    assert set(np.unique(transform.rotate(img, 30, interpolation=interpolation))) == {0, 173}
+
+
+
+def _interior(mask: np.ndarray, reach: int) -> np.ndarray:
+    """Returns the pixels of the mask whose neighbours within reach are all in the mask.
+    """
+    padded = np.pad(mask, reach)
+    height, width = mask.shape
+    interior = np.ones_like(mask)
+    for dy in range(2 * reach + 1):
+        for dx in range(2 * reach + 1):
+            interior &= padded[dy:dy + height, dx:dx + width]
+    return interior
+
+
+def _apply_in_turn(img: np.ndarray, ops: list) -> np.ndarray:
+    for command, args in ops:
+        img = command(img, *args)
+    return img
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+def test_fused_matches_applying_in_turn(interpolation):
+    ys, xs = np.mgrid[0:60, 0:80]
+    img = np.stack([128 + 100 * np.sin(xs / 7), 128 + 100 * np.cos(ys / 9), (xs + ys) * 1.5], axis=-1).clip(0, 255).astype(np.uint8)
+    ops = [(transform.rotate, [25, True, interpolation]), (transform.scale, [1.3, interpolation]),
+           (transform.shear, [0.2, 0.1, True, interpolation])]
+    assert transform.fuse(ops) == [(transform.apply_affines, [ops])]
+
+    in_turn, fused = _apply_in_turn(img, ops), transform.apply_affines(img, ops)
+    assert fused.shape == in_turn.shape
+    # compare the pixels which sample the source in both, away from its edges where interpolation reads the border.
+    opaque = np.full(img.shape, 255, np.uint8)
+    inside = (_apply_in_turn(opaque, ops) == 255).all(axis=2) & (transform.apply_affines(opaque, ops) == 255).all(axis=2)
+    difference = np.abs(fused.astype(int) - in_turn)[_interior(inside, 2)]
+    # resampling once rounds once, applying each in turn blurs and rounds three times.
+    assert difference.max() <= 3
+    assert difference.mean() <= 0.5
+
+
+def test_cropping_ends_fused_run():
+    scale, crop, shear, flip = ((transform.scale, [1.2]), (transform.rotate, [20, False]), (transform.shear, [0.1, 0.0]),
+                                (transform.fliph, []))
+    assert transform.fuse([scale, crop, shear, flip]) == [(transform.apply_affines, [[scale, crop]]),
+                                                          (transform.apply_affines, [[shear, flip]])]
+    assert transform.fuse([crop, (transform.shear, [0.1, 0.0, False]), scale]) == [crop, (transform.shear, [0.1, 0.0, False]), scale]
+
+    # the corners cleared by the crop stay cleared, the following shear doesn't bring the source back into view.
+    opaque = np.full(IMAGES['rgb'], 255, np.uint8)
+    ops = [scale, crop, shear, flip]
+    in_turn, fused = _apply_in_turn(opaque, ops), _apply_in_turn(opaque, transform.fuse(ops))
+    assert fused.shape == in_turn.shape
+    cleared = (in_turn == 0).all(axis=2)
+    assert np.all(fused[_interior(cleared, 1)] == 0)
+    assert np.all(fused[_interior(~cleared, 1)] == 255)
+
+
+# Pillow transpositions which make an image with each EXIF orientation upright.
+_UPRIGHT = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+@pytest.mark.parametrize('orientation', range(1, 9))
+@pytest.mark.parametrize('name', IMAGES)
+def test_orient_matches_pillow(orientation, name):
+    img = _image(IMAGES[name])
+    image = Image.fromarray(img)
+    expected = np.asarray(image.transpose(_UPRIGHT[orientation]) if orientation in _UPRIGHT else image)
+    result = transform.orient(img, orientation)
+    assert result.flags.c_contiguous and result.flags.owndata
+    np.testing.assert_array_equal(result, expected)
+    np.testing.assert_array_equal(transform.orient(img, orientation, view=True), expected)
+
+
+def _source(kind: str, channels: int) -> np.ndarray:
+    """Returns an image with more rows and columns than a tile of the orientation copy, contiguous or as a view.
+    """
+    shape = (150, 97) if channels == 1 else (150, 97, channels)
+    if kind == 'contiguous':
+        return _image(shape)
+    if kind == 'strided':
+        # every other row and every third pixel of a larger image, so neither rows nor pixels are adjacent.
+        return _image((2 * shape[0] + 5, 3 * shape[1] + 7, *shape[2:]))[5::2, 7::3][:shape[0], :shape[1]]
+    if kind == 'swapped':
+        return np.swapaxes(_image((shape[1], shape[0], *shape[2:])), 0, 1)
+    # the color of RGBA, whose pixels are one byte wider than their channels.
+    return _image((*shape[:2], 4))[:, :, :channels]
+
+
+# orientation copies and the numpy view each one has to reproduce.
+_ORIENTATIONS = {
+    'fliph': (lambda img: transform.fliph(img), lambda img: np.flip(img, 0)),
+    'flipv': (lambda img: transform.flipv(img), lambda img: np.flip(img, 1)),
+    'rotate90': (lambda img: transform.rotate90(img), lambda img: np.rot90(img, 1)),
+    'rotate180': (lambda img: transform.rotate90(img, 2), lambda img: np.rot90(img, 2)),
+    'rotate270': (lambda img: transform.rotate90(img, 3), lambda img: np.rot90(img, 3)),
+    'transpose': (lambda img: transform.transpose(img), lambda img: np.swapaxes(img, 0, 1)),
+    'transverse': (lambda img: transform.orient(img, 7), lambda img: np.rot90(np.swapaxes(img, 0, 1), 2)),
+}
+
+
+@pytest.mark.parametrize('orientation', _ORIENTATIONS)
+@pytest.mark.parametrize('kind, channels', [('contiguous', 1), ('contiguous', 3), ('contiguous', 4),
+                                            ('strided', 1), ('strided', 3), ('strided', 4),
+                                            ('swapped', 1), ('swapped', 3), ('swapped', 4), ('padded', 3)])
+def test_orient_copy_matches_numpy(orientation, kind, channels):
+    img = _source(kind, channels)
+    copy, expected = _ORIENTATIONS[orientation]
+    result = copy(img)
+    assert result.flags.c_contiguous and not np.shares_memory(result, img)
+    np.testing.assert_array_equal(result, expected(img))